@@ -0,0 +1,134 @@
+# Approximate nearest neighbor search over the rows of the UAM by random-projection locality sensitive hashing (LSH).
+# Users are hashed by the signs of random projections (similar angle, same bucket); the candidates found in the
+# buckets of a query are then ranked by their exact similarity (inner product)
+__author__ = 'mms'
+
+# Load required modules
+import os
+import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+
+# Parameters
+N_TABLES = 32               # number of hash tables (more tables: higher recall, slower queries)
+N_BITS = 8                  # number of bits (random hyperplanes) per table (more bits: smaller buckets, lower recall)
+N_PROBES = 2                # number of additional buckets probed per table, by flipping the least certain bits
+DENSITY = 1.0 / 3           # fraction of non-zero entries of the (sparse) random hyperplanes
+SEED = 1                    # seed of the random number generator for the hyperplanes
+
+
+# Function to create a sparse random projection matrix of size |artists| * (n_tables * n_bits),
+# with entries +1 / -1 at the given density (and 0 otherwise)
+def random_projections(no_artists, n_tables, n_bits, seed, density=DENSITY):
+    rng = np.random.RandomState(seed)
+    no_planes = n_tables * n_bits
+    planes = sp.random(no_artists, no_planes, density=density, format='csr', dtype=np.float32, random_state=rng)
+    planes.data = np.where(rng.randint(0, 2, size=planes.nnz) == 1, 1.0, -1.0).astype(np.float32)
+    return planes
+
+
+# Function to project rows (dense or sparse) onto the hyperplanes. It returns a dense matrix of size |rows| * |planes|
+def project(vecs, planes):
+    if sp.issparse(vecs):
+        return np.asarray((vecs * planes).todense(), dtype=np.float32)
+    return np.asarray(planes.T.dot(np.asarray(vecs).T).T, dtype=np.float32)
+
+
+# Function to compute the hash key per table from projections. It returns an integer matrix of size |rows| * n_tables
+def hash_keys(proj, n_tables, n_bits):
+    bits = (proj > 0).reshape(proj.shape[0], n_tables, n_bits).astype(np.int64)
+    return np.sum(bits << np.arange(n_bits, dtype=np.int64), axis=2)
+
+
+# Function to build the LSH index over all rows of the UAM.
+# It returns the index as dictionary of arrays (hyperplanes, sorted keys and user order per table)
+def build_lsh_index(UAM, n_tables=N_TABLES, n_bits=N_BITS, seed=SEED, density=DENSITY):
+    planes = random_projections(UAM.shape[1], n_tables, n_bits, seed, density)
+    keys = hash_keys(project(UAM, planes), n_tables, n_bits)
+
+    # Sort users by key for every table, so that a bucket is a contiguous range found by binary search
+    order = np.argsort(keys, axis=0, kind='mergesort').astype(np.int32)
+    sorted_keys = keys[order, np.arange(n_tables)]
+
+    return {"planes": planes, "order": order, "sorted_keys": sorted_keys, "n_tables": n_tables, "n_bits": n_bits,
+            "seed": seed, "density": density}
+
+
+# Function to compute the keys of the buckets to probe for the given projections of queries: the query's own bucket
+# in every table, plus the buckets reached by flipping each of the n_probes least certain bits (smallest projections).
+# It returns an integer array of size |queries| * n_tables * (1 + n_probes)
+def probe_keys(proj, n_tables, n_bits, n_probes=N_PROBES):
+    keys = hash_keys(proj, n_tables, n_bits)
+    proj = np.abs(proj).reshape(proj.shape[0], n_tables, n_bits)
+    flip_bits = np.argsort(proj, axis=2, kind='mergesort')[:, :, :n_probes].astype(np.int64)
+    return np.concatenate([keys[:, :, np.newaxis], keys[:, :, np.newaxis] ^ (1 << flip_bits)], axis=2)
+
+
+# Function to query the approximate K nearest neighbors (by inner product) of the given vectors.
+# Candidates are taken from the probed buckets of the LSH index and ranked by their exact similarity.
+# If exclude is given, the user exclude[i] is removed from the candidates of query i.
+# It returns a list with (neighbor indices, similarities) for each query, sorted by decreasing similarity;
+# fewer than K neighbors are returned if the probed buckets hold fewer candidates
+def query_lsh(index, UAM, vecs, K, exclude=None, n_probes=N_PROBES):
+    vecs = vecs.toarray() if sp.issparse(vecs) else np.atleast_2d(vecs)
+    n_tables = index["n_tables"]
+    keys = probe_keys(project(vecs, index["planes"]), n_tables, index["n_bits"], n_probes)
+
+    # Find the range of every probed bucket in the sorted keys of its table, for all queries at once
+    lo = np.zeros(keys.shape, dtype=np.int64)
+    hi = np.zeros(keys.shape, dtype=np.int64)
+    for t in range(n_tables):
+        lo[:, t, :] = np.searchsorted(index["sorted_keys"][:, t], keys[:, t, :], side='left')
+        hi[:, t, :] = np.searchsorted(index["sorted_keys"][:, t], keys[:, t, :], side='right')
+
+    results = []
+    for i in range(vecs.shape[0]):
+        cands = np.unique(np.concatenate([index["order"][lo[i, t, p]:hi[i, t, p], t]
+                                          for t in range(n_tables) for p in range(keys.shape[2])]))
+        if exclude is not None:
+            cands = cands[cands != exclude[i]]
+        if sp.issparse(UAM):
+            sim = np.asarray(UAM[cands, :].dot(vecs[i]), dtype=np.float32).ravel()
+        else:
+            sim = np.dot(UAM[cands, :], vecs[i]).astype(np.float32)
+
+        # Select the K most similar candidates
+        top = np.argsort(-sim, kind='mergesort')[:K]
+        results.append((cands[top].astype(np.int32), sim[top]))
+    return results
+
+
+# Function to save an LSH index (binary format, see UAM_Storage). uam_hash is the content hash of the indexed UAM
+def save_lsh_index(filename, index, uam_hash=None):
+    planes = index["planes"].tocsr()
+    UAM_Storage.write_arrays(filename, {"planes_data": planes.data, "planes_indices": planes.indices,
+                                        "planes_indptr": planes.indptr, "order": index["order"],
+                                        "sorted_keys": index["sorted_keys"]},
+                             {"kind": "lsh_index", "n_tables": index["n_tables"], "n_bits": index["n_bits"],
+                              "seed": index["seed"], "density": index["density"], "shape": list(planes.shape),
+                              "uam_hash": uam_hash})
+
+
+# Function to load an LSH index (memory-mapped)
+def load_lsh_index(filename, mmap=True):
+    arrays, header = UAM_Storage.read_arrays(filename, mmap)
+    planes = sp.csr_matrix((arrays["planes_data"], arrays["planes_indices"], arrays["planes_indptr"]),
+                           shape=tuple(header["shape"]))
+    return {"planes": planes, "order": arrays["order"], "sorted_keys": arrays["sorted_keys"],
+            "n_tables": header["n_tables"], "n_bits": header["n_bits"], "seed": header.get("seed"),
+            "density": header.get("density"), "uam_hash": header["uam_hash"]}
+
+
+# Function to load the LSH index for the given UAM file, or to build (and save) it if it does not exist,
+# was built from a different UAM or with different parameters
+def get_lsh_index(UAM, uam_file, index_file, n_tables=N_TABLES, n_bits=N_BITS, seed=SEED, density=DENSITY):
+    uam_hash = UAM_Storage.content_hash(uam_file)
+    if os.path.exists(index_file):
+        index = load_lsh_index(index_file)
+        if uam_hash is not None and index["uam_hash"] == uam_hash and index["n_tables"] == n_tables and \
+                index["n_bits"] == n_bits and index["seed"] == seed and index["density"] == density:
+            return index
+
+    index = build_lsh_index(UAM, n_tables, n_bits, seed, density)
+    save_lsh_index(index_file, index, uam_hash)
+    return index
@@ -0,0 +1,240 @@
+# Canonicalization of artist names in listening events by matching them to a local MusicBrainz artist dump,
+# so that variants of a name (e.g. "The Beatles", "Beatles, The") become one artist (column) in the UAM.
+# Names are matched exactly after normalization, or else by their character trigrams via an inverted index
+__author__ = 'mms'
+
+# Load required modules
+import os
+import re
+import csv
+import time
+import unicodedata
+import numpy as np
+import UAM_Storage
+
+# Parameters
+LE_FILE = "mrs_le.txt"                          # aggregated listening events, to read from
+CANONICAL_LE_FILE = "mrs_le_canonical.txt"      # listening events with canonical artist names (input of converter
+                                                # if its USE_CANONICAL is set)
+MB_ARTIST_FILE = "mbdump/artist"                # MusicBrainz dump: artist table (id, gid, name, sort name, ...)
+MB_ALIAS_FILE = "mbdump/artist_alias"           # MusicBrainz dump: artist alias table (id, artist, name, ...)
+INDEX_FILE = "mb_artist_index.bin"              # n-gram index built from the dump (binary format, see UAM_Storage)
+
+CANONICAL_FIELD = "name"        # write canonical artist "name" or MusicBrainz ID ("mbid") to the listening events
+THRESHOLD = 0.8                 # minimum similarity (Dice coefficient of trigrams) of a fuzzy match
+
+
+# Function to normalize an artist name for matching: lower case, without accents and punctuation,
+# "&" as "and", and without leading "the" (also when written as "Beatles, The")
+def normalize_name(name):
+    if not isinstance(name, unicode):
+        name = name.decode('utf8', 'replace')
+    name = unicodedata.normalize('NFKD', name.lower())
+    name = u"".join([c for c in name if not unicodedata.combining(c)])
+    name = name.replace(u"&", u" and ")
+    name = re.sub(u"[^\\w\\s,]", u"", name, flags=re.UNICODE)
+    name = re.sub(u",\\s*the$", u"", name.strip())
+    name = re.sub(u"^the\\s+", u"", name)
+    return u" ".join(name.replace(u",", u" ").split())
+
+
+# Function to compute the character trigrams of a normalized name (padded by blanks), coded as integers
+def trigrams(name):
+    padded = u" " + name + u" "
+    return np.unique(np.array([(ord(padded[i]) << 42) | (ord(padded[i+1]) << 21) | ord(padded[i+2])
+                               for i in range(0, len(padded) - 2)], dtype=np.int64))
+
+
+# Function to read the names of artists from the MusicBrainz dump (tab-separated tables without header).
+# It returns the artist names and MusicBrainz IDs, and (artist index, name) for all names of artists
+# (name, sort name and aliases)
+def read_musicbrainz(artist_file, alias_file=None):
+    artist_names = []
+    mbids = []
+    artist_idx = {}         # MusicBrainz row id -> artist index
+    names = []
+    with open(artist_file, 'r') as f:
+        reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        for row in reader:
+            artist_idx[row[0]] = len(artist_names)
+            artist_names.append(row[2])
+            mbids.append(row[1])
+            names.append((artist_idx[row[0]], row[2]))
+            names.append((artist_idx[row[0]], row[3]))
+    if alias_file is not None and os.path.exists(alias_file):
+        with open(alias_file, 'r') as f:
+            reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+            for row in reader:
+                if row[1] in artist_idx:
+                    names.append((artist_idx[row[1]], row[2]))
+    return artist_names, mbids, names
+
+
+# Function to build the matching index: for every distinct normalized name the artist it belongs to (the first one
+# for homonyms) and its trigrams (as positions in the sorted trigram keys), and an inverted index from trigrams to the names containing them
+# (both in CSR layout). It returns the index as dictionary of arrays
+def build_index(artist_names, mbids, names):
+    norm_names = []
+    norm_artist = []
+    seen = set()
+    for artist, name in names:
+        norm = normalize_name(name)
+        if norm and norm not in seen:
+            seen.add(norm)
+            norm_names.append(norm)
+            norm_artist.append(artist)
+
+    grams = [trigrams(norm) for norm in norm_names]
+    no_grams = np.array([len(g) for g in grams], dtype=np.int32)
+    keys = np.concatenate(grams) if len(grams) > 0 else np.zeros(0, dtype=np.int64)
+    name_ids = np.repeat(np.arange(len(norm_names), dtype=np.int32), no_grams)
+
+    # Sort (trigram, name) pairs by trigram, postings of a trigram are then a contiguous range
+    order = np.argsort(keys, kind='mergesort')
+    gram_keys, gram_ptr = np.unique(keys[order], return_index=True)
+    gram_ptr = np.append(gram_ptr, len(order)).astype(np.int64)
+
+    return {"artist_names": artist_names, "mbids": mbids, "norm_names": norm_names,
+            "norm_artist": np.array(norm_artist, dtype=np.int32), "no_grams": no_grams,
+            "name_ptr": np.append(0, np.cumsum(no_grams)).astype(np.int64), "name_grams": np.searchsorted(gram_keys, keys).astype(np.int32),
+            "gram_keys": gram_keys, "gram_ptr": gram_ptr, "gram_names": name_ids[order]}
+
+
+# Arrays of the matching index (besides the names)
+INDEX_ARRAYS = ["norm_artist", "no_grams", "name_ptr", "name_grams", "gram_keys", "gram_ptr", "gram_names"]
+
+
+# Function to save the matching index (binary format, see UAM_Storage)
+def save_index(filename, index):
+    arrays = dict((key, index[key]) for key in INDEX_ARRAYS)
+    arrays["artist_names"] = UAM_Storage.encode_names(index["artist_names"])
+    arrays["mbids"] = UAM_Storage.encode_names(index["mbids"])
+    arrays["norm_names"] = UAM_Storage.encode_names([norm.encode('utf8') for norm in index["norm_names"]])
+    UAM_Storage.write_arrays(filename, arrays, {"kind": "artist_index"})
+
+
+# Function to load the matching index (postings memory-mapped)
+def load_index(filename):
+    arrays, header = UAM_Storage.read_arrays(filename)
+    # Plain array views of the memory-mapped arrays (faster slicing)
+    index = dict((key, np.asarray(arrays[key])) for key in INDEX_ARRAYS)
+    index["artist_names"] = UAM_Storage.decode_names(arrays["artist_names"])
+    index["mbids"] = UAM_Storage.decode_names(arrays["mbids"])
+    index["norm_names"] = [norm.decode('utf8') for norm in UAM_Storage.decode_names(arrays["norm_names"])]
+    return index
+
+
+# Function to create a matcher for the given index. The matcher maps a raw artist name to the index of the
+# MusicBrainz artist (-1 if no artist matches) and counts exact, fuzzy and failed matches; results are memoized
+# per raw name. It returns the matcher function and the dictionary of counts
+def create_matcher(index, threshold=THRESHOLD):
+    exact = dict((norm, int(artist)) for norm, artist in zip(index["norm_names"], index["norm_artist"]))
+    cache = {}              # raw name -> artist index
+    stats = {"exact": 0, "fuzzy": 0, "unmatched": 0}
+
+    def match(raw_name):
+        if raw_name in cache:
+            return cache[raw_name]
+        norm = normalize_name(raw_name)
+        artist = exact.get(norm, -1)
+        if artist >= 0:
+            stats["exact"] += 1
+        elif norm and len(index["gram_keys"]) > 0:
+            artist = fuzzy_match(index, trigrams(norm), threshold)
+            stats["fuzzy" if artist >= 0 else "unmatched"] += 1
+        else:
+            stats["unmatched"] += 1
+        cache[raw_name] = artist
+        return artist
+
+    return match, stats
+
+
+# Function to find the name in the index most similar (by Dice coefficient of trigrams) to the given trigrams.
+# A name with similarity >= threshold shares at least min_common trigrams with the query, so it contains one of the
+# (no. trigrams - min_common + 1) rarest trigrams of the query: only the postings of these are read (prefix filter).
+# It returns the index of the artist of the most similar name, or -1 if no name reaches the threshold
+def fuzzy_match(index, grams, threshold=THRESHOLD):
+    gram_keys = index["gram_keys"]
+    gram_ptr = index["gram_ptr"]
+    no_grams = index["no_grams"]
+
+    # Trigrams of the query in the index, ordered by number of names containing them
+    pos = np.minimum(np.searchsorted(gram_keys, grams), len(gram_keys) - 1)
+    pos = pos[gram_keys[pos] == grams]
+    min_common = int(np.ceil(threshold * len(grams) / (2.0 - threshold) - 1e-9))
+    if len(pos) < max(min_common, 1):
+        return -1
+    pos = pos[np.argsort(gram_ptr[pos + 1] - gram_ptr[pos], kind='mergesort')]
+
+    # Candidates: names containing a trigram of the prefix, with a number of trigrams that allows the threshold
+    cand = np.unique(np.concatenate([index["gram_names"][gram_ptr[p]:gram_ptr[p+1]]
+                                     for p in pos[:len(pos) - min_common + 1]]))
+    cand = cand[(no_grams[cand] >= min_common) & (no_grams[cand] <= (2.0 - threshold) / threshold * len(grams))]
+    if len(cand) == 0:
+        return -1
+
+    # Count the trigrams shared by every candidate and the query
+    lengths = no_grams[cand].astype(np.int64)
+    bounds = np.append(0, np.cumsum(lengths))
+    idx = np.arange(bounds[-1]) + np.repeat(index["name_ptr"][cand] - bounds[:-1], lengths)
+    is_query_gram = np.zeros(len(gram_keys), dtype=np.bool_)
+    is_query_gram[pos] = True
+    common = np.add.reduceat(is_query_gram[index["name_grams"][idx]].astype(np.int32), bounds[:-1])
+
+    # Dice coefficient of the trigram sets
+    dice = 2.0 * common / (len(grams) + lengths)
+    best = np.argmax(dice)
+    return int(index["norm_artist"][cand[best]]) if dice[best] >= threshold else -1
+
+
+# Function to load the matching index, or to build (and save) it from the MusicBrainz dump if it does not exist
+def get_index(index_file=INDEX_FILE, artist_file=MB_ARTIST_FILE, alias_file=MB_ALIAS_FILE):
+    if os.path.exists(index_file):
+        return load_index(index_file)
+    index = build_index(*read_musicbrainz(artist_file, alias_file))
+    save_index(index_file, index)
+    return index
+
+
+# Function to replace the artist names of all listening events in le_file by their canonical names (or MusicBrainz
+# IDs, see CANONICAL_FIELD) and write them to output_file. Artists without match keep their raw name.
+# It returns the numbers of distinct raw and canonical artist names
+def canonicalize_LE(le_file, output_file, index, field=CANONICAL_FIELD):
+    match, stats = create_matcher(index)
+    canonical = index["mbids"] if field == "mbid" else index["artist_names"]
+    raw_artists = set()
+    canonical_artists = set()
+
+    start = time.time()
+    no_events = 0
+    with open(le_file, 'r') as f, open(output_file, 'w') as outfile:
+        reader = csv.reader(f, delimiter='\t')      # create reader
+        headers = reader.next()
+        outfile.write("\t".join(headers) + "\n")
+        for row in reader:
+            artist = match(row[1])
+            raw_artists.add(row[1])
+            row[1] = canonical[artist] if artist >= 0 else row[1]
+            canonical_artists.add(row[1])
+            outfile.write("\t".join(row) + "\n")
+            no_events += 1
+
+    elapsed = time.time() - start
+    print "Canonicalized " + str(no_events) + " listening events in %.1fs (%.0f names/s)" % \
+        (elapsed, no_events / max(elapsed, 1e-9))
+    print "Distinct artist names: " + str(stats["exact"]) + " matched exactly, " + str(stats["fuzzy"]) + \
+        " matched by trigrams, " + str(stats["unmatched"]) + " not matched"
+    return len(raw_artists), len(canonical_artists)
+
+
+# Main program
+if __name__ == '__main__':
+
+    # Load or build the index of MusicBrainz artist names
+    index = get_index(INDEX_FILE, MB_ARTIST_FILE, MB_ALIAS_FILE)
+
+    # Canonicalize artist names of listening events
+    no_raw, no_canonical = canonicalize_LE(LE_FILE, CANONICAL_LE_FILE, index)
+    print "Artists: " + str(no_raw) + " raw names, " + str(no_canonical) + " canonical artists (-%.1f%%)" % \
+        (100.0 * (no_raw - no_canonical) / max(no_raw, 1))
@@ -0,0 +1,89 @@
+# Baseline recommenders for a block of seed users at once: most popular artists the seed has not listened to,
+# and randomly drawn artists (seeded, reproducible). Artist popularity is computed once per UAM (in evaluation, once
+# per fold of the cross-validation without the test artists, so that they are not counted)
+__author__ = 'mms'
+
+# Load required modules
+import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+
+
+# Function to compute the popularity of all artists (column sums of the UAM, dense or sparse) and their ranks.
+# It returns a dictionary with the popularity and the artist indices by decreasing popularity
+def popularity_ranks(UAM):
+    if sp.issparse(UAM):
+        popularity = np.asarray(UAM.sum(axis=0), dtype=np.float64).ravel()
+    else:
+        popularity = np.sum(UAM, axis=0, dtype=np.float64)
+    return rank_artists(popularity)
+
+
+# Function to rank all artists by their popularity.
+# It returns a dictionary with the popularity and the artist indices by decreasing popularity
+def rank_artists(popularity):
+    return {"popularity": popularity, "order": np.argsort(-popularity, kind='mergesort')}
+
+
+# Function to save the popularity of the artists and their ranks for every fold of a cross-validation
+# (see popularity_ranks)
+def save_popularity(filename, fold_ranks):
+    UAM_Storage.write_arrays(filename, {"popularity": np.vstack([ranks["popularity"] for ranks in fold_ranks]),
+                                        "order": np.vstack([ranks["order"] for ranks in fold_ranks])},
+                             {"kind": "popularity"})
+
+
+# Function to load the popularity of the artists and their ranks for every fold (memory-mapped).
+# It returns a list with the dictionary of every fold (see popularity_ranks)
+def load_popularity(filename, mmap=True):
+    arrays, header = UAM_Storage.read_arrays(filename, mmap)
+    return [{"popularity": arrays["popularity"][fold], "order": arrays["order"][fold]}
+            for fold in range(0, arrays["order"].shape[0])]
+
+
+# Function to compute the boolean mask of the training artists of a block of seeds, one row per seed
+def train_mask(no_artists, seed_aidx_train):
+    rows = np.repeat(np.arange(len(seed_aidx_train)), [len(aidx) for aidx in seed_aidx_train])
+    mask = np.zeros(shape=(len(seed_aidx_train), no_artists), dtype=np.bool_)
+    if len(rows) > 0:
+        mask[rows, np.concatenate(seed_aidx_train).astype(np.int64)] = True
+    return mask
+
+
+# Function that recommends to every seed the N most popular artists not in her training set.
+# popularity is the dictionary returned by popularity_ranks. Only the N + (largest training set) most popular artists
+# are looked at, all seeds at once. It returns a list with the recommended artist indices (by decreasing popularity)
+# for every seed
+def recommend_popular_batch(popularity, seed_aidx_train, N=50):
+    order = popularity["order"]
+    mask = train_mask(len(order), seed_aidx_train)
+    cand = order[:N + max([len(aidx) for aidx in seed_aidx_train] + [0])]
+
+    # Keep the first N candidates of every row that are not training artists
+    unheard = ~mask[:, cand]
+    keep = unheard & (np.cumsum(unheard, axis=1) <= N)
+    return [cand[row] for row in keep]
+
+
+# Function that recommends to every seed a random number (between 1 and the number of artists not in her training
+# set) of artists drawn with replacement from the artists not in her training set, without duplicates (like
+# recommend_baseline in Evaluate_Recommender). All seeds are drawn at once from the given random number generator.
+# It returns a list with the recommended artist indices (in ascending order) for every seed
+def recommend_random_batch(no_artists, seed_aidx_train, rng):
+    mask = train_mask(no_artists, seed_aidx_train)
+    no_seeds = len(seed_aidx_train)
+
+    # Artists not listened to, as one flat array with the artists of each seed in a contiguous range
+    rows, unheard = np.nonzero(~mask)
+    no_unheard = np.bincount(rows, minlength=no_seeds)
+    offsets = np.append(0, np.cumsum(no_unheard)[:-1])
+
+    # Number of draws per seed, then the draws (positions among the seed's unheard artists)
+    no_draws = np.where(no_unheard > 0, (rng.random_sample(no_seeds) * no_unheard).astype(np.int64) + 1, 0)
+    draw_rows = np.repeat(np.arange(no_seeds), no_draws)
+    draws = (rng.random_sample(len(draw_rows)) * no_unheard[draw_rows]).astype(np.int64)
+
+    # Remove duplicates by marking the drawn artists
+    recommended = np.zeros(shape=(no_seeds, no_artists), dtype=np.bool_)
+    recommended[draw_rows, unheard[offsets[draw_rows] + draws]] = True
+    return [np.nonzero(row)[0] for row in recommended]
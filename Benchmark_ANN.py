@@ -0,0 +1,59 @@
+# Benchmark of approximate nearest neighbor search (ANN_Index) against exact search:
+# reports recall@K of the approximate neighbors and queries per second
+__author__ = 'mms'
+
+# Load required modules
+import time
+import numpy as np
+import UAM_Storage
+import Neighbor_Index
+import ANN_Index
+
+# Parameters
+UAM_FILE = "UAM.bin"                # user-artist-matrix (UAM)
+
+K = 10                              # number of nearest neighbors
+NO_QUERIES = 200                    # number of (randomly chosen) seed users to query
+SEED = 1                            # seed of the random number generator for choosing the queries
+CONFIGURATIONS = [                  # LSH parameters to benchmark: (no. tables, no. bits, no. probes)
+    (8, 6, 0),
+    (16, 6, 1),
+    (32, 8, 0),
+    (32, 8, 2),
+    (64, 10, 2),
+]
+
+
+# Main program
+if __name__ == '__main__':
+
+    # Load UAM (dense or sparse)
+    UAM = UAM_Storage.load_UAM(UAM_FILE)
+    no_users = UAM.shape[0]
+    queries = np.random.RandomState(SEED).choice(no_users, size=min(NO_QUERIES, no_users), replace=False)
+
+    # Exact neighbors of the queries
+    start = time.time()
+    exact_idx, exact_sim = Neighbor_Index.build_neighbor_index(UAM, K, queries)
+    exact_time = time.time() - start
+    print "Users: %d, Queries: %d, K: %d" % (no_users, len(queries), K)
+    print "exact\t\t\t\t\tQPS: %.1f" % (len(queries) / exact_time)
+
+    # Approximate neighbors for all configurations
+    for n_tables, n_bits, n_probes in CONFIGURATIONS:
+        start = time.time()
+        index = ANN_Index.build_lsh_index(UAM, n_tables, n_bits)
+        build_time = time.time() - start
+
+        start = time.time()
+        results = ANN_Index.query_lsh(index, UAM, UAM[queries, :], K, queries, n_probes)
+        query_time = time.time() - start
+
+        # Recall@K: fraction of exact neighbors found by approximate search
+        found = 0
+        for i in range(len(queries)):
+            found += len(np.intersect1d(results[i][0], exact_idx[i]))
+        recall = float(found) / exact_idx.size
+
+        print "tables: %d, bits: %d, probes: %d\tRecall@%d: %.3f, QPS: %.1f, build: %.2fs" % (
+            n_tables, n_bits, n_probes, K, recall, len(queries) / query_time, build_time)
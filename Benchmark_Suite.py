@@ -0,0 +1,275 @@
+# Benchmark suite: generates synthetic listening events with power-law distributions for several numbers of users
+# and measures run time and peak memory of every stage (conversion, UAM load, similarities, recommenders, evaluation).
+# Results are written as JSON and can be compared with the results of a previous run to detect regressions
+__author__ = 'mms'
+
+# Load required modules
+import os
+import sys
+import imp
+import json
+import time
+import Queue
+import platform
+import resource
+import subprocess
+import multiprocessing
+import numpy as np
+import UAM_Storage
+import Neighbor_Index
+import Evaluate_Recommender
+
+# Converter is loaded from its file, as its name is no valid module name
+Converter = imp.load_source("Converter_LE_UAM", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              "Converter_LE-UAM.py"))
+
+# Parameters
+SIZES = [1000, 10000, 100000, 1000000]  # numbers of users to benchmark
+ARTISTS_PER_USER = 1.0                  # number of artists in the synthetic data per user
+MIN_EVENTS = 10                         # minimum number of listening events (and distinct artists) per user
+MAX_EVENTS = 5000                       # maximum number of listening events per user
+USER_ALPHA = 1.5                        # shape of the Pareto distribution of the number of events per user
+ARTIST_EXPONENT = 1.0                   # exponent of the Zipf distribution of artist popularity
+SEED = 1                                # seed of the random number generator
+
+DATA_DIR = "benchmark_data"             # directory for the synthetic listening events and UAMs
+RESULTS_FILE = "benchmark.json"         # results of this run
+BASELINE_FILE = None                    # results of a previous run to compare with (None: no comparison)
+TOLERANCE = 0.2                         # relative increase of time or memory over the baseline flagged as regression
+MIN_SECONDS = 0.01                      # times below are not compared (timer noise)
+
+NO_QUERIES = 1000                       # number of seed users for the similarity stage
+NO_CALLS = 20                           # number of calls of a recommender to average its time over
+MAX_DENSE_BYTES = 2 * 1024 ** 3         # stages working on the dense UAM are skipped for larger UAMs
+EVALUATE_MAX_USERS = 1000               # the full evaluation is run for at most this number of users
+POLL_SECONDS = 1.0                      # interval of checking whether the process of a stage is still alive
+
+
+# Function to generate synthetic listening events for no_users users and write them to le_file.
+# The number of events per user follows a Pareto distribution (at least MIN_EVENTS), the artists of the events
+# a Zipf distribution; the first MIN_EVENTS events of every user are distinct artists
+def generate_LE(le_file, no_users, no_artists, seed=SEED):
+    rng = np.random.RandomState(seed)
+    popularity = 1.0 / np.arange(1, no_artists + 1) ** ARTIST_EXPONENT
+    cum_popularity = np.cumsum(popularity) / np.sum(popularity)
+
+    with open(le_file, 'w') as outfile:
+        outfile.write('user\tartist\ttrack\ttime\n')
+        block = 10000
+        for start in range(0, no_users, block):
+            users = np.arange(start, min(start + block, no_users))
+            no_events = np.minimum((rng.pareto(USER_ALPHA, len(users)) + 1) * MIN_EVENTS, MAX_EVENTS).astype(np.int64)
+            uidx = np.repeat(users, no_events)
+            aidx = np.searchsorted(cum_popularity, rng.random_sample(len(uidx)))
+            aidx = np.minimum(aidx, no_artists - 1)
+
+            # First MIN_EVENTS events of every user: consecutive (distinct) artists from a random start
+            first = np.append(0, np.cumsum(no_events)[:-1])
+            distinct = first[:, np.newaxis] + np.arange(MIN_EVENTS)
+            aidx[distinct] = (rng.randint(0, no_artists, len(users))[:, np.newaxis] + np.arange(MIN_EVENTS)) % no_artists
+
+            times = 1300000000 + np.arange(len(uidx))
+            outfile.write("".join(["user%d\tartist%d\ttrack%d\t%d\n" % (u, a, a, t)
+                                   for u, a, t in zip(uidx, aidx, times)]))
+
+
+# Function to get the configuration of the generated listening events for no_users users
+def generator_config(no_users):
+    return {"users": no_users, "artists_per_user": ARTISTS_PER_USER, "min_events": MIN_EVENTS,
+            "max_events": MAX_EVENTS, "user_alpha": USER_ALPHA, "artist_exponent": ARTIST_EXPONENT, "seed": SEED}
+
+
+# Function to get the peak memory (resident set size) in MB of this process, or of its finished child processes
+def peak_memory(children=False):
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is given in KB on Linux and in bytes on Mac OS
+    return usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+# Function to load the UAM of the benchmark data as dense matrix, or None if it is too large
+def load_dense_UAM(uam_file):
+    shape = UAM_Storage.read_header(uam_file)[0]["shape"]
+    if shape[0] * shape[1] * 4 > MAX_DENSE_BYTES:
+        return None
+    return UAM_Storage.load_UAM(uam_file).toarray()
+
+
+# Stages of the benchmark, each taking the directory of the benchmark data and returning the measured time
+# in seconds (None if the stage is skipped). The time of loading input data is not included
+
+# Stage: convert listening events to the normalized sparse UAM and save it
+def stage_convert(data_dir):
+    start = time.time()
+    UAM, user_names, artist_names = Converter.build_sparse_UAM(os.path.join(data_dir, "LE.txt"))
+    UAM_Storage.save_UAM(os.path.join(data_dir, "UAM.bin"), UAM, user_names, artist_names)
+    return time.time() - start
+
+
+# Stage: load the UAM from its binary file (completely read into memory)
+def stage_load(data_dir):
+    start = time.time()
+    UAM_Storage.load_UAM(os.path.join(data_dir, "UAM.bin"), mmap=False)
+    return time.time() - start
+
+
+# Stage: similarities of NO_QUERIES users to all users and selection of their nearest neighbors
+def stage_similarity(data_dir):
+    UAM = UAM_Storage.load_UAM(os.path.join(data_dir, "UAM.bin"))
+    queries = np.random.RandomState(SEED).choice(UAM.shape[0], size=min(NO_QUERIES, UAM.shape[0]), replace=False)
+    start = time.time()
+    Neighbor_Index.build_neighbor_index(UAM, Evaluate_Recommender.K, queries)
+    return time.time() - start
+
+
+# Function to time a recommender function, called for NO_CALLS random seed users. It returns the time per call
+def time_recommender(recommend, UAM):
+    rng = np.random.RandomState(SEED)
+    seeds = rng.randint(0, UAM.shape[0], NO_CALLS)
+    seed_aidx = [np.nonzero(UAM[u, :])[0] for u in seeds]
+    start = time.time()
+    for u, aidx in zip(seeds, seed_aidx):
+        recommend(UAM, u, aidx[:max(1, len(aidx) * 4 // 5)])
+    return (time.time() - start) / NO_CALLS
+
+
+# Stage: single call of the user-based CF recommender
+def stage_recommend_CF(data_dir):
+    UAM = load_dense_UAM(os.path.join(data_dir, "UAM.bin"))
+    if UAM is None:
+        return None
+    return time_recommender(lambda UAM, u, aidx: Evaluate_Recommender.recommend_CF(UAM, u, aidx,
+                                                                                   Evaluate_Recommender.K), UAM)
+
+
+# Stage: single call of the baseline recommender
+def stage_recommend_baseline(data_dir):
+    UAM = load_dense_UAM(os.path.join(data_dir, "UAM.bin"))
+    if UAM is None:
+        return None
+    return time_recommender(Evaluate_Recommender.recommend_baseline, UAM)
+
+
+# Stage: full run of Evaluate_Recommender on the benchmark data (as separate process, output discarded)
+def stage_evaluate(data_dir):
+    shape = UAM_Storage.read_header(os.path.join(data_dir, "UAM.bin"))[0]["shape"]
+    if shape[0] > EVALUATE_MAX_USERS or shape[0] * shape[1] * 4 > MAX_DENSE_BYTES:
+        return None
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, os.path.abspath(Evaluate_Recommender.__file__.replace(".pyc", ".py"))],
+                              cwd=data_dir, stdout=devnull, stderr=devnull)
+    return time.time() - start
+
+
+STAGES = [("convert", stage_convert), ("load", stage_load), ("similarity", stage_similarity),
+          ("recommend_CF", stage_recommend_CF), ("recommend_baseline", stage_recommend_baseline),
+          ("evaluate", stage_evaluate)]
+
+
+# Function to run a stage in the current (child) process and put its time and peak memory into the queue
+def run_stage(queue, stage, data_dir):
+    try:
+        seconds = stage(data_dir)
+        queue.put((seconds, max(peak_memory(), peak_memory(children=True))))
+    except Exception as e:
+        queue.put(("error", str(e)))
+
+
+# Function to wait for the result of a stage process. A process that exits without result (e.g. killed by the
+# OOM killer or a signal) is reported as error. It returns the result put into the queue by run_stage
+def wait_for_stage(queue, process):
+    while True:
+        try:
+            return queue.get(timeout=POLL_SECONDS)
+        except Queue.Empty:
+            if not process.is_alive():
+                try:
+                    return queue.get(timeout=POLL_SECONDS)     # result put right before the process exited
+                except Queue.Empty:
+                    return "error", "process exited with code " + str(process.exitcode)
+
+
+# Function to run every stage in a new process, so that its peak memory is measured separately.
+# It returns a dictionary with time (s) and peak memory (MB) of every stage; skipped and failed stages are None
+def benchmark(data_dir):
+    results = {}
+    for name, stage in STAGES:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_stage, args=(queue, stage, data_dir))
+        process.start()
+        seconds, peak_mb = wait_for_stage(queue, process)
+        process.join()
+        if seconds == "error":
+            print "  " + name + ": failed (" + peak_mb + ")"
+            results[name] = None
+        elif seconds is None:
+            print "  " + name + ": skipped"
+            results[name] = None
+        else:
+            print "  " + name + ": %.4fs, %.1f MB" % (seconds, peak_mb)
+            results[name] = {"time": seconds, "peak_mb": peak_mb}
+    return results
+
+
+# Function to compare results with baseline results. A stage is flagged as regression if its time or peak memory
+# exceeds the baseline by more than the tolerance (times below MIN_SECONDS are ignored). It returns a list of (size, stage, measure, baseline, current)
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for size in sorted(results["results"].keys(), key=int):
+        for name, measures in sorted(results["results"][size].items()):
+            base = baseline["results"].get(size, {}).get(name)
+            if measures is None or base is None:
+                continue
+            for measure in ["time", "peak_mb"]:
+                if measure == "time" and measures[measure] < MIN_SECONDS:
+                    continue
+                if measures[measure] > base[measure] * (1.0 + tolerance):
+                    regressions.append((size, name, measure, base[measure], measures[measure]))
+    return regressions
+
+
+# Main program
+if __name__ == '__main__':
+
+    results = {"machine": {"platform": platform.platform(), "python": platform.python_version(),
+                           "numpy": np.__version__, "cpus": multiprocessing.cpu_count()},
+               "config": {"artists_per_user": ARTISTS_PER_USER, "min_events": MIN_EVENTS, "max_events": MAX_EVENTS,
+                          "user_alpha": USER_ALPHA, "artist_exponent": ARTIST_EXPONENT, "seed": SEED},
+               "results": {}}
+
+    for size in SIZES:
+        # Generate synthetic listening events (once per size and configuration; the configuration of the
+        # listening events is stored beside them)
+        data_dir = os.path.join(DATA_DIR, str(size))
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        le_file = os.path.join(data_dir, "LE.txt")
+        config_file = os.path.join(data_dir, "LE_config.json")
+        config = None
+        if os.path.exists(le_file) and os.path.exists(config_file):
+            with open(config_file, 'r') as f:
+                config = json.load(f)
+        if config != generator_config(size):
+            print "Generating listening events of " + str(size) + " users ..."
+            generate_LE(le_file, size, max(MIN_EVENTS, int(size * ARTISTS_PER_USER)))
+            with open(config_file, 'w') as outfile:
+                json.dump(generator_config(size), outfile)
+
+        print "Users: " + str(size)
+        results["results"][str(size)] = benchmark(data_dir)
+
+    with open(RESULTS_FILE, 'w') as outfile:
+        json.dump(results, outfile, indent=2, sort_keys=True)
+    print "Results written to " + RESULTS_FILE
+
+    # Compare with results of a previous run
+    if BASELINE_FILE is not None:
+        with open(BASELINE_FILE, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        for size, name, measure, base, current in regressions:
+            print "REGRESSION: users: %s, stage: %s, %s: %.4f -> %.4f (+%.0f%%)" % (
+                size, name, measure, base, current, 100.0 * (current - base) / base)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print "No regressions against " + BASELINE_FILE
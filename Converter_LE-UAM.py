@@ -2,109 +2,533 @@
 __author__ = 'mms'
 
 # Load required modules
+import os
 import csv
+import zlib
+import time
+import array
+import shutil
+import tempfile
 import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+import Neighbor_Index
+import LE_Store
+import UAM_Blocks
 
 # Parameters
 LE_FILE = "mrs_le.txt"                      # aggregated listening events, to read from
-UAM_FILE = "UAM.txt"                    # user-artist-matrix (UAM)
+CANONICAL_LE_FILE = "mrs_le_canonical.txt"  # listening events with canonical artist names (see Artist_Canonicalizer)
+UAM_FILE = "UAM.bin"                    # user-artist-matrix (UAM), binary format (see UAM_Storage)
 ARTISTS_FILE = "UAM_artists.txt"        # artist names for UAM
 USERS_FILE = "UAM_users.txt"            # user names for UAM
+COUNTS_FILE = "UAM_counts.bin"          # raw playcounts and append-only user and artist IDs, for merging new events
+MERGED_FILE = "UAM_merged.bin"          # identities of the listening events merged so far, for merging new events
+NEIGHBOR_INDEX_FILE = "UAM_neighbors.bin"   # top-K neighbor index, updated after merging (see Neighbor_Index)
+LE_STORE_FILE = "LE.bin"                # columnar listening event store written by the fetcher (see LE_Store)
 
+SPARSE_UAM = False                      # set to True to build the UAM as sparse CSR matrix in a single pass
+USE_CANONICAL = False                   # set to True to read CANONICAL_LE_FILE instead of LE_FILE (not the store)
+MERGE_LE = False                        # set to True to merge the listening events of LE_FILE into the existing UAM
+OUT_OF_CORE = False                     # set to True to build the sparse UAM from LE files larger than the memory
+USE_LE_STORE = False                    # set to True to build the UAM from LE_STORE_FILE instead of the text file LE_FILE
+                                        # (MERGE_LE and OUT_OF_CORE read LE_FILE and take precedence)
+TIME_RANGE = None                       # (start, end) Unix time stamps of the listening events counted from the store
+MEMORY_CAP = 512 * 1024 * 1024          # approximate number of bytes used for aggregating listening events out of core
+USERS_PER_PARTITION = 4096              # number of users per partition (spill file) of out-of-core aggregation
+
+# Record of a spill file of out-of-core aggregation: (user, artist) pair as int64 key and its count
+PAIR_DTYPE = np.dtype([('key', np.int64), ('count', np.float32)])
 
-# Main program
-if __name__ == '__main__':
 
-    artists = {}            # dictionary used as ordered list of artists without duplicates
-    users = {}              # dictionary used as ordered list of users without duplicates
-    listening_events = {}   # dictionary to store assignments between users and artists, i.e. (user, artist) tuples
+# Function to count the listening events per (user, artist) in a single streaming pass over the listening events.
+# user_names and artist_names are the names of known users and artists (ordered by their index); new users and
+# artists are appended in order of their first occurrence, so the index of a known user or artist never changes.
+# If merged (the identities of the listening events counted before, see event_keys) is given, events already in it
+# are skipped, whatever the order in which the pages of listening events were fetched; the identities of the events
+# counted are added to it.
+# It returns the playcounts as sparse CSR matrix of size |users| * |artists| and the extended lists of names
+def count_listening_events(le_file, user_names=None, artist_names=None, merged=None):
+    user_names = list(user_names) if user_names is not None else []
+    artist_names = list(artist_names) if artist_names is not None else []
+    users = dict((user, idx) for idx, user in enumerate(user_names))            # user name -> user index
+    artists = dict((artist, idx) for idx, artist in enumerate(artist_names))    # artist name -> artist index
+    uidx = array.array('i')     # user index of every listening event
+    aidx = array.array('i')     # artist index of every listening event
+    times = array.array('I')    # time stamp of every listening event (if merged is given)
+    tracks = array.array('I')   # hash of the track name of every listening event (if merged is given)
 
-    # Read listening events from provided file and initialize data structures
-    with open(LE_FILE, 'r') as f:
+    with open(le_file, 'r') as f:
         reader = csv.reader(f, delimiter='\t')      # create reader
         headers = reader.next()                     # skip header
         for row in reader:
-            user = row[0]
-            artist = row[1]
-            # track = row[2]
-            time = row[2]
+            # Assign next free index to users and artists seen for the first time
+            if row[0] not in users:
+                users[row[0]] = len(user_names)
+                user_names.append(row[0])
+            if row[1] not in artists:
+                artists[row[1]] = len(artist_names)
+                artist_names.append(row[1])
+            uidx.append(users[row[0]])
+            aidx.append(artists[row[1]])
+            if merged is not None:
+                times.append(int(row[3]))
+                tracks.append(zlib.crc32(row[2]) & 0xffffffff)
+
+    uidx = np.frombuffer(uidx, dtype=np.int32)
+    aidx = np.frombuffer(aidx, dtype=np.int32)
+    if merged is not None:
+        # Skip the events merged before (users and artists of such events are known already, so no names were added)
+        keys = event_keys(uidx, aidx, np.frombuffer(times, dtype=np.uint32), np.frombuffer(tracks, dtype=np.uint32))
+        new = ~contains_keys(merged["keys"], keys)
+        uidx, aidx = uidx[new], aidx[new]
+        merged["keys"] = sort_keys(np.concatenate([merged["keys"], keys[new]]))
+
+    # Duplicate (user, artist) entries are summed up when converting to CSR, which gives the playcounts
+    counts = np.ones(len(uidx), dtype=np.float32)
+    counts = sp.coo_matrix((counts, (uidx, aidx)),
+                           shape=(len(user_names), len(artist_names)), dtype=np.float32).tocsr()
+    counts.sort_indices()
+
+    return counts, user_names, artist_names
+
+
+# Function to get the identities of listening events, given their user and artist indices, time stamps and hashes
+# of the track names. It returns an array of size |events| * 2 of int64 keys (user and time, artist and track)
+def event_keys(uidx, aidx, times, tracks):
+    keys = np.empty((len(uidx), 2), dtype=np.int64)
+    keys[:, 0] = (uidx.astype(np.int64) << 32) | times.astype(np.int64)
+    keys[:, 1] = (aidx.astype(np.int64) << 32) | tracks.astype(np.int64)
+    return keys
+
+
+# Function to view the rows of an array of event keys as single (16 byte) values, which can be sorted and searched
+def key_rows(keys):
+    return np.ascontiguousarray(keys).view(np.dtype((np.void, keys.dtype.itemsize * 2))).ravel()
 
-            # Create ordered set (list) of unique elements (for artists / tracks)
-            artists[artist] = None
-            users[user] = None
 
-            # Initialize listening event counter, access by tuple (user, artist) in dictionary
-            listening_events[(user, artist)] = 0
+# Function to sort an array of event keys by rows
+def sort_keys(keys):
+    return np.sort(key_rows(keys)).view(np.int64).reshape(-1, 2)
 
-    # Read listening events from provided file and fill user-artist matrix
-    with open(LE_FILE, 'r') as f:
+
+# Function to check which event keys are contained in an array of event keys sorted by rows.
+# It returns a boolean array over the keys
+def contains_keys(sorted_keys, keys):
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    sorted_rows, rows = key_rows(sorted_keys), key_rows(keys)
+    pos = np.minimum(np.searchsorted(sorted_rows, rows), len(sorted_rows) - 1)
+    return sorted_rows[pos] == rows
+
+
+# Function to perform sum-to-1 normalization of each row of a sparse CSR matrix of playcounts
+# (same float32 division as for the dense UAM). It returns the normalized matrix as new CSR matrix
+def normalize_rows(counts):
+    UAM = counts.astype(np.float32)
+    sum_pc_user = np.asarray(UAM.sum(axis=1), dtype=np.float32).ravel()
+    UAM.data /= np.repeat(sum_pc_user, np.diff(UAM.indptr))
+    return UAM
+
+
+# Function to build the normalized UAM as sparse CSR matrix in a single streaming pass over the listening events.
+# Users and artists are integer-coded in order of their first occurrence.
+# It returns the UAM and the lists of user and artist names (ordered by their index)
+def build_sparse_UAM(le_file):
+    counts, user_names, artist_names = count_listening_events(le_file)
+    return normalize_rows(counts), user_names, artist_names
+
+
+# Function to read the listening events of a file in blocks of about block_bytes bytes (header skipped). One csv
+# reader parses the whole file, so rows are parsed as by count_listening_events (also quoted fields with newlines).
+# It yields the rows (user, artist, track, time) of every block as iterator, to be consumed before the next block
+def read_LE_blocks(le_file, block_bytes):
+    with open(le_file, 'r') as f:
         reader = csv.reader(f, delimiter='\t')      # create reader
         headers = reader.next()                     # skip header
-        for row in reader:
-            user = row[0]
-            artist = row[1]
-            #  = row[2]
-            time = row[2]
-            # Increase listening counter for (user, artist) pair/tuple
-            listening_events[(user, artist)] += 1
-
-
-    # Assign a unique index to all artists and users in dictionary (we need these to create the UAM)
-    # Artists
-    counter = 0
-    for artist in artists.keys():
-        artists[artist] = counter
-        counter += 1
-    # Users
-    counter = 0
-    for user in users.keys():
-        users[user] = counter
-        counter += 1
-
-    # Now we use numpy to create the UAM
-    UAM = np.zeros(shape=(len(users.keys()), len(artists.keys())), dtype=np.float32)    # create an empty matrix of size |users| * |artists|
-    # Iterate through all (user, artist) tuples in listening events
-    for u in users.keys():
-        for a in artists.keys():
-            try:
-                # Get correct index for user u and artist a
-                idx_u = users[u]
-                idx_a = artists[a]
-
-                # Insert number of listening events of user u to artist a in UAM
-                UAM[idx_u, idx_a] = listening_events[(u,a)]
-                print "Inserted into UAM the triple (", u, ", ", a, ", ", listening_events[(u,a)], ")"
-
-            except KeyError:        # if user u did not listen to artist a, we continue
+        more = [True]                               # rows left after the current block
+
+        def block():
+            size = 0
+            for row in reader:
+                yield row
+                size += sum([len(field) + 1 for field in row])
+                if size >= block_bytes:
+                    return
+            more[0] = False
+
+        while more[0]:
+            yield block()
+
+
+# Function to aggregate the playcounts of (user, artist) pairs given as int64 keys (user index << 32 | artist index),
+# each with a count. It returns the unique keys in ascending order and their summed counts
+def aggregate_pairs(keys, counts):
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts).astype(np.float32)
+
+
+# Function to append (key, count) pairs to a spill file. The file is opened for every call only, so that the number
+# of open files does not grow with the number of partitions
+def spill_pairs(filename, pairs):
+    with open(filename, 'ab') as f:
+        pairs.tofile(f)
+
+
+# Function to split a spill file of pairs of the users first_user to first_user + no_users - 1 into ranges of users
+# that can each be aggregated within memory_cap bytes (a single user is never split). The file is read twice in
+# chunks: once to count the pairs per user, once to spill the pairs of every range to its own file; then it is removed.
+# It returns the files of the ranges, in order of users
+def split_partition(filename, first_user, no_users, memory_cap):
+    pairs = np.memmap(filename, dtype=PAIR_DTYPE, mode='r')
+    chunk = max(1, int(memory_cap // (4 * PAIR_DTYPE.itemsize)))    # pairs per chunk read
+
+    # Number of pairs per user of the partition
+    no_pairs = np.zeros(no_users, dtype=np.int64)
+    for start in range(0, len(pairs), chunk):
+        no_pairs += np.bincount((pairs['key'][start:start+chunk] >> 32) - first_user, minlength=no_users)
+
+    # Assign consecutive users to ranges of at most memory_cap / 4 bytes of pairs, then spill every chunk by range
+    user_range = (np.cumsum(no_pairs) - no_pairs) * 4 * PAIR_DTYPE.itemsize // int(memory_cap)
+    range_files = {}
+    for start in range(0, len(pairs), chunk):
+        block = np.array(pairs[start:start+chunk])
+        ranges = user_range[(block['key'] >> 32) - first_user]
+        order = np.argsort(ranges, kind='mergesort')
+        block, ranges = block[order], ranges[order]
+        bounds = np.searchsorted(ranges, np.arange(ranges[0], ranges[-1] + 2))
+        for i in range(0, len(bounds) - 1):
+            if bounds[i] < bounds[i+1]:
+                r = int(ranges[bounds[i]])
+                range_files[r] = filename + "." + str(r)
+                spill_pairs(range_files[r], block[bounds[i]:bounds[i+1]])
+    del pairs
+    os.remove(filename)
+    return [range_files[r] for r in sorted(range_files.keys())]
+
+
+# Function to build the normalized UAM as sparse CSR matrix from a listening event file of any size, using about
+# memory_cap bytes (apart from the user and artist names). The file is read once in blocks; user and artist names
+# are interned to integers (in order of their first occurrence, as in build_sparse_UAM) and the playcounts of every
+# block are spilled to one file per partition of users_per_partition users. The partitions are then aggregated and
+# normalized one after another (a partition holds complete rows; partitions too large for memory_cap are split into
+# ranges of users first, see split_partition) and appended to the CSR arrays on disk.
+# The returned UAM is memory-mapped from tmp_dir. It returns the UAM and the lists of user and artist names
+def build_UAM_out_of_core(le_file, tmp_dir, memory_cap=MEMORY_CAP, users_per_partition=USERS_PER_PARTITION):
+    users = {}              # user name -> user index
+    artists = {}            # artist name -> artist index
+    partition_files = {}    # partition index -> spill file of (key, count) pairs
+
+    # Read the file in blocks and spill the playcounts of every block, aggregated, to the partitions
+    start = time.time()
+    no_events = 0
+    for rows in read_LE_blocks(le_file, memory_cap // 16):
+        uidx = array.array('i')
+        aidx = array.array('i')
+        for row in rows:
+            uidx.append(users.setdefault(row[0], len(users)))
+            aidx.append(artists.setdefault(row[1], len(artists)))
+        no_events += len(uidx)
+
+        keys = (np.frombuffer(uidx, dtype=np.int32).astype(np.int64) << 32) | np.frombuffer(aidx, dtype=np.int32)
+        keys, counts = aggregate_pairs(keys, np.ones(len(keys), dtype=np.float32))
+        partitions = (keys >> 32) // users_per_partition
+        bounds = np.searchsorted(partitions, np.arange(partitions[0], partitions[-1] + 2)) if len(keys) > 0 else []
+        for i in range(0, len(bounds) - 1):
+            if bounds[i] == bounds[i+1]:
                 continue
+            p = int(partitions[bounds[i]])
+            partition_files[p] = os.path.join(tmp_dir, "partition_" + str(p) + ".bin")
+            pairs = np.empty(bounds[i+1] - bounds[i], dtype=PAIR_DTYPE)
+            pairs['key'] = keys[bounds[i]:bounds[i+1]]
+            pairs['count'] = counts[bounds[i]:bounds[i+1]]
+            spill_pairs(partition_files[p], pairs)
+
+        elapsed = time.time() - start
+        print "Read " + str(no_events) + " listening events (%.0f events/s)" % (no_events / max(elapsed, 1e-9))
+
+    # Aggregate partitions in order of users and append their rows to the CSR arrays
+    no_users = len(users)
+    row_nnz = np.zeros(no_users, dtype=np.int64)      # number of artists per user
+    nnz = 0
+    with open(os.path.join(tmp_dir, "data.bin"), 'wb') as data_file, \
+            open(os.path.join(tmp_dir, "indices.bin"), 'wb') as indices_file:
+        for p in sorted(partition_files.keys()):
+            # Split the partition into ranges of users if it cannot be aggregated within the memory cap
+            if 4 * os.path.getsize(partition_files[p]) > memory_cap:
+                range_files = split_partition(partition_files[p], p * users_per_partition, users_per_partition,
+                                              memory_cap)
+            else:
+                range_files = [partition_files[p]]
+
+            for range_file in range_files:
+                pairs = np.fromfile(range_file, dtype=PAIR_DTYPE)
+                keys, counts = aggregate_pairs(pairs['key'], pairs['count'])
+                del pairs
+                range_users, inverse = np.unique(keys >> 32, return_inverse=True)
+
+                # Perform sum-to-1 normalization of each row (same float32 division as for the dense UAM)
+                sum_pc_user = np.bincount(inverse, weights=counts).astype(np.float32)
+                counts /= sum_pc_user[inverse]
+                counts.tofile(data_file)
+                (keys & 0xFFFFFFFF).astype(np.int32).tofile(indices_file)
+
+                row_nnz[range_users] = np.bincount(inverse)
+                nnz += len(keys)
+                os.remove(range_file)
+    indptr = np.concatenate([[0], np.cumsum(row_nnz)])
+
+    # Map the CSR arrays from disk
+    data = np.memmap(os.path.join(tmp_dir, "data.bin"), dtype=np.float32, mode='r', shape=(nnz,)) if nnz > 0 else \
+        np.zeros(0, dtype=np.float32)
+    indices = np.memmap(os.path.join(tmp_dir, "indices.bin"), dtype=np.int32, mode='r', shape=(nnz,)) if nnz > 0 else \
+        np.zeros(0, dtype=np.int32)
+    UAM = sp.csr_matrix((data, indices, indptr), shape=(no_users, len(artists)), copy=False)
+
+    elapsed = time.time() - start
+    print "Aggregated " + str(no_events) + " listening events into " + str(nnz) + " playcounts in %.1fs (%.0f events/s)" \
+        % (elapsed, no_events / max(elapsed, 1e-9))
 
-    # Get sum of play events per user and per artist
-    sum_pc_artist = np.sum(UAM, axis=0)
-    sum_pc_user = np.sum(UAM, axis=1)
+    # Lists of names ordered by index
+    user_names = [None] * len(users)
+    for user, idx in users.iteritems():
+        user_names[idx] = user
+    artist_names = [None] * len(artists)
+    for artist, idx in artists.iteritems():
+        artist_names[idx] = artist
 
-    # Normalize the UAM (simply by computing the fraction of listening events per artist for each user, i.e. sum-to-1 normalization)
-    no_users = UAM.shape[0]
-    no_artists = UAM.shape[1]
-    # np.tile: take sum_pc_user no_artists times (results in an array of length no_artists*no_users)
-    # np.reshape: reshape the array to a matrix
-    # np.transpose: transpose the reshaped matrix
-    artist_sum_copy = np.tile(sum_pc_user, no_artists).reshape(no_artists, no_users).transpose()
-    # Perform sum-to-1 normalization
-    UAM = UAM / artist_sum_copy
+    return UAM, user_names, artist_names
 
 
-    # Write everything to text file (artist names, user names, UAM)
-    # Write artists to text file
+# Function to enlarge a sparse CSR matrix to the given shape by appending empty rows and columns
+def grow_matrix(M, shape):
+    indptr = np.concatenate([M.indptr, np.repeat(M.indptr[-1], shape[0] - M.shape[0])])
+    return sp.csr_matrix((M.data, M.indices, indptr), shape=shape)
+
+
+# Function to update the normalized UAM (dense or sparse) after the playcounts of the given rows changed.
+# The UAM is enlarged to the size of the playcounts; only the changed rows are normalized again,
+# all other rows are kept. It returns the updated UAM (in the layout of the given one)
+def update_rows(UAM, counts, rows):
+    changed = normalize_rows(counts[rows, :])
+    if not sp.issparse(UAM):
+        UAM_new = np.zeros(shape=counts.shape, dtype=np.float32)
+        UAM_new[:UAM.shape[0], :UAM.shape[1]] = UAM
+        UAM_new[rows, :] = changed.toarray()
+        return UAM_new
+
+    # Keep the unchanged rows of the UAM and add the changed rows: diag(unchanged) * UAM + selection * changed rows
+    keep = np.ones(counts.shape[0], dtype=np.float32)
+    keep[rows] = 0.0
+    select = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, np.arange(len(rows)))),
+                           shape=(counts.shape[0], len(rows)))
+    UAM_new = sp.diags(keep, format='csr') * grow_matrix(UAM.tocsr(), counts.shape) + select * changed
+    UAM_new = UAM_new.tocsr().astype(np.float32)
+    UAM_new.eliminate_zeros()
+    UAM_new.sort_indices()
+    return UAM_new
+
+
+# Function to merge the listening events of le_file into the playcounts and the normalized UAM.
+# New users and artists are appended, events merged before (contained in merged) are skipped
+# (see count_listening_events).
+# It returns the updated playcounts, UAM and lists of user and artist names, and the indices of the changed users
+def merge_listening_events(le_file, counts, UAM, user_names, artist_names, merged=None):
+    delta, user_names, artist_names = count_listening_events(le_file, user_names, artist_names, merged)
+    counts = grow_matrix(counts.tocsr(), delta.shape) + delta
+    counts.sort_indices()
+    changed_users = np.nonzero(np.diff(delta.indptr))[0]
+    return counts, update_rows(UAM, counts, changed_users), user_names, artist_names, changed_users
+
+
+# Function to load the identities of merged listening events (see count_listening_events); none if not stored.
+# It returns them as dictionary
+def load_merged_events(filename):
+    if not os.path.exists(filename):
+        return {"keys": np.zeros((0, 2), dtype=np.int64)}
+    arrays, header = UAM_Storage.read_arrays(filename, mmap=False)
+    return {"keys": arrays["keys"]}
+
+
+# Function to save the identities of merged listening events
+def save_merged_events(filename, merged):
+    UAM_Storage.write_arrays(filename, {"keys": merged["keys"]}, {"kind": "merged_events"})
+
+
+# Function to write the artist and user names to the text files (ordered by their index)
+def write_names(user_names, artist_names):
     with open(ARTISTS_FILE, 'w') as outfile:
         outfile.write('artist\n')
-        for key in artists.keys():          # for all artists listened to by any user
-            outfile.write(key + "\n")
-    outfile.close()
-    # Write users to text file
+        for artist in artist_names:
+            outfile.write(artist + "\n")
     with open(USERS_FILE, 'w') as outfile:
         outfile.write('user\n')
-        for key in users.keys():            # for all users
-            outfile.write(key + "\n")
-    outfile.close()
-    # Write UAM
-    np.savetxt(UAM_FILE, UAM, fmt='%0.6f', delimiter='\t', newline='\n')
+        for user in user_names:
+            outfile.write(user + "\n")
+
+
+# Main program
+if __name__ == '__main__':
+
+    # Read the listening events with artist names canonicalized by Artist_Canonicalizer
+    if USE_CANONICAL:
+        LE_FILE = CANONICAL_LE_FILE
+
+    if MERGE_LE:
+        if os.path.exists(COUNTS_FILE):
+            # Load playcounts with user and artist IDs, and the UAM normalized from them (not memory-mapped,
+            # as the files are overwritten)
+            counts, user_names, artist_names = UAM_Storage.load_data(COUNTS_FILE, USERS_FILE, ARTISTS_FILE,
+                                                                     dense=False, mmap=False)
+            UAM = UAM_Storage.load_UAM(UAM_FILE, mmap=False)
+            uam_hash = UAM_Storage.content_hash(UAM_FILE)
+            merged = load_merged_events(MERGED_FILE)
+        else:
+            # First run: start from empty playcounts
+            counts = sp.csr_matrix((0, 0), dtype=np.float32)
+            UAM = sp.csr_matrix((0, 0), dtype=np.float32) if SPARSE_UAM else np.zeros((0, 0), dtype=np.float32)
+            user_names, artist_names = [], []
+            uam_hash = None
+            merged = {"keys": np.zeros((0, 2), dtype=np.int64)}
+
+        # The fetcher writes all events fetched so far, in any order of their pages (e.g. newest pages first, older
+        # ones after a resume); events merged before are identified by user, time, artist and track and skipped
+        counts, UAM, user_names, artist_names, changed_users = merge_listening_events(LE_FILE, counts, UAM,
+                                                                                      user_names, artist_names,
+                                                                                      merged)
+        print "Merged listening events of " + str(len(changed_users)) + " users, UAM has now " + \
+              str(UAM.shape[0]) + " users and " + str(UAM.shape[1]) + " artists"
+
+        # Write playcounts, artists, users and UAM
+        UAM_Storage.save_UAM(COUNTS_FILE, counts, user_names, artist_names)
+        save_merged_events(MERGED_FILE, merged)
+        write_names(user_names, artist_names)
+        UAM_Storage.save_UAM(UAM_FILE, UAM, user_names, artist_names)
+
+        # Update the neighbor index of the previous UAM for the changed users, instead of rebuilding it
+        if os.path.exists(NEIGHBOR_INDEX_FILE) and uam_hash is not None:
+            nn_idx, nn_sim, index_hash = Neighbor_Index.load_neighbor_index(NEIGHBOR_INDEX_FILE, mmap=False)
+            if index_hash == uam_hash:
+                nn_idx, nn_sim = Neighbor_Index.update_neighbor_index(UAM, nn_idx, nn_sim, changed_users)
+                Neighbor_Index.save_neighbor_index(NEIGHBOR_INDEX_FILE, nn_idx, nn_sim,
+                                                   UAM_Storage.content_hash(UAM_FILE))
+
+    elif OUT_OF_CORE:
+        # Spill files and CSR arrays are kept in a temporary directory until the UAM is written
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(UAM_FILE)))
+        try:
+            UAM, user_names, artist_names = build_UAM_out_of_core(LE_FILE, tmp_dir)
+
+            # Write artists, users and sparse UAM (CSR layout)
+            write_names(user_names, artist_names)
+            UAM_Storage.save_UAM(UAM_FILE, UAM, user_names, artist_names)
+            del UAM
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    elif USE_LE_STORE:
+        # Count the listening events of the time window in one pass over the memory-mapped columns
+        store = LE_Store.load_store(LE_STORE_FILE)
+        start, end = TIME_RANGE if TIME_RANGE is not None else (None, None)
+        counts, user_names, artist_names = LE_Store.drop_empty(LE_Store.count_events(store, start, end),
+                                                               store["users"], store["artists"])
+        del store
+        UAM = normalize_rows(counts)
+        if not SPARSE_UAM:
+            UAM = UAM.toarray()
+
+        # Write artists, users and UAM
+        write_names(user_names, artist_names)
+        UAM_Storage.save_UAM(UAM_FILE, UAM, user_names, artist_names)
+
+    elif SPARSE_UAM:
+        UAM, user_names, artist_names = build_sparse_UAM(LE_FILE)
+
+        # Write artists, users and sparse UAM (CSR layout)
+        write_names(user_names, artist_names)
+        UAM_Storage.save_UAM(UAM_FILE, UAM, user_names, artist_names)
+
+    else:
+        artists = {}            # dictionary used as ordered list of artists without duplicates
+        users = {}              # dictionary used as ordered list of users without duplicates
+        listening_events = {}   # dictionary to store assignments between users and artists, i.e. (user, artist) tuples
+
+        # Read listening events from provided file and initialize data structures
+        with open(LE_FILE, 'r') as f:
+            reader = csv.reader(f, delimiter='\t')      # create reader
+            headers = reader.next()                     # skip header
+            for row in reader:
+                user = row[0]
+                artist = row[1]
+                # track = row[2]
+                time = row[2]
+
+                # Create ordered set (list) of unique elements (for artists / tracks)
+                artists[artist] = None
+                users[user] = None
+
+                # Initialize listening event counter, access by tuple (user, artist) in dictionary
+                listening_events[(user, artist)] = 0
+
+        # Read listening events from provided file and fill user-artist matrix
+        with open(LE_FILE, 'r') as f:
+            reader = csv.reader(f, delimiter='\t')      # create reader
+            headers = reader.next()                     # skip header
+            for row in reader:
+                user = row[0]
+                artist = row[1]
+                #  = row[2]
+                time = row[2]
+                # Increase listening counter for (user, artist) pair/tuple
+                listening_events[(user, artist)] += 1
+
+
+        # Assign a unique index to all artists and users in dictionary (we need these to create the UAM)
+        # Artists
+        counter = 0
+        for artist in artists.keys():
+            artists[artist] = counter
+            counter += 1
+        # Users
+        counter = 0
+        for user in users.keys():
+            users[user] = counter
+            counter += 1
+
+        # Now we use numpy to create the UAM
+        UAM = np.zeros(shape=(len(users.keys()), len(artists.keys())), dtype=np.float32)    # create an empty matrix of size |users| * |artists|
+        # Iterate through all (user, artist) tuples in listening events
+        for u in users.keys():
+            for a in artists.keys():
+                try:
+                    # Get correct index for user u and artist a
+                    idx_u = users[u]
+                    idx_a = artists[a]
+
+                    # Insert number of listening events of user u to artist a in UAM
+                    UAM[idx_u, idx_a] = listening_events[(u,a)]
+                    print "Inserted into UAM the triple (", u, ", ", a, ", ", listening_events[(u,a)], ")"
+
+                except KeyError:        # if user u did not listen to artist a, we continue
+                    continue
+
+        # Normalize the UAM (simply by computing the fraction of listening events per artist for each user, i.e. sum-to-1 normalization)
+        # in place, block by block, instead of dividing by a second matrix of size |users| * |artists| holding the sums
+        UAM_Blocks.normalize_rows(UAM, UAM)
+
+
+        # Write everything to file (artist names, user names as text, UAM in binary format)
+        # Write artists to text file
+        with open(ARTISTS_FILE, 'w') as outfile:
+            outfile.write('artist\n')
+            for key in artists.keys():          # for all artists listened to by any user
+                outfile.write(key + "\n")
+        outfile.close()
+        # Write users to text file
+        with open(USERS_FILE, 'w') as outfile:
+            outfile.write('user\n')
+            for key in users.keys():            # for all users
+                outfile.write(key + "\n")
+        outfile.close()
+        # Write UAM (dense layout)
+        UAM_Storage.save_UAM(UAM_FILE, UAM, users.keys(), artists.keys())
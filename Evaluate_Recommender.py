@@ -3,93 +3,211 @@ __author__ = 'mms'
 
 
 # Load required modules
-import csv
+import os
+import tempfile
+import multiprocessing
 import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+import Neighbor_Index
+import ANN_Index
+import Item_Similarity
+import Similarity
+import Matrix_Factorization
+import Baselines
+import Instrumentation
 from sklearn import cross_validation  # machine learning & evaluation module
-from random import randint
 
 # Parameters
-UAM_FILE = "UAM.txt"                # user-artist-matrix (UAM)
+UAM_FILE = "UAM.bin"                # user-artist-matrix (UAM)
 ARTISTS_FILE = "UAM_artists.txt"    # artist names for UAM
 USERS_FILE = "UAM_users.txt"        # user names for UAM
+LSH_INDEX_FILE = "UAM_lsh.bin"      # LSH index for approximate neighbor search (see ANN_Index)
+ITEM_SIM_FILE = "UAM_item_sim.bin"  # artist-artist similarity matrix for item-based CF (see Item_Similarity)
+POPULARITY_FILE = "UAM_popularity.bin"  # artist popularity of every fold for the popularity baseline (see Baselines)
+SIM_MODEL_FILE = "UAM_sim_model.bin"    # row statistics of the UAM for the similarity measure (see Similarity)
+FACTORS_FILE = "UAM_als.bin"        # user and artist factors for matrix factorization, one file per fold (see fold_factors_file)
 
 NF = 5              # number of folds to perform in cross-validation
 K = 2               # parameter for k nearest function
+K_SWEEP = None      # numbers of neighbors to evaluate in one pass instead of K, e.g. range(1, 51) (exact search only)
+N_CF = None         # number of top scored artists recommended by user-based CF (None: all artists of the neighbors)
+N_IB = 50           # number of artists recommended by the item-based recommender
+N_MF = 50           # number of artists recommended by the matrix factorization recommender
+N_POPULAR = 50      # number of artists recommended by the popularity baseline
+BASELINE_SEED = 1   # seed of the random baseline
 
-# Function to read metadata (users or artists)
-def read_from_file(filename):
-    data = []
-    with open(filename, 'r') as f:  # open file for reading
-        reader = csv.reader(f, delimiter='\t')  # create reader
-        headers = reader.next()  # skip header
-        for row in reader:
-            item = row[0]
-            data.append(item)
-    f.close()
-    return data
+RECOMMENDER = "CF"  # recommender to evaluate: "CF" (user-based), "IB" (item-based), "MF" (matrix factorization),
+                    # "baseline" (random artists) or "popular" (most popular artists not listened to, see Baselines)
 
+N_JOBS = 1          # number of worker processes for evaluation (1 evaluates serially in this process)
+SHARD_SIZE = 16     # number of users per shard processed by a worker
+USE_BATCH = False   # set to True to compute recommendations for all folds of a shard of users at once
+NEIGHBOR_SEARCH = "exact"   # "exact" (similarities to all users) or "lsh" (approximate, see ANN_Index)
+SIMILARITY = "inner"        # similarity of users for exact search: "inner", "cosine", "pearson" or "jaccard" (see Similarity)
 
-# Function that implements a CF recommender. It takes as input the UAM, metadata (artists and users),
-# the index of the seed user (to make predictions for) and the indices of the seed user's training artists.
-# It returns a list of recommended artist indices
-def recommend_CF(UAM, seed_uidx, seed_aidx_train, K = 1):
+QUIET = False       # set to True to switch off the output of items, precision and recall per user and fold
+REPORT = True       # print the time spent per stage and the counters recorded during evaluation (see Instrumentation)
+TRACE_FILE = None   # file to write the JSON trace of all timed stages to (None: no trace)
 
-    # UAM               user-artist-matrix
-    # seed_uidx         user index of seed user
-    # seed_aidx_train   indices of training artists for seed user
 
-    # Get playcount vector for seed user
-    pc_vec = UAM[seed_uidx, :]
+# Function to remove the test artists from the seed user's playcount vector and to normalize it again.
+# It returns the masked and normalized playcount vector as a new array, the UAM is not modified
+def mask_seed_vector(UAM, seed_uidx, seed_aidx_train):
+
+    # Get (copy of) playcount vector for seed user
+    pc_vec = np.array(UAM[seed_uidx, :])
 
     # Remove information on test artists from seed's listening vector
     aidx_nz = np.nonzero(pc_vec)[0]                            # artists with non-zero listening events
     aidx_test = np.setdiff1d(aidx_nz, seed_aidx_train)         # compute set difference between all artist indices of user and train indices gives test artist indices
-#    print aidx_test
-
-    # Set to 0 the listening events of seed user for testing (in UAM; pc_vec just points to UAM, is thus automatically updated)
-    UAM[seed_uidx, aidx_test] = 0.0
+    pc_vec[aidx_test] = 0.0
 
     # Seed user needs to be normalized again
     # Perform sum-to-1 normalization
-    UAM[seed_uidx, :] = UAM[seed_uidx, :] / np.sum(UAM[seed_uidx, :])
+    return pc_vec / np.sum(pc_vec)
 
-    # Compute similarities as inner product between pc_vec of user and all users via UAM (assuming that UAM is normalized)
-    sim_users = np.inner(pc_vec, UAM)  # similarities between u and other users
 
-    # Alternatively, compute cosine similarities as inverse cosine distance between pc_vec of user and all users via UAM (assuming that UAM is normalized)
-#    sim_users = np.zeros(shape=(UAM.shape[0]), dtype=np.float32)
-#    for u in range(0, UAM.shape[0]):
-#        sim_users[u] = 1.0 - scidist.cosine(pc_vec, UAM[u,:])
+# Function to rank all users by their similarities to the seed user.
+# pc_vec is the masked and normalized playcount vector of the seed user (see mask_seed_vector).
+# If a similarity model is given (see Similarity), its measure is used instead of the inner product.
+# It returns the user indices sorted by ascending similarity
+def rank_users(UAM, seed_uidx, pc_vec, sim_model = None):
+
+    with Instrumentation.timer("similarity"):
+        if sim_model is None or sim_model["measure"] == "inner":
+            # Compute similarities as inner product between pc_vec of user and all users via UAM (assuming that UAM is normalized)
+            sim_users = np.inner(pc_vec, UAM)  # similarities between u and other users
+            # The seed user's row in the UAM still contains the test artists, so use the masked vector for her own similarity
+            sim_users[seed_uidx] = np.inner(pc_vec, pc_vec)
+        else:
+            # Cosine, Pearson or Jaccard similarities between pc_vec of user and all users, computed vectorized
+            sim_users = Similarity.similarities(sim_model, UAM, pc_vec)[0]
+            sim_users[seed_uidx] = Similarity.self_similarity(sim_model, pc_vec)[0]
 
     # Sort similarities to all others
-    sort_idx = np.argsort(sim_users)  # sort in ascending order
+    with Instrumentation.timer("neighbor selection"):
+        return np.argsort(sim_users)  # sort in ascending order
 
-    # Get all artist indices the seed user and her closest neighbor listened to, i.e., element with non-zero entries in UAM
-    artist_idx_u = seed_aidx_train                      # indices of artists in training set user
+
+# Function to select the K nearest neighbors of the seed user by computing the similarities to all users
+# (see rank_users). The precomputed neighbor index (see Neighbor_Index) must not be used here: it is built from the
+# unmasked rows and would leak the seed's test artists
+def exact_neighbors(UAM, seed_uidx, pc_vec, K, sim_model = None):
+    sort_idx = rank_users(UAM, seed_uidx, pc_vec, sim_model)
 
     # Select the k closest neighbor to seed user (which is the last but one; last one is user u herself!)
-    kneighbor_idx = sort_idx[-(1+K):-1]
+    return sort_idx[-(1+K):-1]
+
+
+# Function to select the N highest scores (only scores > 0) by argpartition, without sorting all scores.
+# It returns the indices and the scores, both sorted by decreasing score
+def top_n_artists(scores, N):
+    cand_aidx = np.nonzero(scores > 0)[0]
+    if N < len(cand_aidx):
+        cand_aidx = cand_aidx[np.argpartition(-scores[cand_aidx], N - 1)[:N]]
+    cand_aidx = cand_aidx[np.argsort(-scores[cand_aidx], kind='mergesort')]
+    return cand_aidx, scores[cand_aidx]
+
+
+# Function to score artists for the seed user by the playcounts of her neighbors, weighted by the neighbors'
+# similarities to the seed (by the measure of the similarity model, if given; see Similarity).
+# Only the rows of the neighbors are gathered from the UAM (dense or sparse).
+# It returns a dense array of scores of size |artists|
+def score_neighbors(UAM, seed_uidx, pc_vec, kneighbor_idx, sim_model = None):
+    kneighbor_idx = np.asarray(kneighbor_idx, dtype=np.int64)
+    is_seed = kneighbor_idx == seed_uidx
+    rows = UAM[kneighbor_idx[~is_seed], :]
+    if sim_model is not None and sim_model["measure"] != "inner":
+        sim = Similarity.similarities(sim_model, UAM, pc_vec, kneighbor_idx[~is_seed])[0]
+        self_sim = Similarity.self_similarity(sim_model, pc_vec)[0]
+    elif sp.issparse(UAM):
+        sim = np.asarray(rows.dot(pc_vec), dtype=np.float32).ravel()
+        self_sim = np.inner(pc_vec, pc_vec)
+    else:
+        sim = np.dot(rows, pc_vec)
+        self_sim = np.inner(pc_vec, pc_vec)
+    if sp.issparse(UAM):
+        scores = np.asarray(rows.T.dot(sim), dtype=np.float32).ravel()
+    else:
+        scores = np.dot(sim, rows)
+    # The seed user's own row is replaced by her masked vector
+    if np.any(is_seed):
+        scores = scores + self_sim * pc_vec
+    return scores
 
-    artist_idx_n = [] # indices of artists user u's neighbor(s) listened to
-    for neighbor_idx in kneighbor_idx:
-        listened_to = np.nonzero(UAM[neighbor_idx, :]) # indices of artists user u's neighbor listened to
 
-        artist_idx_n = np.union1d(listened_to[0], artist_idx_n) # np.nonzero returns a tuple of arrays, so we need to take the first element only
+# Function that implements a CF recommender. It takes as input the UAM, metadata (artists and users),
+# the index of the seed user (to make predictions for) and the indices of the seed user's training artists.
+# The masked and normalized playcount vector of the seed user (see mask_seed_vector) can be passed as pc_vec;
+# otherwise it is computed. The UAM is only read, never modified. If an LSH index is given,
+# the K neighbors are searched approximately among the candidates of the index (see ANN_Index); otherwise by the
+# measure of the similarity model, if given (see Similarity), or else by the inner product.
+# If N is None, it returns a list of recommended artist indices (all artists of the neighbors not in the training set).
+# Otherwise, the artists are scored by the similarity-weighted playcounts of the neighbors, and it returns
+# the indices and scores of the N highest scored artists, sorted by decreasing score
+def recommend_CF(UAM, seed_uidx, seed_aidx_train, K = 1, pc_vec = None, lsh_index = None, N = None, sim_model = None):
 
-        '''
-        if len(artist_idx_n) == 0:
-            artist_idx_n = listened_to[0]
-        else:
-            artist_idx_n = np.intersect1d(listened_to[0], artist_idx_n) # np.nonzero returns a tuple of arrays, so we need to take the first element only
-        '''
+    # UAM               user-artist-matrix
+    # seed_uidx         user index of seed user
+    # seed_aidx_train   indices of training artists for seed user
+    # pc_vec            masked and normalized playcount vector of seed user
+    # lsh_index         LSH index for approximate neighbor search
+    # N                 number of top scored artists to recommend (None: unranked, all artists of the neighbors)
+    # sim_model         precomputed similarity model (None: inner product)
 
-    # Compute the set difference between seed user's neighbor and seed user,
-    # i.e., artists listened to by the neighbor, but not by seed user.
-    # These artists are recommended to seed user.
+    # Get playcount vector for seed user, without information on test artists
+    if pc_vec is None:
+        with Instrumentation.timer("masking"):
+            pc_vec = mask_seed_vector(UAM, seed_uidx, seed_aidx_train)
 
-    recommended_artists_idx = np.setdiff1d(artist_idx_n, artist_idx_u)
-    # or alternatively, convert to a numpy array by ...
-    # artist_idx_n.arrnp.setdiff1d(np.array(artist_idx_n), np.array(artist_idx_u))
+    # Get all artist indices the seed user and her closest neighbor listened to, i.e., element with non-zero entries in UAM
+    artist_idx_u = seed_aidx_train                      # indices of artists in training set user
+
+    # Select the k closest neighbors to seed user
+    if lsh_index is not None:
+        # approximately, among the candidates in the LSH buckets of the seed user (excluding herself)
+        with Instrumentation.timer("neighbor search (LSH)"):
+            kneighbor_idx = ANN_Index.query_lsh(lsh_index, UAM, pc_vec, K, [seed_uidx])[0][0]
+    else:
+        # exactly from the masked vector; not by the neighbor index, built from unmasked rows (leaks test artists)
+        kneighbor_idx = exact_neighbors(UAM, seed_uidx, pc_vec, K, sim_model)
+    Instrumentation.count("neighbors per query", len(kneighbor_idx))
+
+    if N is not None:
+        # Score artists of the neighbors, exclude training artists and select the top N
+        with Instrumentation.timer("candidate scoring"):
+            scores = score_neighbors(UAM, seed_uidx, pc_vec, kneighbor_idx, sim_model)
+            scores[artist_idx_u] = 0.0
+            rec_aidx, rec_scores = top_n_artists(scores, N)
+        Instrumentation.count("candidates per query", len(rec_aidx))
+        return rec_aidx, rec_scores
+
+    with Instrumentation.timer("candidate union"):
+        artist_idx_n = [] # indices of artists user u's neighbor(s) listened to
+        for neighbor_idx in kneighbor_idx:
+            if neighbor_idx == seed_uidx:   # take the masked vector if the seed user is among her own neighbors
+                listened_to = np.nonzero(pc_vec)
+            else:
+                listened_to = np.nonzero(UAM[neighbor_idx, :]) # indices of artists user u's neighbor listened to
+
+            artist_idx_n = np.union1d(listened_to[0], artist_idx_n) # np.nonzero returns a tuple of arrays, so we need to take the first element only
+
+            '''
+            if len(artist_idx_n) == 0:
+                artist_idx_n = listened_to[0]
+            else:
+                artist_idx_n = np.intersect1d(listened_to[0], artist_idx_n) # np.nonzero returns a tuple of arrays, so we need to take the first element only
+            '''
+
+        # Compute the set difference between seed user's neighbor and seed user,
+        # i.e., artists listened to by the neighbor, but not by seed user.
+        # These artists are recommended to seed user.
+
+        recommended_artists_idx = np.setdiff1d(artist_idx_n, artist_idx_u)
+        # or alternatively, convert to a numpy array by ...
+        # artist_idx_n.arrnp.setdiff1d(np.array(artist_idx_n), np.array(artist_idx_u))
+    Instrumentation.count("candidates per query", len(recommended_artists_idx))
 
 #    print "training-set: " + str(seed_aidx_train)
 #    print "recommended: " + str(recommended_artists_idx)
@@ -97,29 +215,513 @@ def recommend_CF(UAM, seed_uidx, seed_aidx_train, K = 1):
     # Return list of recommended artist indices
     return recommended_artists_idx
 
+# Function to compute the binary (listened to or not) UAM as sparse CSR matrix, used by recommend_CF_batch
+def listened_matrix(UAM):
+    if sp.issparse(UAM):
+        UAM_listened = UAM.tocsr(copy=True)
+        UAM_listened.data = (UAM_listened.data != 0).astype(np.float32)
+        UAM_listened.eliminate_zeros()
+        return UAM_listened
+    uidx, aidx = np.nonzero(UAM)
+    return sp.csr_matrix((np.ones(len(uidx), dtype=np.float32), (uidx, aidx)), shape=UAM.shape)
+
+
+# Function that implements the CF recommender for a block of seed users (or folds of seed users) at once.
+# It takes as input the UAM, an array of seed user indices and a list with the indices of the training artists
+# for each of them. UAM_listened is the binary UAM (see listened_matrix), computed if not given.
+# Similarities of all seeds are computed by one matrix-matrix product, the K nearest neighbors are selected
+# row-wise by argpartition, and the artists of the neighbors are merged by a sparse matrix product.
+# If an LSH index is given, the K neighbors are searched approximately instead (see ANN_Index); if a similarity model
+# is given, similarities are computed by its measure instead of the inner product (see Similarity).
+# It returns a list with an array of recommended artist indices for each seed; if N is given, a list with
+# the indices and scores of the N highest scored artists for each seed instead (see recommend_CF)
+def recommend_CF_batch(UAM, seed_uidx, seed_aidx_train, K = 1, UAM_listened = None, lsh_index = None, N = None,
+                       sim_model = None):
+
+    if UAM_listened is None:
+        UAM_listened = listened_matrix(UAM)
+    seed_uidx = np.asarray(seed_uidx)
+    no_seeds = len(seed_uidx)
+    rows = np.arange(no_seeds)
+
+    # Boolean mask of training artists, one row per seed
+    train_rows = np.repeat(rows, [len(aidx) for aidx in seed_aidx_train])
+    train_mask = np.zeros(shape=(no_seeds, UAM.shape[1]), dtype=np.bool_)
+    if len(train_rows) > 0:
+        train_mask[train_rows, np.concatenate(seed_aidx_train).astype(np.int64)] = True
+
+    # Playcount vectors of seeds without information on test artists, sum-to-1 normalized
+    pc_vecs = np.array(UAM[seed_uidx, :])
+    pc_vecs[~train_mask] = 0.0
+    pc_vecs /= np.sum(pc_vecs, axis=1)[:, np.newaxis]
+
+    if lsh_index is not None:
+        # Search the (approximately) K nearest neighbors among the candidates in the LSH buckets of the seeds
+        lsh_neighbors = ANN_Index.query_lsh(lsh_index, UAM, pc_vecs, K, seed_uidx)
+        neighbor_rows = np.repeat(rows, [len(neighbors_idx) for neighbors_idx, neighbors_sim in lsh_neighbors])
+        neighbor_cols = np.concatenate([neighbors_idx for neighbors_idx, neighbors_sim in lsh_neighbors])
+        neighbor_sim = np.concatenate([neighbors_sim for neighbors_idx, neighbors_sim in lsh_neighbors])
+    else:
+        if sim_model is not None and sim_model["measure"] != "inner":
+            # Cosine, Pearson or Jaccard similarities between all seeds and all users; for her own similarity,
+            # the masked vector of the seed user is used
+            sim_users = Similarity.similarities(sim_model, UAM, pc_vecs)
+            sim_users[rows, seed_uidx] = Similarity.self_similarity(sim_model, pc_vecs)
+        else:
+            # Similarities between all seeds and all users by one matrix-matrix product; for her own similarity,
+            # the masked vector of the seed user is used
+            sim_users = np.dot(pc_vecs, UAM.T)
+            sim_users[rows, seed_uidx] = np.sum(pc_vecs * pc_vecs, axis=1)
+
+        # Select the K+1 most similar users by argpartition and drop the most similar one (usually the seed user herself)
+        kneighbor_idx, kneighbor_sim = Neighbor_Index.top_k(sim_users, K + 1)
+        neighbor_rows = np.repeat(rows, kneighbor_idx.shape[1] - 1)
+        neighbor_cols = kneighbor_idx[:, 1:].ravel()
+        neighbor_sim = kneighbor_sim[:, 1:].ravel()
+
+    if N is not None:
+        # Score artists by the similarity-weighted playcounts of the neighbors: weighted indicator matrix of
+        # neighbors (seeds x users) times UAM (users x artists). The seed user's own row is replaced by her masked vector
+        is_seed = neighbor_cols == seed_uidx[neighbor_rows]
+        neighbors = sp.csr_matrix((neighbor_sim[~is_seed], (neighbor_rows[~is_seed], neighbor_cols[~is_seed])),
+                                  shape=(no_seeds, UAM.shape[0]), dtype=np.float32)
+        scores = (neighbors * UAM).toarray() if sp.issparse(UAM) else neighbors.dot(UAM).astype(np.float32)
+        seed_rows = neighbor_rows[is_seed]
+        scores[seed_rows] += neighbor_sim[is_seed][:, np.newaxis] * pc_vecs[seed_rows]
+        scores[train_mask] = 0.0
+        return [top_n_artists(scores[i], N) for i in rows]
+
+    # Merge artists of neighbors: indicator matrix of neighbors (seeds x users) times binary UAM (users x artists).
+    # The seed user's own (masked) row only holds training artists, which are removed anyway, so she is left out
+    not_seed = neighbor_cols != seed_uidx[neighbor_rows]
+    neighbors = sp.csr_matrix((np.ones(np.count_nonzero(not_seed), dtype=np.float32),
+                               (neighbor_rows[not_seed], neighbor_cols[not_seed])), shape=(no_seeds, UAM.shape[0]))
+    artists_n = (neighbors * UAM_listened).toarray() > 0
+
+    # Recommend artists listened to by the neighbors, but not in the seed's training set
+    rec_rows, rec_aidx = np.nonzero(artists_n & ~train_mask)
+    return np.split(rec_aidx, np.searchsorted(rec_rows, rows[1:]))
+
+
+# Function to evaluate the user-based CF recommender for one seed user and fold for several numbers of neighbors
+# at once. The users are ranked only once (see rank_users); the recommended artists (or their scores, if N is given)
+# are then grown neighbor by neighbor up to the largest K, and the measures are taken at every K in Ks.
+# The results are the same as those of recommend_CF and compute_measures for every single K.
+# It returns a list with a tuple (no. recommended items, precision, recall) for every K in Ks, in ascending order of K
+def recommend_CF_sweep(UAM, seed_uidx, seed_aidx_train, seed_aidx_test, Ks, pc_vec = None, N = None, sim_model = None):
+
+    if pc_vec is None:
+        with Instrumentation.timer("masking"):
+            pc_vec = mask_seed_vector(UAM, seed_uidx, seed_aidx_train)
+
+    # Neighbors by decreasing similarity, without the most similar user (usually the seed user herself, see exact_neighbors)
+    Ks = sorted(set(Ks))
+    neighbors = rank_users(UAM, seed_uidx, pc_vec, sim_model)[-2::-1][:Ks[-1]]
+    if N is not None:
+        # Similarities of the neighbors as weights of their playcounts (see score_neighbors)
+        if sim_model is not None and sim_model["measure"] != "inner":
+            sim_neighbors = Similarity.similarities(sim_model, UAM, pc_vec, neighbors)[0]
+            sim_neighbors[neighbors == seed_uidx] = Similarity.self_similarity(sim_model, pc_vec)[0]
+        else:
+            sim_neighbors = np.inner(pc_vec, UAM[neighbors, :])
+            sim_neighbors[neighbors == seed_uidx] = np.inner(pc_vec, pc_vec)
+
+    is_train = np.zeros(UAM.shape[1], dtype=np.bool_)
+    is_train[seed_aidx_train] = True
+    is_test = np.zeros(UAM.shape[1], dtype=np.bool_)
+    is_test[seed_aidx_test] = True
+    is_rec = np.zeros(UAM.shape[1], dtype=np.bool_)     # artists of the neighbors so far
+    scores = np.zeros(UAM.shape[1], dtype=np.float64)   # scores of the neighbors so far (if N is given)
+    no_rec = 0          # number of recommended artists (neighbors' artists not in training set)
+    TP = 0              # number of recommended test artists
+
+    results = []
+    k = 0
+    with Instrumentation.timer("candidate union"):
+        for K in Ks:
+            # Add the artists of the neighbors up to K
+            while k < min(K, len(neighbors)):
+                # the masked vector is taken if the seed user is among her own neighbors
+                pc_neighbor = pc_vec if neighbors[k] == seed_uidx else UAM[neighbors[k], :]
+                if N is not None:
+                    scores += sim_neighbors[k] * pc_neighbor
+                else:
+                    listened_to = np.nonzero(pc_neighbor)[0]
+                    new_aidx = listened_to[~is_rec[listened_to]]
+                    is_rec[new_aidx] = True
+                    new_aidx = new_aidx[~is_train[new_aidx]]
+                    no_rec += len(new_aidx)
+                    TP += np.count_nonzero(is_test[new_aidx])
+                k += 1
+
+            if N is not None:
+                # Select the top N of the scores so far, training artists excluded
+                K_scores = scores.copy()
+                K_scores[seed_aidx_train] = 0.0
+                rec_aidx = top_n_artists(K_scores, N)[0]
+                no_rec = len(rec_aidx)
+                TP = np.count_nonzero(is_test[rec_aidx])
+
+            # Precision and recall in percent, as in compute_measures
+            prec = 100.0 * TP / no_rec if no_rec > 0 else 0.0
+            rec = 100.0 * TP / len(seed_aidx_test)
+            results.append((no_rec, prec, rec))
+
+    return results
+
+
+# Function that implements an item-based CF recommender. It takes as input the UAM, the index of the seed user
+# and the indices of the seed user's training artists, like recommend_CF, and the precomputed artist-artist
+# similarity matrix (see Item_Similarity). Artists are scored by one sparse product of the seed's masked playcount
+# vector with the similarity matrix, so the time per request does not depend on the number of users.
+# The similarity matrix is computed from the complete UAM; the seed's own contribution (including her test artists)
+# is removed from the similarities when scoring, given the column norms of the UAM (computed if None) and the measure.
+# It returns the indices of the N highest scored artists not in the training set, ordered by decreasing score
+def recommend_IB(UAM, seed_uidx, seed_aidx_train, item_sim, N = 50, norms = None, measure = Item_Similarity.MEASURE):
+
+    # Get playcount vector for seed user, without information on test artists
+    pc_vec = mask_seed_vector(UAM, seed_uidx, seed_aidx_train)
+    if norms is None:
+        norms = Item_Similarity.column_norms(UAM)
+
+    # Score artists by their similarities to the seed's training artists, weighted by playcount
+    scores = Item_Similarity.score_artists_without_user(item_sim, pc_vec, np.asarray(UAM[seed_uidx, :]), norms,
+                                                        measure)
+    scores[seed_aidx_train] = 0.0
+
+    # Select the N artists with highest score
+    return top_n_artists(scores, N)[0]
+
+
+# Function that implements a recommender by implicit-feedback matrix factorization (see Matrix_Factorization).
+# It takes the same input as recommend_IB, but the precomputed user and artist factors instead of the similarity matrix.
+# The artist factors have to be trained without the seed's test artists (see fold_train_matrices); the seed's factors
+# are solved from her masked playcount vector with the artist factors fixed. Artists are then scored by one product
+# of the artist factors with the seed's factors.
+# It returns the indices of the N highest scored artists not in the training set, ordered by decreasing score
+def recommend_MF(UAM, seed_uidx, seed_aidx_train, factors, N = 50):
+
+    # Get playcount vector for seed user, without information on test artists
+    pc_vec = mask_seed_vector(UAM, seed_uidx, seed_aidx_train)
+
+    # Factors of the seed user and scores of all artists
+    user_factors = Matrix_Factorization.fold_in(factors, pc_vec)
+    scores = np.dot(factors["artist_factors"], user_factors)
+    scores[seed_aidx_train] = 0.0
+
+    # Select the N artists with highest score
+    return top_n_artists(scores, N)[0]
+
+
+# Random number generator of recommend_baseline
+baseline_rng = np.random.RandomState(BASELINE_SEED)
+
+
 # This function defines a baseline recommender, which selects a random number of artists
 # the seed user hasn't listened yet and returns these. Since this function is used with
 # a cross fold validation all artists not in the seed_aidx_train set are artists the
-# user hasn't listened to.
+# user hasn't listened to. The evaluation draws for a whole block of seeds at once (see Baselines).
 def recommend_baseline (UAM, seed_uidx, seed_aidx_train):
     # UAM               user-artist-matrix
     # seed_uidx         user index of seed user
 
-    # Get list of artist indices the user hasn't listened yet
-    all_artists_idx = range(0, len(UAM[0,:]))
-    not_listened = np.setdiff1d(all_artists_idx, seed_aidx_train)
-
-    # get number of artists to recommend
-    num_recommend = randint(1,len(not_listened))
+    # recommend artists, with possible duplicates removed
+    return Baselines.recommend_random_batch(UAM.shape[1], [seed_aidx_train], baseline_rng)[0]
+
+# Function to compute precision and recall (in percent) of recommended artists, given the test artists
+def compute_measures(test_aidx, rec_aidx):
+    correct_aidx = np.intersect1d(test_aidx, rec_aidx)          # correctly predicted artists
+    # True Positives is amount of overlap in recommended artists and test artists
+    TP = len(correct_aidx)
+    # False Positives is recommended artists minus correctly predicted ones
+    FP = len(np.setdiff1d(rec_aidx, correct_aidx))
+    # Precision is percentage of correctly predicted among predicted (0 if nothing is recommended)
+    prec = 100.0 * TP / len(rec_aidx) if len(rec_aidx) > 0 else 0.0
+    # Recall is percentage of correctly predicted among all listened to
+    rec = 100.0 * TP / len(test_aidx)
+    return prec, rec
+
+
+# Function to call the recommender selected by RECOMMENDER for one seed user and fold (the index of the fold of
+# the cross-validation). models holds the precomputed data the recommenders need (see load_models)
+def recommend(UAM, u, train_aidx, models, fold=0):
+    if RECOMMENDER == "IB":
+        with Instrumentation.timer("item-based recommendation"):
+            return recommend_IB(UAM, u, train_aidx, models["item_sim"], N_IB, models["item_norms"],
+                                models["item_measure"])
+    elif RECOMMENDER == "MF":
+        with Instrumentation.timer("MF recommendation"):
+            return recommend_MF(UAM, u, train_aidx, models["factors"][fold], N_MF)
+
+    # The UAM is shared and not modified, the seed's test artists are masked in pc_vec
+    with Instrumentation.timer("masking"):
+        pc_vec = mask_seed_vector(UAM, u, train_aidx)
+    if N_CF is not None:
+        return recommend_CF(UAM, u, train_aidx, K, pc_vec, models.get("lsh_index"), N_CF, models.get("similarity"))[0]
+    return recommend_CF(UAM, u, train_aidx, K, pc_vec, models.get("lsh_index"), sim_model=models.get("similarity"))
+
+
+# Function to evaluate the recommender for one seed user in cross-fold validation.
+# It returns a list with one tuple (no. training items, no. test items, no. recommended items, precision, recall) per fold
+def evaluate_user(UAM, u, models):
+
+    results = []
+
+    # Get indices of seed user's artists listened to
+    u_aidx = np.nonzero(UAM[u, :])[0]
+
+    # Split user's artists into train and test set for cross-fold (CV) validation
+    kf = cross_validation.KFold(len(u_aidx), n_folds=NF)  # create folds (splits) for 5-fold CV
+    for fold, (train_aidx, test_aidx) in enumerate(kf):  # for all folds
+        # Call recommend function
+        rec_aidx = recommend(UAM, u, train_aidx, models, fold)
+
+        # Compute performance measures
+        with Instrumentation.timer("metrics"):
+            prec, rec = compute_measures(test_aidx, rec_aidx)
+        results.append((len(train_aidx), len(test_aidx), len(rec_aidx), prec, rec))
+
+    return results
+
+
+# Function to evaluate the user-based CF recommender for one seed user in cross-fold validation for all numbers of
+# neighbors in K_SWEEP at once (see recommend_CF_sweep). It returns a list with one list per fold, holding a tuple
+# (no. training items, no. test items, no. recommended items, precision, recall) for every K
+def evaluate_user_sweep(UAM, u, models):
+
+    results = []
+
+    # Get indices of seed user's artists listened to
+    u_aidx = np.nonzero(UAM[u, :])[0]
+
+    # Split user's artists into train and test set for cross-fold (CV) validation
+    kf = cross_validation.KFold(len(u_aidx), n_folds=NF)  # create folds (splits) for 5-fold CV
+    for train_aidx, test_aidx in kf:  # for all folds
+        sweep = recommend_CF_sweep(UAM, u, train_aidx, test_aidx, K_SWEEP, N=N_CF, sim_model=models.get("similarity"))
+        results.append([(len(train_aidx), len(test_aidx), no_rec, prec, rec) for no_rec, prec, rec in sweep])
+
+    return results
+
+
+# Function to evaluate the user-based CF recommender or a baseline for a block of seed users in cross-fold validation,
+# computing the recommendations for all folds of all users by one call of recommend_CF_batch or of the baseline
+# (see Baselines). The random baseline is seeded by BASELINE_SEED and the first user of the block, so its results
+# do not depend on the number of jobs. It returns a list with the results of evaluate_user for each user
+def evaluate_users_batch(UAM, users, models):
+
+    # Create folds (splits) for all users
+    seeds = []          # (user, training artists, test artists) for each fold
+    for u in users:
+        u_aidx = np.nonzero(UAM[u, :])[0]
+        kf = cross_validation.KFold(len(u_aidx), n_folds=NF)
+        for fold, (train_aidx, test_aidx) in enumerate(kf):
+            seeds.append((u, train_aidx, test_aidx, fold))
+
+    # Compute recommendations for all folds at once
+    with Instrumentation.timer("batch recommendation"):
+        if RECOMMENDER == "popular":
+            # The seeds of a fold are ranked by the popularity without the test artists of the fold
+            rec_aidx_all = [None] * len(seeds)
+            for fold in range(0, NF):
+                fold_seeds = [i for i, seed in enumerate(seeds) if seed[3] == fold]
+                fold_rec = Baselines.recommend_popular_batch(models["popularity"][fold],
+                                                             [seeds[i][1] for i in fold_seeds], N_POPULAR)
+                for i, rec_aidx in zip(fold_seeds, fold_rec):
+                    rec_aidx_all[i] = rec_aidx
+        elif RECOMMENDER == "baseline":
+            rec_aidx_all = Baselines.recommend_random_batch(UAM.shape[1], [seed[1] for seed in seeds],
+                                                            np.random.RandomState([BASELINE_SEED, users[0]]))
+        else:
+            rec_aidx_all = recommend_CF_batch(UAM, [seed[0] for seed in seeds], [seed[1] for seed in seeds], K,
+                                              models["UAM_listened"], models.get("lsh_index"), N_CF,
+                                              models.get("similarity"))
+    if RECOMMENDER == "CF" and N_CF is not None:
+        rec_aidx_all = [rec_aidx for rec_aidx, rec_scores in rec_aidx_all]
+
+    # Compute performance measures and group results by user
+    results = dict((u, []) for u in users)
+    for (u, train_aidx, test_aidx, fold), rec_aidx in zip(seeds, rec_aidx_all):
+        with Instrumentation.timer("metrics"):
+            prec, rec = compute_measures(test_aidx, rec_aidx)
+        Instrumentation.count("candidates per query", len(rec_aidx))
+        results[u].append((len(train_aidx), len(test_aidx), len(rec_aidx), prec, rec))
+    return [results[u] for u in users]
+
+
+# Function to evaluate shards (lists) of users, either per user and fold or batch-wise
+# (baselines, and the user-based CF recommender if USE_BATCH is True), or for all K of a sweep (if K_SWEEP is given)
+def evaluate_shards(UAM, shards, models):
+    for shard in shards:
+        if K_SWEEP is not None and RECOMMENDER == "CF":
+            for u in shard:
+                yield evaluate_user_sweep(UAM, u, models)
+        elif (USE_BATCH and RECOMMENDER == "CF") or RECOMMENDER in ["baseline", "popular"]:
+            for user_results in evaluate_users_batch(UAM, shard, models):
+                yield user_results
+        else:
+            for u in shard:
+                yield evaluate_user(UAM, u, models)
 
-    # recommend artists
-    recommended_artists_idx = [not_listened[randint(0,len(not_listened)-1)] for _ in range(num_recommend)]
 
-#    print "not_listened: " + str(len(not_listened)) +" num_recommended: " + str(num_recommend) + " len(recommended_artists_idx): " + str(len(recommended_artists_idx))
-#    print "recommended: "+ str(recommended_artists_idx)
+# Function to compute the UAM of every fold of the cross-validation without the test artists of all users, i.e. the
+# artists that mask_seed_vector removes from the vector of a seed in this fold (see evaluate_user), for training
+# models that must not see them. It returns a list of NF sparse CSR matrices
+def fold_train_matrices(UAM):
+    rows = [[] for fold in range(0, NF)]
+    cols = [[] for fold in range(0, NF)]
+    for u in range(0, UAM.shape[0]):
+        u_aidx = np.nonzero(UAM[u, :])[0]
+        kf = cross_validation.KFold(len(u_aidx), n_folds=NF)
+        for fold, (train_aidx, test_aidx) in enumerate(kf):
+            keep = np.intersect1d(u_aidx, train_aidx)
+            rows[fold].append(np.repeat(u, len(keep)))
+            cols[fold].append(keep)
+
+    matrices = []
+    for fold in range(0, NF):
+        fold_rows = np.concatenate(rows[fold]) if UAM.shape[0] > 0 else np.zeros(0, dtype=np.int64)
+        fold_cols = np.concatenate(cols[fold]) if UAM.shape[0] > 0 else np.zeros(0, dtype=np.int64)
+        data = np.asarray(UAM[fold_rows, fold_cols], dtype=np.float32).ravel()
+        matrices.append(sp.csr_matrix((data, (fold_rows, fold_cols)), shape=UAM.shape, dtype=np.float32))
+    return matrices
+
+
+# Function to compute the artist popularity of every fold of the cross-validation without the test artists of all
+# users, i.e. the artists compute_measures checks the recommendations of a seed against in this fold
+# (see evaluate_users_batch). It returns a list of NF dictionaries (see Baselines.popularity_ranks)
+def fold_popularity(UAM):
+    popularity = np.tile(Baselines.popularity_ranks(UAM)["popularity"], (NF, 1))
+    for u in range(0, UAM.shape[0]):
+        u_aidx = np.nonzero(UAM[u, :])[0]
+        kf = cross_validation.KFold(len(u_aidx), n_folds=NF)
+        for fold, (train_aidx, test_aidx) in enumerate(kf):
+            popularity[fold, test_aidx] -= np.asarray(UAM[u, test_aidx], dtype=np.float64)
+    return [Baselines.rank_artists(popularity[fold]) for fold in range(0, NF)]
+
+
+# Function to get the file of the factor matrices trained for a fold of the cross-validation
+def fold_factors_file(fold):
+    name, ext = os.path.splitext(FACTORS_FILE)
+    return name + "_fold" + str(fold) + ext
+
+
+# Function to get the files of the precomputed data needed by the selected recommender, building them if necessary
+# (similarity model, LSH index, artist-artist similarity matrix, factor matrices or artist popularity of every fold).
+# It returns a dictionary of file names (list of file names for the factors) by model name
+def model_files(UAM):
+    files = {}
+    if RECOMMENDER == "CF" and SIMILARITY != "inner":
+        # Computed once here and memory-mapped by the workers, not recomputed by each of them
+        Similarity.get_sim_model(UAM, UAM_FILE, SIM_MODEL_FILE, SIMILARITY)
+        files["similarity"] = SIM_MODEL_FILE
+    if RECOMMENDER == "CF" and NEIGHBOR_SEARCH == "lsh":
+        ANN_Index.get_lsh_index(UAM, UAM_FILE, LSH_INDEX_FILE)
+        files["lsh_index"] = LSH_INDEX_FILE
+    elif RECOMMENDER == "IB":
+        Item_Similarity.get_item_similarity(UAM, UAM_FILE, ITEM_SIM_FILE)
+        files["item_sim"] = ITEM_SIM_FILE
+    elif RECOMMENDER == "MF":
+        # One factorization per fold, each trained without the test artists of the fold
+        train_UAMs = fold_train_matrices(UAM)
+        files["factors"] = []
+        for fold in range(0, NF):
+            Matrix_Factorization.get_factors(UAM, UAM_FILE, fold_factors_file(fold), train_UAM=train_UAMs[fold],
+                                             fold=[fold, NF])
+            files["factors"].append(fold_factors_file(fold))
+    elif RECOMMENDER == "popular":
+        # Popularity of every fold without its test artists, written for the workers to map
+        Baselines.save_popularity(POPULARITY_FILE, fold_popularity(UAM))
+        files["popularity"] = POPULARITY_FILE
+    return files
+
+
+# Function to load the precomputed data needed by the selected recommender from the given files (memory-mapped).
+# The binary UAM for batch-wise evaluation is computed. It returns a dictionary of models by name
+def load_models(UAM, files):
+    models = {}
+    if USE_BATCH and RECOMMENDER == "CF":
+        models["UAM_listened"] = listened_matrix(UAM)
+    if "similarity" in files:
+        models["similarity"] = Similarity.load_sim_model(files["similarity"], mmap=True)[0]
+    if "popularity" in files:
+        models["popularity"] = Baselines.load_popularity(files["popularity"], mmap=True)
+    if "lsh_index" in files:
+        models["lsh_index"] = ANN_Index.load_lsh_index(files["lsh_index"], mmap=True)
+    if "item_sim" in files:
+        # Column norms are stored with the similarities (memory-mapped), not recomputed per worker
+        models["item_sim"], header, models["item_norms"] = Item_Similarity.load_item_similarity(files["item_sim"],
+                                                                                               mmap=True)
+        models["item_measure"] = header["measure"]
+    if "factors" in files:
+        models["factors"] = [Matrix_Factorization.load_factors(factors_file, mmap=True)
+                             for factors_file in files["factors"]]
+    return models
+
+
+# UAM and models of a worker process in parallel evaluation (memory-mapped, see init_worker)
+worker_UAM = None
+worker_models = None
+
+
+# Function to initialize a worker process in parallel evaluation by memory-mapping the UAM from a binary file,
+# so that all workers share the same pages instead of receiving a pickled copy. The same holds for the models
+def init_worker(uam_file, files):
+    global worker_UAM, worker_models
+    Instrumentation.collect()       # discard data recorded by the parent process before the fork
+    worker_UAM = UAM_Storage.load_UAM(uam_file, mmap=True)
+    worker_models = load_models(worker_UAM, files)
+
+
+# Function to evaluate a shard (list) of users in a worker process.
+# It returns the results and the instrumentation data recorded for the shard (see Instrumentation)
+def evaluate_shard(shard):
+    results = list(evaluate_shards(worker_UAM, [shard], worker_models))
+    return results, Instrumentation.collect()
+
+
+# Function to evaluate all users in parallel by a pool of n_jobs worker processes, each processing a shard of users.
+# If uam_file is not a dense binary UAM file, the UAM is written to a temporary binary file the workers map.
+# files are the files of the models the workers load (see model_files).
+# It yields the results of evaluate_user for all users, in order of user index (independent of n_jobs)
+def evaluate_parallel(UAM, uam_file, n_jobs, shards, files):
+    tmp_file = None
+    if not (UAM_Storage.is_binary_file(uam_file) and UAM_Storage.read_header(uam_file)[0]["layout"] == "dense"):
+        fd, tmp_file = tempfile.mkstemp(suffix=".bin")
+        os.close(fd)
+        UAM_Storage.save_UAM(tmp_file, UAM)
+        uam_file = tmp_file
+
+    pool = multiprocessing.Pool(n_jobs, init_worker, (uam_file, files))
+    try:
+        # imap returns the results of the shards in order
+        for shard_results, instrumentation in pool.imap(evaluate_shard, shards):
+            Instrumentation.merge(instrumentation)
+            for user_results in shard_results:
+                yield user_results
+        pool.close()
+    finally:
+        pool.terminate()
+        if tmp_file is not None:
+            os.remove(tmp_file)
+
+
+# Function to aggregate the results of a sweep over K (see evaluate_user_sweep) in order of users and folds,
+# and to output MAP, MAR and F1 for every K as table
+def print_sweep(results, no_users):
+    Ks = sorted(set(K_SWEEP))
+    sweep_prec = [0.0] * len(Ks)
+    sweep_rec = [0.0] * len(Ks)
+    for user_results in results:
+        for fold_results in user_results:
+            for i, (no_train, no_test, no_rec, prec, rec) in enumerate(fold_results):
+                sweep_prec[i] += prec / (NF * no_users)
+                sweep_rec[i] += rec / (NF * no_users)
+
+    print "%5s %8s %8s %8s" % ("K", "MAP", "MAR", "F1")
+    for K, avg_prec, avg_rec in zip(Ks, sweep_prec, sweep_rec):
+        f1 = 2 * ((avg_prec * avg_rec) / (avg_prec + avg_rec)) if avg_prec + avg_rec > 0 else 0.0
+        print "%5d %8.2f %8.2f %8.2f" % (K, avg_prec, avg_rec, f1)
 
-    # return result with possible duplicates removed
-    return list(set(recommended_artists_idx))
 
 # Main program
 if __name__ == '__main__':
@@ -128,59 +730,55 @@ if __name__ == '__main__':
     avg_prec = 0       # mean precision
     avg_rec = 0        # mean recall
 
-    # Load metadata from provided files into lists
-    artists = read_from_file(ARTISTS_FILE)
-    users = read_from_file(USERS_FILE)
-    # Load UAM
-    UAM = np.loadtxt(UAM_FILE, delimiter='\t', dtype=np.float32)
+    # Record every timed stage for the trace
+    Instrumentation.TRACE = TRACE_FILE is not None
 
-    # For all users in our data (UAM)
-    no_users = UAM.shape[0]
-    for u in range(0, no_users):
-
-        # Get indices of seed user's artists listened to
-        u_aidx = np.nonzero(UAM[u, :])[0]
+    # Load UAM and metadata (artists and users)
+    with Instrumentation.timer("load UAM"):
+        UAM, users, artists = UAM_Storage.load_data(UAM_FILE, USERS_FILE, ARTISTS_FILE)
 
-        # Split user's artists into train and test set for cross-fold (CV) validation
-        fold = 0
-        kf = cross_validation.KFold(len(u_aidx), n_folds=NF)  # create folds (splits) for 5-fold CV
-        for train_aidx, test_aidx in kf:  # for all folds
-            # Show progress
-            print "User: " + str(u) + ", Fold: " + str(fold) + ", Training items: " + str(
-                len(train_aidx)) + ", Test items: " + str(len(test_aidx)),      # the comma at the end avoids line break
-            # Call recommend function
-            copy_UAM = UAM.copy()       # we need to create a copy of the UAM, otherwise modifications within recommend function will effect the variable
-            #rec_aidx = recommend_CF(copy_UAM, u, train_aidx)
-            rec_aidx = recommend_CF(copy_UAM, u, train_aidx, K)
-            #rec_aidx = recommend_baseline(copy_UAM, u, train_aidx)
-            print "Recommended items: ", len(rec_aidx)
-
-            # Compute performance measures
-            correct_aidx = np.intersect1d(test_aidx, rec_aidx)          # correctly predicted artists
-            # True Positives is amount of overlap in recommended artists and test artists
-            TP = len(correct_aidx)
-            # False Positives is recommended artists minus correctly predicted ones
-            FP = len(np.setdiff1d(rec_aidx, correct_aidx))
-            # Precision is percentage of correctly predicted among predicted
-            prec = 100.0 * TP / len(rec_aidx)
-            # Recall is percentage of correctly predicted among all listened to
-            rec = 100.0 * TP / len(test_aidx)
-
-
-            # add precision and recall for current user and fold to aggregate variables
-            avg_prec += prec / (NF * no_users)
-            avg_rec += rec / (NF * no_users)
-
-             # Output precision and recall of current fold
-            print ("\tPrecision: %.2f, Recall:  %.2f" % (prec, rec))
-
-            # Increase fold counter
-            fold += 1
-
-    # calculate f1 measure
-    f1 = 2 * ((avg_prec * avg_rec) / (avg_prec + avg_rec))
-
-    # Output mean average precision and recall
-    print ("\nMAP: %.2f, MAR: %.2f, F1: %.2f" % (avg_prec, avg_rec, f1))
+    # Evaluate all users in our data (UAM), serially or in parallel
+    no_users = UAM.shape[0]
+    shards = [range(start, min(start + SHARD_SIZE, no_users)) for start in range(0, no_users, SHARD_SIZE)]
+    # Build the precomputed data of the recommender if it does not exist or is outdated
+    with Instrumentation.timer("build models"):
+        files = model_files(UAM)
+    if N_JOBS > 1:
+        results = evaluate_parallel(UAM, UAM_FILE, N_JOBS, shards, files)
+    else:
+        results = evaluate_shards(UAM, shards, load_models(UAM, files))
+
+    # Output MAP, MAR and F1 for every K of a sweep
+    if K_SWEEP is not None and RECOMMENDER == "CF":
+        print_sweep(results, no_users)
+    else:
+        # Aggregate results in order of users and folds, so that the sums are the same for any number of jobs
+        for u, user_results in enumerate(results):
+            for fold, (no_train, no_test, no_rec, prec, rec) in enumerate(user_results):
+                # Show progress
+                if not QUIET:
+                    print "User: " + str(u) + ", Fold: " + str(fold) + ", Training items: " + str(
+                        no_train) + ", Test items: " + str(no_test),      # the comma at the end avoids line break
+                    print "Recommended items: ", no_rec
+
+                # add precision and recall for current user and fold to aggregate variables
+                avg_prec += prec / (NF * no_users)
+                avg_rec += rec / (NF * no_users)
+
+                # Output precision and recall of current fold
+                if not QUIET:
+                    print ("\tPrecision: %.2f, Recall:  %.2f" % (prec, rec))
+
+        # calculate f1 measure
+        f1 = 2 * ((avg_prec * avg_rec) / (avg_prec + avg_rec))
+
+        # Output mean average precision and recall
+        print ("\nMAP: %.2f, MAR: %.2f, F1: %.2f" % (avg_prec, avg_rec, f1))
+
+    # Output time spent per stage and counters
+    if REPORT:
+        print "\n" + Instrumentation.report()
+    if TRACE_FILE is not None:
+        Instrumentation.write_trace(TRACE_FILE)
 
 
@@ -0,0 +1,96 @@
+# Lightweight instrumentation of the recommenders and the evaluation: time spent per stage and counters are recorded
+# without printing, and reported as summary or written as JSON trace of all timed stages (Chrome trace event format)
+__author__ = 'mms'
+
+# Load required modules
+import os
+import json
+import time
+from contextlib import contextmanager
+
+# Parameters
+ENABLED = True              # set to False to switch off recording (timers and counters do nothing)
+TRACE = False               # set to True to record every timed stage for the JSON trace (memory grows with calls)
+
+# Recorded data of this process
+timings = {}                # stage -> [total seconds, number of calls]
+counters = {}               # counter -> [sum of values, number of values, maximum value]
+trace_events = []           # timed stages in Chrome trace event format
+start_time = time.time()    # time stamps of the trace are relative to this time
+
+
+# Function to add the time of one call of a stage
+def add_time(stage, seconds):
+    timing = timings.setdefault(stage, [0.0, 0])
+    timing[0] += seconds
+    timing[1] += 1
+
+
+# Function to add a value to a counter (e.g. number of candidates of a query)
+def count(counter, value=1):
+    if not ENABLED:
+        return
+    values = counters.setdefault(counter, [0, 0, value])
+    values[0] += value
+    values[1] += 1
+    values[2] = max(values[2], value)
+
+
+# Context manager to time a stage: with timer("similarity"): ...
+@contextmanager
+def timer(stage):
+    if not ENABLED:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        add_time(stage, end - start)
+        if TRACE:
+            trace_events.append({"name": stage, "ph": "X", "ts": int((start - start_time) * 1e6),
+                                 "dur": int((end - start) * 1e6), "pid": os.getpid(), "tid": 0})
+
+
+# Function to get the data recorded by this process and to reset it (e.g. to send it from a worker process)
+def collect():
+    global timings, counters, trace_events
+    data = {"timings": timings, "counters": counters, "trace": trace_events}
+    timings, counters, trace_events = {}, {}, []
+    return data
+
+
+# Function to add data recorded by another process (see collect)
+def merge(data):
+    for stage, (seconds, calls) in data["timings"].iteritems():
+        timing = timings.setdefault(stage, [0.0, 0])
+        timing[0] += seconds
+        timing[1] += calls
+    for counter, (total, no_values, maximum) in data["counters"].iteritems():
+        values = counters.setdefault(counter, [0, 0, maximum])
+        values[0] += total
+        values[1] += no_values
+        values[2] = max(values[2], maximum)
+    trace_events.extend(data["trace"])
+
+
+# Function to create the summary report: total time, calls and mean time per stage (by decreasing total time),
+# and mean and maximum value of every counter. It returns the report as string
+def report():
+    lines = ["%-28s %12s %10s %12s" % ("Stage", "Total (s)", "Calls", "Mean (ms)")]
+    for stage, (seconds, calls) in sorted(timings.items(), key=lambda item: -item[1][0]):
+        lines.append("%-28s %12.3f %10d %12.4f" % (stage, seconds, calls, 1000.0 * seconds / max(calls, 1)))
+    if len(counters) > 0:
+        lines.append("%-28s %12s %10s %12s" % ("Counter", "Total", "Values", "Mean / Max"))
+        for counter, (total, no_values, maximum) in sorted(counters.items()):
+            lines.append("%-28s %12d %10d %12s" % (counter, total, no_values,
+                                                   "%.1f / %d" % (float(total) / max(no_values, 1), maximum)))
+    return "\n".join(lines)
+
+
+# Function to write the recorded data as JSON: summary of timings and counters, and the trace events
+# (if TRACE is set), which can be viewed in chrome://tracing
+def write_trace(filename):
+    with open(filename, 'w') as outfile:
+        json.dump({"timings": timings, "counters": counters, "traceEvents": trace_events}, outfile)
@@ -0,0 +1,161 @@
+# Precomputed, sparse artist-artist similarity matrix for item-based CF
+__author__ = 'mms'
+
+# Load required modules
+import os
+import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+import UAM_Blocks
+
+# Parameters
+UAM_FILE = "UAM.bin"                        # user-artist-matrix (UAM)
+ITEM_SIM_FILE = "UAM_item_sim.bin"          # artist-artist similarity matrix (binary format, see UAM_Storage)
+
+TOP_N = 100                                 # number of most similar artists kept per artist
+MEASURE = "cosine"                          # "cosine" (of playcount columns) or "cooccurrence" (no. common listeners)
+MEMORY_BUDGET = 256 * 1024 * 1024           # maximum number of bytes used for a block of similarities
+
+
+# Function to keep only the n largest entries in every row of a sparse CSR matrix
+def prune_rows(M, n):
+    M = M.tocsr()
+    M.sum_duplicates()
+    rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+
+    # Sort entries by row and decreasing value, then keep the first n entries of every row
+    order = np.lexsort((-M.data, rows))
+    rank = np.arange(len(order)) - M.indptr[rows[order]]
+    keep = order[rank < n]
+    return sp.csr_matrix((M.data[keep], (rows[keep], M.indices[keep])), shape=M.shape, dtype=np.float32)
+
+
+# Function to compute the artist-artist similarity matrix from the UAM (dense or sparse).
+# Similarities are computed for blocks of artists by sparse matrix products and pruned to the top_n most
+# similar artists per artist (the artist itself excluded), so that the matrix stays sparse.
+# It returns the similarity matrix as sparse CSR matrix of size |artists| * |artists|
+def build_item_similarity(UAM, top_n=TOP_N, measure=MEASURE, memory_budget=MEMORY_BUDGET):
+    X = sp.csc_matrix(UAM, dtype=np.float32)
+    X.eliminate_zeros()
+    if measure == "cooccurrence":
+        X.data[:] = 1.0
+    elif measure == "cosine":
+        # Normalize columns to unit length
+        norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=0), dtype=np.float32).ravel())
+        norms[norms == 0] = 1.0
+        X = X * sp.diags(1.0 / norms)
+    else:
+        raise ValueError("Unknown similarity measure: " + measure)
+    X = X.tocsc()
+    XT = X.T.tocsr()
+
+    # Size of the blocks of artists, estimated from the average number of co-listened artists per artist
+    no_artists = X.shape[1]
+    nnz_per_user = np.diff(X.tocsr().indptr).astype(np.float64)
+    nnz_per_artist = max(1.0, np.sum(nnz_per_user ** 2) / max(no_artists, 1))
+    block = max(1, int(memory_budget // (16 * nnz_per_artist)))
+
+    blocks = []
+    for start in range(0, no_artists, block):
+        S = (XT[start:start+block, :] * X).tocsr()
+        # Remove similarity of the artist to herself
+        S = S - sp.csr_matrix((S.diagonal(k=start), (np.arange(S.shape[0]), np.arange(S.shape[0]) + start)),
+                              shape=S.shape)
+        S.eliminate_zeros()
+        blocks.append(prune_rows(S, top_n))
+    return sp.vstack(blocks, format='csr') if len(blocks) > 0 else sp.csr_matrix((0, 0), dtype=np.float32)
+
+
+# Function to score all artists for the given (normalized) playcount vectors by one sparse vector-matrix product.
+# It returns a dense matrix of scores of size |vectors| * |artists|
+def score_artists(item_sim, pc_vecs):
+    pc_vecs = sp.csr_matrix(np.atleast_2d(pc_vecs), dtype=np.float32)
+    return np.asarray((pc_vecs * item_sim).todense(), dtype=np.float32)
+
+
+# Function to compute the norms of the columns (artists) of the UAM (dense or sparse), as used by the cosine measure,
+# block by block (see UAM_Blocks.column_stats), so that a memory-mapped UAM is not copied
+def column_norms(UAM):
+    return np.sqrt(UAM_Blocks.column_stats(UAM)["squares"])
+
+
+# Function to score all artists for the (masked) playcount vector of a user of the UAM the similarities were computed
+# from, with the user's own contribution removed from the similarities (leave-one-out), so that her held-out artists
+# do not raise their own scores. full_vec is the user's complete playcount vector, norms are the column norms of the
+# UAM (see column_norms, stored with the similarities). Similarities pruned from the matrix stay 0.
+# It returns the scores of all artists
+def score_artists_without_user(item_sim, pc_vec, full_vec, norms, measure=MEASURE):
+    pc_vec = np.asarray(pc_vec, dtype=np.float64).ravel()
+    full_vec = np.asarray(full_vec, dtype=np.float64).ravel()
+    train = np.nonzero(pc_vec)[0]
+    listened = np.nonzero(full_vec)[0]
+
+    # Co-occurrences and norms of the UAM without the user
+    sub = np.asarray(item_sim[train, :][:, listened].todense(), dtype=np.float64)
+    if measure == "cooccurrence":
+        weights = pc_vec
+        sub = np.where(sub != 0, sub - 1.0, 0.0)
+    else:
+        norms = np.asarray(norms, dtype=np.float64)
+        rest = norms.copy()
+        rest[listened] = np.sqrt(np.maximum(norms[listened] ** 2 - full_vec[listened] ** 2, 0.0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Columns of artists the user did not listen to only change by the norms of her training artists
+            weights = np.where(rest > 0, pc_vec * norms / np.where(rest > 0, rest, 1.0), 0.0)
+            dots = sub * np.outer(norms[train], norms[listened]) - np.outer(full_vec[train], full_vec[listened])
+            denom = np.outer(rest[train], rest[listened])
+            sub = np.where((sub != 0) & (denom > 0), dots / np.where(denom > 0, denom, 1.0), 0.0)
+
+    scores = np.asarray((sp.csr_matrix(weights[np.newaxis, :].astype(np.float32)) * item_sim).todense(),
+                        dtype=np.float32).ravel()
+    scores[listened] = np.dot(pc_vec[train], sub).astype(np.float32)
+    return scores
+
+
+# Function to save an artist-artist similarity matrix. uam_hash is the content hash of the UAM it was built from,
+# norms are the column norms of the UAM (see column_norms), stored beside the matrix if given
+def save_item_similarity(filename, item_sim, uam_hash=None, measure=MEASURE, top_n=TOP_N, norms=None):
+    item_sim = item_sim.tocsr()
+    arrays = {"data": item_sim.data, "indices": item_sim.indices, "indptr": item_sim.indptr}
+    if norms is not None:
+        arrays["norms"] = np.asarray(norms, dtype=np.float64)
+    UAM_Storage.write_arrays(filename, arrays, {"kind": "item_similarity", "shape": list(item_sim.shape),
+                                                "measure": measure, "top_n": top_n, "uam_hash": uam_hash})
+
+
+# Function to load an artist-artist similarity matrix (memory-mapped).
+# It returns the matrix, the header (with measure and hash of the UAM) and the column norms of the UAM (None if not
+# stored)
+def load_item_similarity(filename, mmap=True):
+    arrays, header = UAM_Storage.read_arrays(filename, mmap)
+    item_sim = sp.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(header["shape"]),
+                             copy=False)
+    return item_sim, header, arrays.get("norms")
+
+
+# Function to load the artist-artist similarity matrix for the given UAM file, or to build (and save) it together
+# with the column norms of the UAM if it does not exist or was built from a different UAM or with different parameters
+def get_item_similarity(UAM, uam_file, sim_file, top_n=TOP_N, measure=MEASURE):
+    uam_hash = UAM_Storage.content_hash(uam_file)
+    if os.path.exists(sim_file):
+        item_sim, header, norms = load_item_similarity(sim_file)
+        if uam_hash is not None and header["uam_hash"] == uam_hash and header["measure"] == measure and \
+                header["top_n"] == top_n and norms is not None:
+            return item_sim
+
+    item_sim = build_item_similarity(UAM, top_n, measure)
+    save_item_similarity(sim_file, item_sim, uam_hash, measure, top_n, column_norms(UAM))
+    return item_sim
+
+
+# Main program
+if __name__ == '__main__':
+
+    # Load UAM (dense or sparse)
+    UAM = UAM_Storage.load_UAM(UAM_FILE)
+
+    # Build and save artist-artist similarity matrix
+    item_sim = build_item_similarity(UAM, TOP_N, MEASURE)
+    save_item_similarity(ITEM_SIM_FILE, item_sim, UAM_Storage.content_hash(UAM_FILE), MEASURE, TOP_N,
+                         column_norms(UAM))
+    print "Stored " + str(item_sim.nnz) + " similarities of " + str(item_sim.shape[0]) + " artists in " + ITEM_SIM_FILE
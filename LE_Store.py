@@ -0,0 +1,196 @@
+# Columnar store of listening events: integer user, artist and track codes and uint32 time stamps (one array per
+# column), with the user, artist and track names stored beside them (binary format, see UAM_Storage). The events are
+# sorted by user and time, so the events of a user are a contiguous slice and a time window is one vectorized pass.
+# A track is coded by its artist and title (the artist of every track code is stored in track_artist).
+# The store is written in chunks of events sorted by user and time, which are merged by ranges of users; the memory
+# used for merging is about the size of a chunk (more if the events of a single user exceed a chunk), plus the codes
+# of all names
+__author__ = 'mms'
+
+# Load required modules
+import os
+import array
+import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+
+# Parameters
+LE_STORE_FILE = "LE.bin"        # listening event store
+CHUNK_EVENTS = 1000000          # number of listening events buffered before they are written to a chunk file
+
+COLUMNS = ["user", "artist", "track", "time"]
+COLUMN_DTYPES = {"user": np.int32, "artist": np.int32, "track": np.int32, "time": np.uint32}
+
+
+# Function to create a writer of a listening event store. Users, artists and tracks are integer-coded in order of
+# their first occurrence; the events are written in chunks of chunk_events events to tmp_dir.
+# It returns the writer as dictionary
+def create_writer(filename, tmp_dir, chunk_events=CHUNK_EVENTS):
+    return {"filename": filename, "tmp_dir": tmp_dir, "chunk_events": chunk_events, "chunks": [],
+            "codes": {"user": {}, "artist": {}, "track": {}},   # name (track: (artist code, title)) -> code, per column
+            "buffer": dict((column, array.array('I' if column == "time" else 'i')) for column in COLUMNS)}
+
+
+# Function to write the buffered listening events of a writer to a new chunk file, sorted by user and time
+# (stable, so events of a user with equal time stamps keep their order)
+def flush_chunk(writer):
+    buffer = writer["buffer"]
+    if len(buffer["time"]) == 0:
+        return
+    columns = dict((column, np.frombuffer(buffer[column], dtype=COLUMN_DTYPES[column])) for column in COLUMNS)
+    order = np.lexsort((columns["time"], columns["user"]))
+    chunk_file = os.path.join(writer["tmp_dir"], "chunk_" + str(len(writer["chunks"])) + ".bin")
+    UAM_Storage.write_arrays(chunk_file, dict((column, columns[column][order]) for column in COLUMNS),
+                             {"kind": "le_chunk"})
+    writer["chunks"].append(chunk_file)
+    writer["buffer"] = dict((column, array.array(buffer[column].typecode)) for column in COLUMNS)
+
+
+# Function to add listening events, given as lines of the LE file (user, artist, track and time separated by tabs,
+# see Lastfm_LE_Fetcher.parse_listening_events), to a writer
+def add_events(writer, lines):
+    users, artists, tracks = writer["codes"]["user"], writer["codes"]["artist"], writer["codes"]["track"]
+    buffer = writer["buffer"]
+    for line in lines.split("\n"):
+        if not line:
+            continue
+        user, artist, track, uts = line.split("\t")
+        a = artists.setdefault(artist, len(artists))
+        buffer["user"].append(users.setdefault(user, len(users)))
+        buffer["artist"].append(a)
+        buffer["track"].append(tracks.setdefault((a, track), len(tracks)))
+        buffer["time"].append(int(uts))
+    if len(buffer["time"]) >= writer["chunk_events"]:
+        flush_chunk(writer)
+
+
+# Function to get the names of a dictionary name -> code, ordered by code
+def ordered_names(codes):
+    names = [None] * len(codes)
+    for name, code in codes.iteritems():
+        names[code] = name
+    return names
+
+
+# Function to finish a listening event store: the sorted chunks (memory-mapped) are merged by ranges of users into
+# the store, which is created at full size together with the names and the offsets of every user's events.
+# It returns the number of events
+def close_writer(writer):
+    flush_chunk(writer)
+    chunks = [UAM_Storage.read_arrays(chunk_file)[0] for chunk_file in writer["chunks"]]
+
+    # Offsets of every user's events, from the numbers of events per user of all chunks
+    no_users = len(writer["codes"]["user"])
+    user_ptr = np.zeros(no_users + 1, dtype=np.int64)
+    for chunk in chunks:
+        user_ptr[1:] += np.bincount(chunk["user"], minlength=no_users)
+    np.cumsum(user_ptr, out=user_ptr)
+    no_events = int(user_ptr[-1])
+
+    track_keys = ordered_names(writer["codes"]["track"])
+    names = {"users": UAM_Storage.encode_names(ordered_names(writer["codes"]["user"])),
+             "artists": UAM_Storage.encode_names(ordered_names(writer["codes"]["artist"])),
+             "tracks": UAM_Storage.encode_names([track for artist, track in track_keys]),
+             "track_artist": np.array([artist for artist, track in track_keys], dtype=np.int32)}
+    del track_keys
+    specs = dict((column, ((no_events,), COLUMN_DTYPES[column])) for column in COLUMNS)
+    specs["user_ptr"] = (user_ptr.shape, np.int64)
+    specs.update((name, (names[name].shape, names[name].dtype)) for name in names)
+    arrays = UAM_Storage.create_arrays(writer["filename"], specs, {"kind": "le_store", "no_events": no_events})
+    arrays["user_ptr"][:] = user_ptr
+    for name in names:
+        arrays[name][:] = names[name]
+
+    # Merge ranges of users with about chunk_events events: the events of the range are gathered from every chunk (in
+    # order of the chunks) and sorted by user and time (stable, see flush_chunk)
+    lo = 0
+    while lo < no_users:
+        hi = max(lo + 1, int(np.searchsorted(user_ptr, user_ptr[lo] + writer["chunk_events"], 'right')) - 1)
+        bounds = [np.searchsorted(chunk["user"], [lo, hi]) for chunk in chunks]
+        events = {}
+        for column in COLUMNS:
+            events[column] = np.concatenate([chunk[column][first:last] for chunk, (first, last) in zip(chunks, bounds)])
+        order = np.lexsort((events["time"], events["user"]))
+        for column in COLUMNS:
+            arrays[column][user_ptr[lo]:user_ptr[hi]] = events[column][order]
+        lo = hi
+    del chunks
+
+    for name in arrays:
+        if isinstance(arrays[name], np.memmap):
+            arrays[name].flush()
+    del arrays
+    UAM_Storage.finish_arrays(writer["filename"])
+
+    for chunk_file in writer["chunks"]:
+        os.remove(chunk_file)
+    return no_events
+
+
+# Function to load a listening event store. The columns are memory-mapped (unless mmap is False).
+# It returns the store as dictionary of the columns, the offsets of the users' events, the artist of every track and
+# the lists of names
+def load_store(filename, mmap=True):
+    arrays, header = UAM_Storage.read_arrays(filename, mmap)
+    if header.get("kind") != "le_store":
+        raise IOError("Not a listening event store: " + filename)
+    store = dict((column, arrays[column]) for column in COLUMNS + ["user_ptr", "track_artist"])
+    for column in ["users", "artists", "tracks"]:
+        store[column] = UAM_Storage.decode_names(arrays[column])
+    return store
+
+
+# Function to get the events of a user (by code) with start <= time < end (no limit if None),
+# by binary search in the user's time stamps. It returns a slice of the columns of the store
+def user_events(store, u, start=None, end=None):
+    first, last = int(store["user_ptr"][u]), int(store["user_ptr"][u+1])
+    times = store["time"][first:last]
+    lo = first + int(np.searchsorted(times, start)) if start is not None else first
+    hi = first + int(np.searchsorted(times, end)) if end is not None else last
+    return slice(lo, hi)
+
+
+# Function to select the events with start <= time < end (no limit if None).
+# It returns a boolean mask over the events (None for all events)
+def time_mask(store, start=None, end=None):
+    mask = None
+    if start is not None:
+        mask = store["time"] >= start
+    if end is not None:
+        mask = store["time"] < end if mask is None else mask & (store["time"] < end)
+    return mask
+
+
+# Function to count the listening events per (user, artist) with start <= time < end in one vectorized pass.
+# It returns the playcounts as sparse CSR matrix of size |users| * |artists| (all users and artists of the store)
+def count_events(store, start=None, end=None):
+    mask = time_mask(store, start, end)
+    uidx = store["user"] if mask is None else store["user"][mask]
+    aidx = store["artist"] if mask is None else store["artist"][mask]
+    counts = sp.coo_matrix((np.ones(len(uidx), dtype=np.float32), (uidx, aidx)),
+                           shape=(len(store["users"]), len(store["artists"])), dtype=np.float32).tocsr()
+    counts.sort_indices()
+    return counts
+
+
+# Function to remove the users and artists without playcounts (e.g. outside a time window) from a playcount matrix.
+# It returns the matrix and the lists of remaining user and artist names
+def drop_empty(counts, user_names, artist_names):
+    users = np.nonzero(np.diff(counts.indptr))[0]
+    artists = np.nonzero(np.bincount(counts.indices, minlength=counts.shape[1]))[0]
+    if len(users) == counts.shape[0] and len(artists) == counts.shape[1]:
+        return counts, user_names, artist_names
+    counts = counts[users, :][:, artists]
+    counts.sort_indices()
+    return counts, [user_names[u] for u in users], [artist_names[a] for a in artists]
+
+
+# Main program
+if __name__ == '__main__':
+
+    # Output size and time range of the store
+    store = load_store(LE_STORE_FILE)
+    print "Stored " + str(len(store["time"])) + " listening events of " + str(len(store["users"])) + " users, " + \
+        str(len(store["artists"])) + " artists and " + str(len(store["tracks"])) + " tracks"
+    if len(store["time"]) > 0:
+        print "Time stamps from " + str(int(store["time"].min())) + " to " + str(int(store["time"].max()))
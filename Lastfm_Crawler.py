@@ -0,0 +1,429 @@
+# Concurrent fetch engine for the Last.fm API: a pool of worker threads with one keep-alive connection each,
+# a global token bucket limiting the request rate, and retries with exponential backoff
+__author__ = 'mms'
+
+# Load required modules
+import os
+import time
+import json
+import socket
+import urllib
+import httplib
+import urlparse
+import threading
+import Queue
+
+
+# Parameters
+LASTFM_API_URL = "http://ws.audioscrobbler.com/2.0/"  # base URL of the API (can point to a local stub server)
+LASTFM_OUTPUT_FORMAT = "json"
+
+N_THREADS = 8                   # number of concurrent worker threads (and connections)
+REQUESTS_PER_SECOND = 5.0       # API quota: average number of requests per second over all threads
+BURST = 5                       # maximum number of requests sent at once after idle time
+MAX_RETRIES = 4                 # number of retries of a failed request
+BACKOFF = 1.0                   # seconds to wait before the first retry, doubled for every further retry
+TIMEOUT = 30                    # socket timeout in seconds
+SAVE_EVERY = 100                # number of pages fetched between two saves of the crawl manifest
+
+FRIENDS_PER_PAGE = 200          # number of friends per page of user.getFriends
+MAX_FRIEND_PAGES = 5            # maximum number of pages of friends fetched per user
+
+RETRY_STATUS = [429, 500, 502, 503, 504]    # HTTP status codes of temporary errors
+RETRY_API_ERRORS = [8, 11, 16, 29]          # Last.fm error codes of temporary errors (29: rate limit exceeded)
+
+
+# Function to create a token bucket rate limiter shared by all threads: tokens are refilled at the given rate
+# up to burst tokens, and every request takes one token. It returns a function that blocks until a token is available
+def rate_limiter(rate=REQUESTS_PER_SECOND, burst=BURST):
+    lock = threading.Lock()
+    bucket = {"tokens": float(burst), "time": time.time()}
+
+    def acquire():
+        while True:
+            with lock:
+                now = time.time()
+                bucket["tokens"] = min(float(burst), bucket["tokens"] + (now - bucket["time"]) * rate)
+                bucket["time"] = now
+                if bucket["tokens"] >= 1.0:
+                    bucket["tokens"] -= 1.0
+                    return
+                wait = (1.0 - bucket["tokens"]) / rate
+            time.sleep(wait)
+
+    return acquire
+
+
+# Connections of the worker threads, one per thread and host (reused for all requests of the thread)
+connections = threading.local()
+
+
+# Function to get the keep-alive connection of the current thread to the host of the given URL
+def get_connection(url):
+    parts = urlparse.urlsplit(url)
+    if not hasattr(connections, "pool"):
+        connections.pool = {}
+    key = (parts.scheme, parts.netloc)
+    if key not in connections.pool:
+        if parts.scheme == "https":
+            connections.pool[key] = httplib.HTTPSConnection(parts.netloc, timeout=TIMEOUT)
+        else:
+            connections.pool[key] = httplib.HTTPConnection(parts.netloc, timeout=TIMEOUT)
+    return connections.pool[key]
+
+
+# Function to close the connection of the current thread to the host of the given URL (reopened on next use)
+def close_connection(url):
+    parts = urlparse.urlsplit(url)
+    pool = getattr(connections, "pool", {})
+    conn = pool.pop((parts.scheme, parts.netloc), None)
+    if conn is not None:
+        conn.close()
+
+
+# Function to call the Last.fm API with the given parameters (dictionary), respecting the rate limit.
+# Temporary errors (network errors, HTTP status in RETRY_STATUS, Last.fm errors in RETRY_API_ERRORS) are retried
+# with exponential backoff. It returns the content of the response, or None if all retries failed
+def api_call(params, base_url=LASTFM_API_URL, acquire=None, retries=MAX_RETRIES, backoff=BACKOFF):
+    parts = urlparse.urlsplit(base_url)
+    path = (parts.path or "/") + "?" + urllib.urlencode(sorted(params.items()))
+
+    for attempt in range(0, retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        if acquire is not None:
+            acquire()
+
+        try:
+            conn = get_connection(base_url)
+            conn.request("GET", path)
+            response = conn.getresponse()
+            content = response.read()       # read completely, so that the connection can be reused
+        except (socket.error, httplib.HTTPException) as e:
+            # Connection closed by the server or network error: reconnect on retry
+            print "Request failed (" + str(e) + "), retrying ..."
+            close_connection(base_url)
+            continue
+
+        if response.status in RETRY_STATUS:
+            print "HTTP status " + str(response.status) + ", retrying ..."
+            continue
+        try:
+            error = json.loads(content).get("error")
+        except ValueError:                  # no JSON content
+            error = None
+        if error in RETRY_API_ERRORS:
+            print "API error " + str(error) + ", retrying ..."
+            continue
+        return content
+
+    return None
+
+
+# Function to get the number of pages of a user.getRecentTracks (or other, given by its root tag) response
+# (0 if not found)
+def total_pages(content, root="recenttracks"):
+    try:
+        return int(json.loads(content)[root]["@attr"]["totalPages"])
+    except (ValueError, KeyError, TypeError):
+        return 0
+
+
+# Function to get the timestamp of the newest listening event in a user.getRecentTracks response (0 if none).
+# The track currently playing has no timestamp and is skipped
+def newest_uts(content):
+    try:
+        tracks = json.loads(content)["recenttracks"]["track"]
+    except (ValueError, KeyError, TypeError):
+        return 0
+    if isinstance(tracks, dict):            # single track
+        tracks = [tracks]
+    return max([int(track["date"]["uts"]) for track in tracks if "date" in track] + [0])
+
+
+# Lock for all changes of a crawl manifest, which is shared by the worker threads
+manifest_lock = threading.Lock()
+
+
+# Function to load the crawl manifest from a JSON file (an empty manifest if the file does not exist).
+# For each user, the manifest holds the crawls of her listening events: the timestamps they started from and
+# ended at (the API's from and to parameters), their number of pages and the time each page was fetched; further
+# the files written and the timestamp of the newest listening event fetched
+def load_manifest(filename):
+    users = {}
+    if filename is not None and os.path.exists(filename):
+        with open(filename, 'r') as f:
+            users = json.load(f)
+    return {"filename": filename, "users": users, "unsaved": 0}
+
+
+# Function to save the crawl manifest. The file is replaced at once, so that a killed crawl leaves a valid manifest
+def save_manifest(manifest):
+    if manifest["filename"] is None:
+        return
+    with manifest_lock:
+        manifest["unsaved"] = 0
+        tmp_file = manifest["filename"] + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest["users"], f, sort_keys=True)
+        os.rename(tmp_file, manifest["filename"])
+
+
+# Function to get the files of all pages fetched for a user, in order of fetching
+def user_files(manifest, user):
+    return list(manifest["users"].get(user, {}).get("files", []))
+
+
+# Function to get the current crawl of a user from the manifest. If the user was not crawled before, a crawl of all
+# her listening events is started; if her last crawl is complete, a new crawl of the events newer than the newest
+# event fetched. Otherwise, the last (interrupted) crawl is continued. A crawl only asks for the events up to the
+# time it started, so that events scrobbled while it runs (or is interrupted) do not shift the pages (which are
+# ordered newest first) and the pages fetched before and after a resume fit together
+def current_crawl(manifest, user):
+    with manifest_lock:
+        entry = manifest["users"].setdefault(user, {"crawls": [], "files": [], "newest_uts": 0})
+        crawls = entry["crawls"]
+        if len(crawls) == 0 or (crawls[-1]["total_pages"] is not None and
+                                len(crawls[-1]["pages"]) >= crawls[-1]["total_pages"]):
+            start = entry["newest_uts"] + 1 if len(crawls) > 0 else 0
+            crawls.append({"from": start, "to": int(time.time()), "total_pages": None, "pages": {}})
+        elif "to" not in crawls[-1]:
+            # Crawl of a manifest written before crawls had an end: bounded from now on
+            crawls[-1]["to"] = int(time.time())
+        return entry, crawls[-1]
+
+
+# Function to fetch the recent tracks (listening events) of a user, at most max_pages pages of limit events each.
+# The first page tells the total number of pages, so no requests are sent for pages the user does not have.
+# If a crawl manifest is given, only the pages missing in the user's current crawl are fetched (see current_crawl),
+# and the manifest is updated after every page and saved every SAVE_EVERY pages (save_manifest has to be called
+# when the crawl is done; fetch_LEs does so).
+# Every page is written to output_dir as <user>_<page>.json (<user>_<from>-<page>.json for crawls of new events).
+# It returns the list of contents of all pages fetched
+def fetch_user_LEs(user, output_dir, api_key, max_pages, limit, base_url=LASTFM_API_URL, acquire=None,
+                   manifest=None):
+    if manifest is None:
+        manifest = load_manifest(None)
+    entry, crawl = current_crawl(manifest, user)
+
+    params = {"method": "user.getrecenttracks", "user": user, "api_key": api_key,
+              "format": LASTFM_OUTPUT_FORMAT, "limit": limit}
+    if crawl["from"] > 0:
+        params["from"] = crawl["from"]
+    params["to"] = crawl["to"]
+
+    content_merged = []
+    p = 0
+    while p < (crawl["total_pages"] if crawl["total_pages"] is not None else max_pages):
+        if str(p + 1) in crawl["pages"]:        # fetched before
+            p += 1
+            continue
+        params["page"] = p + 1
+        content = api_call(params, base_url, acquire)
+        if content is None:
+            print "Giving up on page #" + str(p+1) + " of user " + user
+            break
+
+        # Write content to local file
+        if crawl["from"] > 0:
+            file_name = user + "_" + str(crawl["from"]) + "-" + str(p+1) + "." + LASTFM_OUTPUT_FORMAT
+        else:
+            file_name = user + "_" + str(p+1) + "." + LASTFM_OUTPUT_FORMAT
+        with open(output_dir + "/" + file_name, 'w') as file_out:
+            file_out.write(content)
+        content_merged.append(content)
+
+        # Record page in manifest
+        with manifest_lock:
+            if crawl["total_pages"] is None:
+                crawl["total_pages"] = min(max_pages, total_pages(content))
+            crawl["pages"][str(p+1)] = int(time.time())
+            if file_name not in entry["files"]:
+                entry["files"].append(file_name)
+            entry["newest_uts"] = max(entry["newest_uts"], newest_uts(content))
+            manifest["unsaved"] += 1
+            save = manifest["unsaved"] >= SAVE_EVERY
+        if save:
+            save_manifest(manifest)
+        p += 1
+
+    return content_merged
+
+
+# Function to fetch the listening events of all given users concurrently by n_threads worker threads sharing
+# one rate limiter. If a crawl manifest is given, the crawl resumes from it (see fetch_user_LEs).
+# It returns a list with the contents (list of pages fetched) for each user, in order of users
+def fetch_LEs(users, output_dir, api_key, max_pages, limit, base_url=LASTFM_API_URL, n_threads=N_THREADS,
+              rate=REQUESTS_PER_SECOND, manifest=None):
+
+    # Ensure that output directory structure exists
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    acquire = rate_limiter(rate)
+    tasks = Queue.Queue()
+    for u in range(0, len(users)):
+        tasks.put(u)
+    results = [[] for u in users]
+
+    def worker():
+        while True:
+            try:
+                u = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            print 'Fetching listening events for user #' + str(u+1) + ': ' + users[u] + ' ...'
+            results[u] = fetch_user_LEs(users[u], output_dir, api_key, max_pages, limit, base_url, acquire,
+                                        manifest)
+
+    threads = [threading.Thread(target=worker) for t in range(0, min(n_threads, len(users)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if manifest is not None:
+        save_manifest(manifest)
+
+    return results
+
+
+# Function to get the names of the users in a user.getFriends response
+def friend_names(content):
+    try:
+        friends = json.loads(content)["friends"]["user"]
+    except (ValueError, KeyError, TypeError):
+        return []
+    if isinstance(friends, dict):           # single friend
+        friends = [friends]
+    return [friend["name"].encode("utf-8") for friend in friends if "name" in friend]
+
+
+# Function to fetch the friends of a user, at most max_pages pages of limit friends each.
+# It returns the list of names of the friends (empty if the user is not found), or None if all retries of a page failed
+def fetch_friends(user, api_key, max_pages=MAX_FRIEND_PAGES, limit=FRIENDS_PER_PAGE, base_url=LASTFM_API_URL,
+                  acquire=None):
+    params = {"method": "user.getfriends", "user": user, "api_key": api_key,
+              "format": LASTFM_OUTPUT_FORMAT, "limit": limit}
+    friends = []
+    p = 0
+    no_pages = max_pages
+    while p < no_pages:
+        params["page"] = p + 1
+        content = api_call(params, base_url, acquire)
+        if content is None:
+            print "Giving up on friends of user " + user
+            return None
+        friends.extend(friend_names(content))
+        if p == 0:
+            no_pages = min(max_pages, total_pages(content, "friends"))
+        p += 1
+    return friends
+
+
+# Function to load the state of a friend-graph expansion from its log file (a new expansion if the file does not
+# exist). The state holds the users found so far in breadth-first order, the number of them whose friends were
+# processed (the users not expanded yet form the frontier) and the users whose friends could not be fetched.
+# The log has one JSON record per line, with the users found, the number of users expanded and the failed users
+# after a round (see save_frontier); an incomplete last record of an interrupted expansion is removed
+def load_frontier(filename):
+    users = []
+    expanded = 0
+    failed = []
+    if filename is not None and os.path.exists(filename):
+        with open(filename, 'r+') as f:
+            end = 0                         # end of the last complete record
+            newline = True
+            for line in iter(f.readline, ""):
+                try:
+                    record = json.loads(line)
+                except ValueError:          # incomplete record
+                    break
+                users.extend([user.encode("utf-8") for user in record.get("users", [])])
+                expanded = record["expanded"]
+                failed = [user.encode("utf-8") for user in record.get("failed", [])]
+                end = f.tell()
+                newline = line.endswith("\n")
+            # Truncate to the complete records, which end with a newline (not written by older versions)
+            f.seek(end)
+            f.truncate()
+            if not newline:
+                f.write("\n")
+    return {"filename": filename, "users": users, "expanded": expanded, "failed": failed, "saved": len(users)}
+
+
+# Function to save the state of a friend-graph expansion by appending a record with the users found since the last
+# save to its log file, so that the time of saving does not grow with the number of users found
+def save_frontier(state):
+    if state["filename"] is None:
+        return
+    with open(state["filename"], 'a') as f:
+        f.write(json.dumps({"users": state["users"][state["saved"]:], "expanded": state["expanded"],
+                            "failed": state["failed"]}) + "\n")
+    state["saved"] = len(state["users"])
+
+
+# Function to find users by breadth-first expansion of the friend graph, starting from the seed users, until
+# target users are found. The friends of the next n_threads users of the frontier are fetched concurrently,
+# sharing one rate limiter; new users are appended in order of the frontier (independent of the timing of
+# the threads), and users already found are skipped by a hash set. Users whose friends could not be fetched are
+# not counted as expanded but kept as failed, and retried first by the next expansion (e.g. after a resume).
+# The state (see load_frontier) is saved after every round, so an interrupted expansion resumes where it stopped.
+# It returns the names of (at most) target users, seeds first
+def expand_friends(seeds, target, api_key, max_pages=MAX_FRIEND_PAGES, base_url=LASTFM_API_URL, n_threads=N_THREADS,
+                   rate=REQUESTS_PER_SECOND, state=None):
+    if state is None:
+        state = load_frontier(None)
+    users = state["users"]
+    seen = set(users)
+    for seed in seeds:
+        if seed not in seen:
+            seen.add(seed)
+            users.append(seed)
+
+    acquire = rate_limiter(rate)
+    retry = list(state["failed"])       # users that failed in a previous expansion
+    while len(users) < target and (len(retry) > 0 or state["expanded"] < len(users)):
+        # Fetch the friends of the users to retry, then of the next users of the frontier, concurrently
+        if len(retry) > 0:
+            batch, retry = retry[:n_threads], retry[n_threads:]
+            state["failed"] = state["failed"][len(batch):]
+            from_frontier = 0
+        else:
+            batch = users[state["expanded"]:state["expanded"] + n_threads]
+            from_frontier = len(batch)
+        friends = [None for user in batch]
+        tasks = Queue.Queue()
+        for i in range(0, len(batch)):
+            tasks.put(i)
+
+        def worker():
+            while True:
+                try:
+                    i = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                friends[i] = fetch_friends(batch[i], api_key, max_pages, FRIENDS_PER_PAGE, base_url, acquire)
+
+        threads = [threading.Thread(target=worker) for t in range(0, len(batch))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Add new users, in order of the frontier
+        for user, user_friends in zip(batch, friends):
+            if user_friends is None:
+                state["failed"].append(user)
+                continue
+            for friend in user_friends:
+                if friend not in seen:
+                    seen.add(friend)
+                    users.append(friend)
+        state["expanded"] += from_frontier
+        save_frontier(state)
+        print "Expanded " + str(state["expanded"]) + " users, found " + str(len(users)) + " users"
+
+    return users[:target]
+
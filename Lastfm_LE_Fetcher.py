@@ -7,8 +7,13 @@ import urllib
 import csv
 import json
 import shutil
+import tempfile
+import itertools
+import multiprocessing
 from os import listdir
 from os.path import isfile, join
+import Lastfm_Crawler
+import LE_Store
 
 
 # Parameters
@@ -20,6 +25,8 @@ MAX_PAGES = 5                           # maximum number of pages per user
 MAX_ARTISTS = 50                        # maximum number of top artists to fetch
 MAX_FANS = 10                           # maximum number of fans per artist
 MAX_EVENTS_PER_PAGE = 200               # maximum number of listening events to retrieve per page
+N_THREADS = 8                           # number of concurrent connections for fetching listening events
+REQUESTS_PER_SECOND = 5.0               # maximum average number of API requests per second (API quota)
 
 MAX_LE = 500                            # maximum number of user for fetching
 GET_NEW_USERS = False                   # set to True if new users should be retrieved
@@ -27,9 +34,15 @@ USERS_FILE = "./seed_users.csv"         # text file containing Last.fm user name
 
 OUTPUT_DIRECTORY = "./"                 # directory to write output to
 OUTPUT_FILE = "./users.txt"             # file to write output
-LE_FILE = "./LE.txt"                    # aggregated listening events
+LE_FILE = "./LE.txt"                    # aggregated listening events (text format)
+LE_STORE_FILE = "./LE.bin"              # aggregated listening events (columnar store, see LE_Store)
+LE_FORMAT = "text"                      # "text" to write LE_FILE, "store" to write LE_STORE_FILE
+MANIFEST_FILE = "./crawl_manifest.json" # pages fetched per user, to resume crawls and fetch only new events
+FRONTIER_FILE = "./friend_frontier.json"    # log of the users found and expanded so far, to resume the search for users
 
 USE_EXISTING_LE = True                  # use already fetched LE from listening_events folder
+N_JOBS = 4                              # number of processes parsing the fetched pages (1 parses in this process)
+CHUNK_SIZE = 16                         # number of pages parsed per task of a process
 
 # Simple function to read content of a text file into a list
 def read_users(users_file):
@@ -43,34 +56,13 @@ def read_users(users_file):
 
 # Function to call Last.fm API: Users.getRecentTrack
 def lastfm_api_call_getLEs(user, output_dir):
-    content_merged = []        # empty list
-
     # Ensure that output directory structure exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Retrieve content from URL
-    query_quoted = urllib.quote(user)
-    # Loop over number of pages to retrieve
-    for p in range(0, MAX_PAGES):
-        # Construct API call
-        url = LASTFM_API_URL + "?method=user.getrecenttracks&user=" + query_quoted + \
-              "&format=" + LASTFM_OUTPUT_FORMAT + \
-              "&api_key=" + LASTFM_API_KEY + \
-              "&limit=" + str(MAX_EVENTS_PER_PAGE) + \
-              "&page=" + str(p+1)
-
-        print "Retrieving page #" + str(p+1)
-        content = urllib.urlopen(url).read()
-
-        # Add retrieved content of current page to merged content variable
-        content_merged.append(content)
-
-        # Write content to local file
-        output_file = output_dir + "/" + user + "_" + str(p+1) + "." + LASTFM_OUTPUT_FORMAT
-        file_out = open(output_file, 'w')
-        file_out.write(content)
-        file_out.close()
+    # Retrieve pages over a keep-alive connection; stop after the last page of the user
+    content_merged = Lastfm_Crawler.fetch_user_LEs(user, output_dir, LASTFM_API_KEY, MAX_PAGES, MAX_EVENTS_PER_PAGE,
+                                                   LASTFM_API_URL)
 
     # Return all content retrieved for given user
     return content_merged
@@ -137,100 +129,89 @@ def lastfm_api_call_getTopFans(artist_list):
 
 
 # ADDED THIS NEW FUNCTION
-# Function to call Last.fm API: Artist.getTopFans
+# Function to call Last.fm API: User.getFriends
 def lastfm_api_call_getFriends(user):
-    content_merged = []         # empty list
-    friend_list = []            # empty list
-
-    # Construct API call
-    url = LASTFM_API_URL + "?method=user.getfriends" + \
-        "&api_key=" + LASTFM_API_KEY + \
-        "&user=" + str(user) + \
-        "&format=" + LASTFM_OUTPUT_FORMAT
-
-    _content = urllib.urlopen(url).read()
-
-    # Add retrieved content of current page to merged content variable
-    content_merged.append(_content)
-    json_content = json.loads(_content)
-
-    if "friends" in json_content.keys():
-        for _friend in json_content["friends"]["user"]:
-            friend_list.append(_friend["name"].encode("utf-8"))
-
-    return friend_list
-
-def retrieve_listening_events(LEs, users):
-    # For all users, retrieve listening events
-    for u in range(0, MAX_LE):
-        print 'Fetching listening events for user #' + str(u+1) + ': ' + users[u] + ' ...'
-        content = lastfm_api_call_getLEs(users[u], OUTPUT_DIRECTORY + "/listening_events/")
-
-        # Parse retrieved JSON content
-        try:
-            # For all retrieved JSON pages of current user
-            for page in range(0, len(content)):
-                listening_events = json.loads(content[page])
-
-                # Get number of listening events in current JSON
-                no_items = len(listening_events["recenttracks"]["track"])
-
-                # Read artist, track names and time stamp for each listening event
-                for item in range(0, no_items):
-                    artist = listening_events["recenttracks"]["track"][item]["artist"]["#text"]
-                    track = listening_events["recenttracks"]["track"][item]["name"]
-                    time = listening_events["recenttracks"]["track"][item]["date"]["uts"]
-#                    print users[u], artist, track, time
-
-                    # Add listening event to aggregated list of LEs
-                    LEs.append([users[u], artist.encode('utf8'), track.encode('utf8'), str(time)])
-
-        except KeyError:                    # JSON tag not found
-            print "JSON tag not found!"
-            continue
+    return Lastfm_Crawler.fetch_friends(user, LASTFM_API_KEY, base_url=LASTFM_API_URL)
+
+
+# Function to find new users by breadth-first search in the friend graph of the given users, until MAX_LE users
+# are found. Users are fetched concurrently and never twice; an interrupted search resumes from FRONTIER_FILE.
+# It returns the names of the users found
+def retrieve_users(users):
+    state = Lastfm_Crawler.load_frontier(FRONTIER_FILE)
+    return Lastfm_Crawler.expand_friends(users, MAX_LE, LASTFM_API_KEY, base_url=LASTFM_API_URL, n_threads=N_THREADS,
+                                         rate=REQUESTS_PER_SECOND, state=state)
+
+# Function to fetch the listening events of the given users (at most MAX_LE).
+# It returns a list of (user, file) for all pages of listening events fetched by this and previous runs
+def retrieve_listening_events(users):
+    # Retrieve listening events of all users concurrently, limited to REQUESTS_PER_SECOND.
+    # Pages fetched by previous (interrupted) runs are skipped, for users crawled completely only new events are fetched
+    users = users[:MAX_LE]
+    path = OUTPUT_DIRECTORY + "/listening_events/"
+    manifest = Lastfm_Crawler.load_manifest(MANIFEST_FILE)
+    Lastfm_Crawler.fetch_LEs(users, path, LASTFM_API_KEY, MAX_PAGES, MAX_EVENTS_PER_PAGE, LASTFM_API_URL,
+                             N_THREADS, REQUESTS_PER_SECOND, manifest)
 
-    return LEs
+    return [(user, path + user_file) for user in users for user_file in Lastfm_Crawler.user_files(manifest, user)]
 
 
-def retrieve_listening_events_existing(LEs):
+# Function to list all pages of listening events already fetched to the listening_events folder.
+# It yields (user, file) for every page, ordered by user
+def retrieve_listening_events_existing():
     # get all listening event files
     path = OUTPUT_DIRECTORY + "/listening_events/"
-    files = [ f for f in listdir(path) if isfile(join(path,f)) ]
+    files = sorted([ f for f in listdir(path) if isfile(join(path,f)) ])
 
-    # prepare dictionario which holds a list of files with LE for each user
-    userFiles = dict()
     for file in files:
         user = str(file[:file.rfind("_")])
+        yield user, path + file
+
+
+# Function to parse a page of listening events (JSON file) of a user.
+# It returns the listening events as lines of the LE file (user, artist, track and time separated by tabs)
+def parse_listening_events(user_file):
+    user, file_name = user_file
+    with open(file_name, 'r') as lefile:
+        content = lefile.read()
+
+    try:
+        tracks = json.loads(content)["recenttracks"]["track"]
+    except ValueError:              # not JSON (e.g. an error or HTML page saved by the crawler), skipped
+        print "No JSON in " + file_name + ", skipped"
+        return ""
+    except (KeyError, TypeError):   # JSON tag not found
+        print "JSON tag not found!"
+        return ""
+    if isinstance(tracks, dict):    # single track
+        tracks = [tracks]
+
+    # Read artist, track names and time stamp for each listening event
+    lines = []
+    for track in tracks:
+        if "date" not in track:     # track currently playing, no listening event yet
+            continue
+        try:
+            lines.append(user + "\t" + track["artist"]["#text"].encode('utf8') + "\t" +
+                         track["name"].encode('utf8') + "\t" + str(track["date"]["uts"]) + "\n")
+        except (KeyError, TypeError, AttributeError):   # malformed track, skipped
+            continue
+    return "".join(lines)
 
-        if user not in userFiles:
-            userFiles[user] = []
-        userFiles[user].append(file)
-
-    # get merged LE for every user
-    for user in userFiles:
-        content = []
-        for userFile in userFiles[user]:
-            with open(path + userFile, 'r') as lefile:
-                listening_events = json.loads(lefile.read())
-
-                try:
-                    # Get number of listening events in current JSON
-                    no_items = len(listening_events["recenttracks"]["track"])
-
-                    # Read artist, track names and time stamp for each listening event
-                    for item in range(0, no_items):
-                        artist = listening_events["recenttracks"]["track"][item]["artist"]["#text"]
-                        track = listening_events["recenttracks"]["track"][item]["name"]
-                        time = listening_events["recenttracks"]["track"][item]["date"]["uts"]
-                        print user, artist, track, time
-
-                        # Add listening event to aggregated list of LEs
-                        LEs.append([user, artist.encode('utf8'), track.encode('utf8'), str(time)])
-                except KeyError:                # JSON tag not found
-                    print "JSON tag not found!"
-                    continue
 
-    return LEs
+# Function to parse the given pages of listening events by n_jobs processes (in this process if n_jobs is 1).
+# It yields the lines of every page in order of the pages, so that only few pages are held in memory at a time
+def stream_listening_events(user_files, n_jobs=N_JOBS):
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            for lines in pool.imap(parse_listening_events, user_files, CHUNK_SIZE):
+                yield lines
+        finally:
+            pool.terminate()
+    else:
+        for lines in itertools.imap(parse_listening_events, user_files):
+            yield lines
 
 
 # Main program
@@ -242,47 +223,38 @@ if __name__ == '__main__':
 
     # Read users from provided file
     users = read_users(USERS_FILE)
-    user_list = users
-    data = ""
 
     if (not os.path.exists(OUTPUT_FILE)) or GET_NEW_USERS:   # if you want to retrieve new users
-        # Find friends from existing users to receive more than 500 users
-        for _user in users:
-            print "fetching friends of " + _user.encode("utf-8")
-            user_list = lastfm_api_call_getFriends(_user)
-
-            for u in user_list:
-                data += u.encode("utf-8") + "\n"
-
-            print "finished " + _user.encode("utf-8")
-
-        if os.path.exists(OUTPUT_FILE):
-            shutil.rmtree(OUTPUT_FILE)
+        # Find friends (of friends) of existing users to receive more than 500 users
+        users = retrieve_users(users)
 
         # Write content to local file
-        file_out = open(OUTPUT_FILE, 'w')
-        file_out.write(data)
-        file_out.close()
-
-        users = read_users(OUTPUT_FILE)
+        with open(OUTPUT_FILE, 'w') as file_out:
+            file_out.write("".join([user + "\n" for user in users]))
     else:
         users = read_users(OUTPUT_FILE)
 
     print "\n"
 
-    # Create list to hold all listening events
-    LEs = []
-
+    # Get pages of listening events
     if USE_EXISTING_LE:
-        LEs = retrieve_listening_events_existing(LEs)
-        pass
+        user_files = retrieve_listening_events_existing()
     else:
-        LEs = retrieve_listening_events(LEs, users)
-        pass
-
+        user_files = retrieve_listening_events(users)
 
-    # Write retrieved listening events to text file
-    with open(LE_FILE, 'w') as outfile:             # "a" to append
-        outfile.write('user\tartist\ttrack\ttime\n')
-        for le in LEs:          # For all listening events
-            outfile.write(le[0] + "\t" + le[1] + "\t" + le[2] + "\t" + le[3] + "\n")
+    if LE_FORMAT == "store":
+        # Parse pages and add listening events to the store, which is written in chunks to a temporary directory
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(LE_STORE_FILE)))
+        try:
+            writer = LE_Store.create_writer(LE_STORE_FILE, tmp_dir)
+            for lines in stream_listening_events(user_files):   # For all pages
+                LE_Store.add_events(writer, lines)
+            print "Stored " + str(LE_Store.close_writer(writer)) + " listening events in " + LE_STORE_FILE
+        finally:
+            shutil.rmtree(tmp_dir)
+    else:
+        # Parse pages and write listening events to text file, page by page
+        with open(LE_FILE, 'w') as outfile:             # "a" to append
+            outfile.write('user\tartist\ttrack\ttime\n')
+            for lines in stream_listening_events(user_files):   # For all pages
+                outfile.write(lines)
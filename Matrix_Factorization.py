@@ -0,0 +1,158 @@
+# Implicit-feedback matrix factorization of the UAM by alternating least squares (ALS, Hu, Koren and Volinsky 2008):
+# playcounts are taken as confidence that a user prefers an artist, and user and artist factor matrices are fitted
+# so that their product approximates the binary preferences, weighted by confidence
+__author__ = 'mms'
+
+# Load required modules
+import os
+import time
+import multiprocessing
+import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+
+# Parameters
+UAM_FILE = "UAM.bin"                        # user-artist-matrix (UAM)
+FACTORS_FILE = "UAM_als.bin"                # user and artist factor matrices (binary format, see UAM_Storage)
+
+NO_FACTORS = 32             # number of latent factors
+ITERATIONS = 15             # number of ALS iterations (each solves for all users, then for all artists)
+REGULARIZATION = 0.1        # weight of the L2 regularization of the factors
+ALPHA = 10.0                # confidence: c = 1 + ALPHA * log(1 + r / EPSILON) for a (normalized) playcount r
+EPSILON = 0.01
+SEED = 1                    # seed of the random initialization of the factors
+N_JOBS = multiprocessing.cpu_count()    # number of worker processes solving blocks of rows (1: serially)
+BLOCK_SIZE = 1024           # number of rows solved per task of a worker
+
+
+# Function to compute the confidence weights of the non-zero playcounts of a sparse matrix.
+# It returns a sparse CSR matrix with c - 1 for every non-zero entry
+def confidence(UAM, alpha=ALPHA, epsilon=EPSILON):
+    C = sp.csr_matrix(UAM, dtype=np.float32)
+    C.eliminate_zeros()
+    C.data = (alpha * np.log1p(C.data / epsilon)).astype(np.float32)
+    return C
+
+
+# Function to solve the least squares problems of the given rows of the confidence matrix C for fixed factors Y:
+# x_u = (YtY + Yt (C_u - I) Y + reg * I)^-1 Yt C_u p_u. Only the non-zero entries of a row enter besides YtY.
+# It returns the factors of the rows as matrix of size |rows| * |factors|
+def solve_rows(C, Y, YtY, reg, start, end):
+    X = np.zeros(shape=(end - start, Y.shape[1]), dtype=np.float32)
+    reg_I = reg * np.eye(Y.shape[1])
+    for u in range(start, end):
+        idx = C.indices[C.indptr[u]:C.indptr[u+1]]
+        if len(idx) == 0:
+            continue
+        c = C.data[C.indptr[u]:C.indptr[u+1]].astype(np.float64)
+        Yu = Y[idx].astype(np.float64)
+        A = YtY + np.dot(Yu.T * c, Yu) + reg_I
+        b = np.dot(Yu.T, 1.0 + c)
+        X[u - start] = np.linalg.solve(A, b)
+    return X
+
+
+# Data of the solver in a worker process (see init_solver)
+solver_data = {}
+
+
+# Function to initialize a worker process of the solver with the confidence matrix and the fixed factors
+def init_solver(C, Y, YtY, reg):
+    solver_data.update({"C": C, "Y": Y, "YtY": YtY, "reg": reg})
+
+
+# Function to solve a block (start, end) of rows in a worker process
+def solve_block(block):
+    return solve_rows(solver_data["C"], solver_data["Y"], solver_data["YtY"], solver_data["reg"], block[0], block[1])
+
+
+# Function to solve for the factors of all rows of C, given the factors Y of the columns. YtY is computed once
+# by BLAS; the rows are solved in blocks by a pool of n_jobs worker processes (serially if n_jobs is 1).
+# It returns the factors of the rows
+def solve_all(C, Y, reg, n_jobs=N_JOBS, block_size=BLOCK_SIZE):
+    YtY = np.dot(Y.T.astype(np.float64), Y.astype(np.float64))
+    blocks = [(start, min(start + block_size, C.shape[0])) for start in range(0, C.shape[0], block_size)]
+    if n_jobs <= 1 or len(blocks) <= 1:
+        return np.vstack([solve_rows(C, Y, YtY, reg, start, end) for start, end in blocks])
+
+    pool = multiprocessing.Pool(n_jobs, init_solver, (C, Y, YtY, reg))
+    try:
+        return np.vstack(pool.map(solve_block, blocks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Function to factorize the UAM (dense or sparse) by implicit-feedback ALS.
+# It returns the user factors (|users| * no_factors) and the artist factors (|artists| * no_factors)
+def train_als(UAM, no_factors=NO_FACTORS, iterations=ITERATIONS, reg=REGULARIZATION, n_jobs=N_JOBS, seed=SEED):
+    C = confidence(UAM)
+    CT = C.T.tocsr()
+    rng = np.random.RandomState(seed)
+    user_factors = (0.01 * rng.standard_normal((C.shape[0], no_factors))).astype(np.float32)
+    artist_factors = (0.01 * rng.standard_normal((C.shape[1], no_factors))).astype(np.float32)
+
+    for i in range(0, iterations):
+        start = time.time()
+        user_factors = solve_all(C, artist_factors, reg, n_jobs)
+        artist_factors = solve_all(CT, user_factors, reg, n_jobs)
+        print "ALS iteration " + str(i + 1) + ": %.2fs" % (time.time() - start)
+    return user_factors, artist_factors
+
+
+# Function to compute the factors of a user from a (masked) playcount vector, with fixed artist factors ("fold-in"),
+# so that artists not in the vector (e.g. test artists) do not influence the recommendations.
+# factors is the dictionary returned by load_factors. It returns the user's factors
+def fold_in(factors, pc_vec):
+    C = confidence(np.atleast_2d(pc_vec))
+    return solve_rows(C, factors["artist_factors"], factors["YtY"], factors["reg"], 0, 1)[0]
+
+
+# Function to save the factor matrices. uam_hash is the content hash of the UAM they were trained on, fold identifies
+# the training matrix if it was derived from the UAM (e.g. [fold, no. folds] of a cross-validation)
+def save_factors(filename, user_factors, artist_factors, uam_hash=None, reg=REGULARIZATION, fold=None):
+    UAM_Storage.write_arrays(filename, {"user_factors": user_factors, "artist_factors": artist_factors},
+                             {"kind": "als_factors", "no_factors": int(user_factors.shape[1]), "reg": reg,
+                              "alpha": ALPHA, "epsilon": EPSILON, "iterations": ITERATIONS, "seed": SEED,
+                              "fold": fold, "uam_hash": uam_hash})
+
+
+# Function to load the factor matrices (memory-mapped). It returns a dictionary with the user and artist factors,
+# the precomputed Gram matrix of the artist factors (for fold_in) and the header
+def load_factors(filename, mmap=True):
+    arrays, header = UAM_Storage.read_arrays(filename, mmap)
+    artist_factors = np.asarray(arrays["artist_factors"])
+    return {"user_factors": arrays["user_factors"], "artist_factors": artist_factors,
+            "YtY": np.dot(artist_factors.T.astype(np.float64), artist_factors.astype(np.float64)),
+            "reg": header["reg"], "header": header}
+
+
+# Function to load the factor matrices for the given UAM file, or to train (and save) them if they do not exist
+# or were trained on a different UAM or with different parameters. If train_UAM is given, the factors are trained
+# on it instead of the UAM (e.g. the UAM without the test artists of a fold), identified by fold (see save_factors)
+def get_factors(UAM, uam_file, factors_file, no_factors=NO_FACTORS, train_UAM=None, fold=None):
+    uam_hash = UAM_Storage.content_hash(uam_file)
+    if os.path.exists(factors_file):
+        factors = load_factors(factors_file)
+        header = factors["header"]
+        if uam_hash is not None and header["uam_hash"] == uam_hash and header["no_factors"] == no_factors and \
+                header["reg"] == REGULARIZATION and header["alpha"] == ALPHA and header["epsilon"] == EPSILON and \
+                header.get("iterations") == ITERATIONS and header.get("seed") == SEED and header.get("fold") == fold:
+            return factors
+
+    user_factors, artist_factors = train_als(UAM if train_UAM is None else train_UAM, no_factors)
+    save_factors(factors_file, user_factors, artist_factors, uam_hash, fold=fold)
+    return load_factors(factors_file)
+
+
+# Main program
+if __name__ == '__main__':
+
+    # Load UAM (dense or sparse)
+    UAM = UAM_Storage.load_UAM(UAM_FILE)
+
+    # Train and save factor matrices
+    user_factors, artist_factors = train_als(UAM, NO_FACTORS)
+    save_factors(FACTORS_FILE, user_factors, artist_factors, UAM_Storage.content_hash(UAM_FILE))
+    print "Stored " + str(NO_FACTORS) + " factors of " + str(user_factors.shape[0]) + " users and " + \
+        str(artist_factors.shape[0]) + " artists in " + FACTORS_FILE
@@ -0,0 +1,209 @@
+# Precomputed top-K nearest neighbor index for user-based CF
+__author__ = 'mms'
+
+# Load required modules
+import os
+import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+
+# Parameters
+UAM_FILE = "UAM.bin"                        # user-artist-matrix (UAM)
+NEIGHBOR_INDEX_FILE = "UAM_neighbors.bin"   # top-K neighbor index (binary format, see UAM_Storage)
+
+K = 100                                     # number of nearest neighbors to store per user
+MEMORY_BUDGET = 256 * 1024 * 1024           # maximum number of bytes used for similarity blocks
+
+
+# Function to compute the similarities (inner products) between the given users and all users.
+# It returns a dense matrix of size |rows| * |users|
+def block_similarities(UAM, rows):
+    if sp.issparse(UAM):
+        return np.asarray((UAM[rows, :] * UAM.T).todense(), dtype=np.float32)
+    return np.dot(UAM[rows, :], UAM.T).astype(np.float32, copy=False)
+
+
+# Function to determine how many rows of similarities fit into the memory budget,
+# given the number of columns of each row
+def block_size(no_columns, memory_budget):
+    # similarity values, indices of argpartition and a temporary copy per row
+    bytes_per_row = 16 * max(no_columns, 1)
+    return max(1, int(memory_budget // bytes_per_row))
+
+
+# Function to determine the number of users per tile of build_neighbor_index_out_of_core that fit into the memory
+# budget, given the number of artists: two blocks of rows (4 bytes per value) and the similarities of a tile merged
+# with the current neighbor lists (about 24 bytes per value)
+def tile_size(no_artists, K, memory_budget):
+    b = 8.0 * no_artists + 24.0 * K
+    return max(1, int((-b + np.sqrt(b * b + 96.0 * memory_budget)) / 48.0))
+
+
+# Function to read the rows start to end of a (memory-mapped) UAM into memory
+def read_rows(UAM, start, end):
+    if sp.issparse(UAM):
+        return UAM[start:end, :]
+    return np.array(UAM[start:end, :])
+
+
+# Function to select the K largest similarities per row. If idx is None, the column index is taken as neighbor index.
+# It returns neighbor indices and similarities, both sorted by decreasing similarity
+def top_k(sim, K, idx=None):
+    if idx is None:
+        idx = np.broadcast_to(np.arange(sim.shape[1], dtype=np.int32), sim.shape)
+    rows = np.arange(sim.shape[0])[:, np.newaxis]
+
+    # Select (unordered) K largest entries per row, then sort only these
+    if K < sim.shape[1]:
+        part_idx = np.argpartition(-sim, K - 1, axis=1)[:, :K]
+    else:
+        part_idx = np.broadcast_to(np.arange(sim.shape[1]), sim.shape)
+    part_sim = sim[rows, part_idx]
+    sort_idx = np.argsort(-part_sim, axis=1, kind='mergesort')
+    part_idx = part_idx[rows, sort_idx]
+
+    return idx[rows, part_idx].astype(np.int32), sim[rows, part_idx].astype(np.float32)
+
+
+# Function to compute the top-K neighbors (excluding the user herself) of the given users (all users if None).
+# Similarities are computed in blocks of rows, so that at most memory_budget bytes are used per block.
+# A memory-mapped UAM larger than memory_budget is processed in tiles (see build_neighbor_index_out_of_core).
+# It returns neighbor indices and similarities, both of size |users| * K
+def build_neighbor_index(UAM, K, users=None, memory_budget=MEMORY_BUDGET):
+    no_users = UAM.shape[0]
+    K = min(K, no_users - 1)
+    if users is None:
+        users = np.arange(no_users)
+    users = np.asarray(users, dtype=np.int64)
+
+    if len(users) == no_users and isinstance(UAM, np.memmap) and UAM.nbytes > memory_budget:
+        return build_neighbor_index_out_of_core(UAM, K, memory_budget)
+
+    nn_idx = np.zeros(shape=(len(users), K), dtype=np.int32)
+    nn_sim = np.zeros(shape=(len(users), K), dtype=np.float32)
+
+    bs = block_size(no_users, memory_budget)
+    for start in range(0, len(users), bs):
+        block = users[start:start+bs]
+        sim = block_similarities(UAM, block)
+        # Exclude the user herself from her neighbors
+        sim[np.arange(len(block)), block] = -np.inf
+        nn_idx[start:start+bs], nn_sim[start:start+bs] = top_k(sim, K)
+
+    return nn_idx, nn_sim
+
+
+# Function to compute the top-K neighbors (excluding the user herself) of all users of a UAM larger than the memory
+# (memory-mapped, dense or sparse). Similarities are computed in tiles of block_rows * block_rows users (as many as fit
+# into memory_budget if None): for every block of rows, the blocks of columns are read one after another and the
+# neighbor lists of the rows are merged with the similarities of each tile, so that the UAM is read once per block
+# of rows. It returns neighbor indices and similarities, both of size |users| * K
+def build_neighbor_index_out_of_core(UAM, K, memory_budget=MEMORY_BUDGET, block_rows=None):
+    no_users = UAM.shape[0]
+    K = min(K, no_users - 1)
+    if block_rows is None:
+        block_rows = tile_size(UAM.shape[1], K, memory_budget)
+
+    nn_idx = np.zeros(shape=(no_users, K), dtype=np.int32)
+    nn_sim = np.zeros(shape=(no_users, K), dtype=np.float32)
+
+    for start in range(0, no_users, block_rows):
+        end = min(start + block_rows, no_users)
+        rows = read_rows(UAM, start, end)
+        best_idx = np.zeros(shape=(end - start, 0), dtype=np.int32)
+        best_sim = np.zeros(shape=(end - start, 0), dtype=np.float32)
+        for col_start in range(0, no_users, block_rows):
+            col_end = min(col_start + block_rows, no_users)
+            cols = rows if col_start == start else read_rows(UAM, col_start, col_end)
+            if sp.issparse(rows):
+                sim = np.asarray((rows * cols.T).todense(), dtype=np.float32)
+            else:
+                sim = np.dot(rows, cols.T).astype(np.float32, copy=False)
+            # Exclude the user herself from her neighbors
+            if col_start == start:
+                sim[np.arange(end - start), np.arange(end - start)] = -np.inf
+            del cols
+
+            # Merge the current neighbor lists with the tile
+            cand_sim = np.hstack([best_sim, sim])
+            cand_idx = np.hstack([best_idx, np.tile(np.arange(col_start, col_end, dtype=np.int32), (end - start, 1))])
+            del sim
+            best_idx, best_sim = top_k(cand_sim, min(K, cand_sim.shape[1]), cand_idx)
+        nn_idx[start:end], nn_sim[start:end] = best_idx, best_sim
+
+    return nn_idx, nn_sim
+
+
+# Function to update a neighbor index after the rows of the given users changed in the UAM.
+# Users appended to the UAM (more rows than in the index) are treated as changed.
+# Neighbor lists of changed users, and of users whose list contains a changed user, are recomputed;
+# all other lists are merged with the new similarities to the changed users.
+# It returns the updated neighbor indices and similarities
+def update_neighbor_index(UAM, nn_idx, nn_sim, changed_users, memory_budget=MEMORY_BUDGET):
+    no_users = UAM.shape[0]
+    K = nn_idx.shape[1]
+    no_indexed = nn_idx.shape[0]
+    changed = np.union1d(np.asarray(changed_users, dtype=np.int64), np.arange(no_indexed, no_users))
+
+    # Grow index for new users
+    nn_idx = np.vstack([nn_idx, np.zeros(shape=(no_users - no_indexed, K), dtype=np.int32)])
+    nn_sim = np.vstack([nn_sim, np.zeros(shape=(no_users - no_indexed, K), dtype=np.float32)])
+
+    # Users whose neighbor list contains a changed user need to be recomputed, as the similarity could have decreased
+    is_changed = np.zeros(no_users, dtype=np.bool_)
+    is_changed[changed] = True
+    stale = np.nonzero(np.any(is_changed[nn_idx], axis=1) & ~is_changed)[0]
+    recompute = np.union1d(changed, stale)
+    others = np.setdiff1d(np.arange(no_users), recompute)
+
+    # Merge similarities to changed users into the lists of all other users (similarities are symmetric)
+    bs = block_size(no_users + len(others), memory_budget)
+    for start in range(0, len(changed), bs):
+        block = changed[start:start+bs]
+        sim = block_similarities(UAM, block)
+        cand_sim = np.hstack([nn_sim[others], sim[:, others].T])
+        cand_idx = np.hstack([nn_idx[others], np.tile(block.astype(np.int32), (len(others), 1))])
+        nn_idx[others], nn_sim[others] = top_k(cand_sim, K, cand_idx)
+
+    # Recompute lists of changed and stale users
+    nn_idx[recompute], nn_sim[recompute] = build_neighbor_index(UAM, K, recompute, memory_budget)
+
+    return nn_idx, nn_sim
+
+
+# Function to save a neighbor index. uam_hash is the content hash of the UAM the index was built from
+def save_neighbor_index(filename, nn_idx, nn_sim, uam_hash=None):
+    UAM_Storage.write_arrays(filename, {"nn_idx": nn_idx, "nn_sim": nn_sim},
+                             {"kind": "neighbor_index", "K": int(nn_idx.shape[1]), "uam_hash": uam_hash})
+
+
+# Function to load a neighbor index. It returns neighbor indices, similarities and the hash of the UAM it was built from
+def load_neighbor_index(filename, mmap=True):
+    arrays, header = UAM_Storage.read_arrays(filename, mmap)
+    return arrays["nn_idx"], arrays["nn_sim"], header["uam_hash"]
+
+
+# Function to load the neighbor index for the given UAM file, or to build (and save) it if it does not exist,
+# was built from a different UAM or holds less than K neighbors per user
+def get_neighbor_index(UAM, uam_file, index_file, K, memory_budget=MEMORY_BUDGET):
+    uam_hash = UAM_Storage.content_hash(uam_file)
+    if os.path.exists(index_file):
+        nn_idx, nn_sim, index_hash = load_neighbor_index(index_file)
+        if uam_hash is not None and index_hash == uam_hash and nn_idx.shape[1] >= min(K, UAM.shape[0] - 1):
+            return nn_idx[:, :K], nn_sim[:, :K]
+
+    nn_idx, nn_sim = build_neighbor_index(UAM, K, memory_budget=memory_budget)
+    save_neighbor_index(index_file, nn_idx, nn_sim, uam_hash)
+    return nn_idx, nn_sim
+
+
+# Main program
+if __name__ == '__main__':
+
+    # Load UAM (dense or sparse)
+    UAM = UAM_Storage.load_UAM(UAM_FILE)
+
+    # Build and save neighbor index
+    nn_idx, nn_sim = build_neighbor_index(UAM, K)
+    save_neighbor_index(NEIGHBOR_INDEX_FILE, nn_idx, nn_sim, UAM_Storage.content_hash(UAM_FILE))
+    print "Stored " + str(nn_idx.shape[1]) + " neighbors for " + str(nn_idx.shape[0]) + " users in " + NEIGHBOR_INDEX_FILE
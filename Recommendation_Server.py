@@ -0,0 +1,300 @@
+# Long-running recommendation service: loads the UAM and the precomputed neighbor index (or artist-artist similarity
+# matrix) once and answers requests for the top-N artists of a user over a local HTTP API. Concurrent requests are
+# collected into batches that are scored by one matrix product, and recent results are kept in an LRU cache
+__author__ = 'mms'
+
+# Load required modules
+import json
+import time
+import signal
+import urlparse
+import threading
+import collections
+import Queue
+import SocketServer
+import BaseHTTPServer
+import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+import Neighbor_Index
+import Item_Similarity
+import Evaluate_Recommender
+
+# Parameters
+UAM_FILE = "UAM.bin"                        # user-artist-matrix (UAM)
+ARTISTS_FILE = "UAM_artists.txt"            # artist names for UAM (if not stored in the binary UAM)
+USERS_FILE = "UAM_users.txt"                # user names for UAM (if not stored in the binary UAM)
+NEIGHBOR_INDEX_FILE = "UAM_neighbors.bin"   # precomputed top-K neighbor index (see Neighbor_Index)
+ITEM_SIM_FILE = "UAM_item_sim.bin"          # artist-artist similarity matrix (see Item_Similarity)
+
+RECOMMENDER = "CF"          # "CF" (user-based, neighbor index) or "IB" (item-based, artist-artist similarities)
+K = 10                      # number of neighbors of the user-based recommender
+N = 10                      # default number of artists to recommend
+MAX_N = 1000                # maximum number of artists a request can ask for
+
+HOST = "127.0.0.1"          # address to listen on (local only)
+PORT = 8080                 # port to listen on
+MAX_BATCH = 256             # maximum number of requests scored at once
+BATCH_WINDOW = 0.002        # seconds to wait for further requests after the first request of a batch
+CACHE_SIZE = 10000          # number of results kept in the LRU cache (0: no cache)
+LATENCY_WINDOW = 10000      # number of most recent requests the latency percentiles are computed from
+
+
+# State of the service, shared by the request threads and the batching thread
+model = None                                # current model (see load_model)
+model_lock = threading.Lock()               # held while the model is replaced
+requests = Queue.Queue()                    # pending requests, scored by the batching thread
+cache = collections.OrderedDict()           # (user index, N) -> result, least recently used first
+cache_lock = threading.Lock()
+stats_lock = threading.Lock()
+stats = {"requests": 0, "cache_hits": 0, "batches": 0, "batched_requests": 0, "reloads": 0}
+latencies = collections.deque(maxlen=LATENCY_WINDOW)    # latencies (seconds) of the most recent requests
+
+
+# Function to load the model of the service: the UAM (memory-mapped), user and artist names, and the neighbor index
+# or the artist-artist similarity matrix (built if it does not exist or is outdated).
+# It returns the model as dictionary
+def load_model(recommender=RECOMMENDER):
+    UAM, users, artists = UAM_Storage.load_data(UAM_FILE, USERS_FILE, ARTISTS_FILE, dense=False)
+    loaded = {"UAM": UAM, "users": users, "artists": artists, "recommender": recommender,
+              "user_idx": dict((user, u) for u, user in enumerate(users))}
+    if recommender == "IB":
+        loaded["item_sim"] = Item_Similarity.get_item_similarity(UAM, UAM_FILE, ITEM_SIM_FILE)
+    else:
+        nn_idx, nn_sim = Neighbor_Index.get_neighbor_index(UAM, UAM_FILE, NEIGHBOR_INDEX_FILE, K)
+        loaded["nn_idx"] = np.asarray(nn_idx)
+        loaded["nn_sim"] = np.asarray(nn_sim)
+    return loaded
+
+
+# Function to score all artists for a batch of users by one matrix product: for the user-based recommender, the
+# similarity-weighted indicator matrix of the users' neighbors (users x users) times the UAM; for the item-based
+# recommender, the users' playcount vectors times the artist-artist similarities. Artists a user listened to are excluded.
+# It returns a list with the indices and scores of the N highest scored artists for each user
+def recommend_batch(model, uidx, N=N):
+    uidx = np.asarray(uidx, dtype=np.int64)
+    UAM = model["UAM"]
+    if model["recommender"] == "IB":
+        pc_vecs = UAM[uidx, :].toarray() if sp.issparse(UAM) else np.asarray(UAM[uidx, :])
+        scores = Item_Similarity.score_artists(model["item_sim"], pc_vecs)
+    else:
+        nn_idx = model["nn_idx"][uidx]
+        nn_sim = model["nn_sim"][uidx]
+        neighbors = sp.csr_matrix((nn_sim.ravel(), nn_idx.ravel(),
+                                   np.arange(0, nn_idx.size + 1, nn_idx.shape[1])), shape=(len(uidx), UAM.shape[0]))
+        scores = (neighbors * UAM).toarray() if sp.issparse(UAM) else neighbors.dot(UAM).astype(np.float32)
+
+    # Exclude artists the users listened to
+    if sp.issparse(UAM):
+        listened = UAM[uidx, :].tocoo()
+        scores[listened.row, listened.col] = 0.0
+    else:
+        scores[np.asarray(UAM[uidx, :]) != 0] = 0.0
+    return [Evaluate_Recommender.top_n_artists(scores[i], N) for i in range(0, len(uidx))]
+
+
+# Function to look up a result in the LRU cache (None if not cached), marking it as most recently used.
+# The cache only holds results of the current model, so nothing is returned for a model that was replaced
+def cache_get(key, from_model):
+    with cache_lock:
+        if from_model is not model:
+            return None
+        result = cache.pop(key, None)
+        if result is not None:
+            cache[key] = result
+        return result
+
+
+# Function to add a result to the LRU cache, evicting the least recently used results. Results computed with
+# a model that was replaced meanwhile are not added
+def cache_put(key, result, from_model):
+    if CACHE_SIZE <= 0:
+        return
+    with cache_lock:
+        if from_model is not model:
+            return
+        cache[key] = result
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+# Function run by the batching thread: takes the first pending request, waits up to BATCH_WINDOW seconds for further
+# requests (at most MAX_BATCH), scores them by one call of recommend_batch per model (the model a request was
+# resolved with, which differs from the current model after a reload) and hands the results back
+def batch_requests():
+    while True:
+        batch = [requests.get()]
+        deadline = time.time() + BATCH_WINDOW
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(requests.get(timeout=max(0.0, deadline - time.time())))
+            except Queue.Empty:
+                break
+
+        # Group requests by model, in order of their arrival
+        groups = collections.OrderedDict()
+        for request in batch:
+            groups.setdefault(id(request["model"]), []).append(request)
+
+        for group in groups.values():
+            from_model = group[0]["model"]
+            try:
+                results = recommend_batch(from_model, [request["user"] for request in group],
+                                          max([request["N"] for request in group]))
+            except Exception as e:
+                results = [e] * len(group)
+            with stats_lock:
+                stats["batches"] += 1
+                stats["batched_requests"] += len(group)
+
+            for request, result in zip(group, results):
+                if not isinstance(result, Exception):
+                    result = (result[0][:request["N"]], result[1][:request["N"]])
+                    cache_put((request["user"], request["N"]), result, from_model)
+                request["result"] = result
+                request["done"].set()
+
+
+# Function to get the top-N artists of a user (by index in the given model), from the cache or by queueing a request
+# for the batching thread and waiting for its result. It returns the indices and scores of the artists, and whether
+# they were cached
+def get_recommendations(current, u, n):
+    result = cache_get((u, n), current)
+    if result is not None:
+        with stats_lock:
+            stats["cache_hits"] += 1
+        return result, True
+
+    request = {"model": current, "user": u, "N": n, "result": None, "done": threading.Event()}
+    requests.put(request)
+    request["done"].wait()
+    if isinstance(request["result"], Exception):
+        raise request["result"]
+    return request["result"], False
+
+
+# Function to reload the model (e.g. after the UAM or the indices were rebuilt) and to clear the cache
+def reload_model():
+    global model
+    with model_lock:
+        loaded = load_model()
+        with cache_lock:
+            model = loaded
+            cache.clear()
+        with stats_lock:
+            stats["reloads"] += 1
+
+
+# Function to compute the statistics of the service, including latency percentiles (ms) of the recent requests.
+# It returns the statistics as dictionary
+def get_stats():
+    with stats_lock:
+        recent = np.array(latencies) * 1000.0
+        result = dict(stats)
+    result.update({"cache_size": len(cache), "users": len(model["users"]), "artists": len(model["artists"]),
+                   "mean_batch_size": float(stats["batched_requests"]) / max(stats["batches"], 1),
+                   "latency_p50_ms": float(np.percentile(recent, 50)) if len(recent) > 0 else None,
+                   "latency_p99_ms": float(np.percentile(recent, 99)) if len(recent) > 0 else None})
+    return result
+
+
+# HTTP server handling every request in its own thread
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+# Handler of the HTTP API:
+#   GET  /recommend?user=<name or index>&n=<N>   top-N artists of the user (JSON)
+#   GET  /stats                                  request counts, cache hits, batch sizes and p50/p99 latency (JSON)
+#   POST /reload                                 reload the model from disk and clear the cache
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"       # keep-alive connections
+
+    def send_json(self, status, content):
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = urlparse.parse_qs(url.query)
+        if url.path == "/stats":
+            self.send_json(200, get_stats())
+            return
+        if url.path != "/recommend":
+            self.send_json(404, {"error": "unknown path " + url.path})
+            return
+
+        start = time.time()
+        current = model
+        user = params.get("user", [""])[0]
+        u = current["user_idx"].get(user)
+        if u is None and user.isdigit() and int(user) < len(current["users"]):
+            u = int(user)
+        if u is None:
+            self.send_json(404, {"error": "unknown user " + user})
+            return
+        try:
+            n = int(params.get("n", [N])[0])
+        except ValueError:
+            n = 0
+        if n < 1 or n > MAX_N:
+            self.send_json(400, {"error": "n must be between 1 and " + str(MAX_N)})
+            return
+
+        try:
+            (rec_aidx, rec_scores), cached = get_recommendations(current, u, n)
+        except Exception as e:
+            self.send_json(500, {"error": "recommendation failed: " + str(e)})
+            return
+        self.send_json(200, {"user": current["users"][u], "cached": cached,
+                             "artists": [{"artist": current["artists"][a], "index": int(a), "score": float(s)}
+                                         for a, s in zip(rec_aidx, rec_scores)]})
+        with stats_lock:
+            stats["requests"] += 1
+            latencies.append(time.time() - start)
+
+    def do_POST(self):
+        if urlparse.urlsplit(self.path).path != "/reload":
+            self.send_json(404, {"error": "unknown path " + self.path})
+            return
+        reload_model()
+        self.send_json(200, {"reloaded": True, "users": len(model["users"]), "artists": len(model["artists"])})
+
+    def log_message(self, format, *args):
+        pass                            # no output per request
+
+
+# Main program
+if __name__ == '__main__':
+
+    # Load UAM and index once
+    reload_model()
+    print "Loaded UAM of " + str(len(model["users"])) + " users and " + str(len(model["artists"])) + " artists"
+
+    # Start batching thread
+    batcher = threading.Thread(target=batch_requests)
+    batcher.daemon = True
+    batcher.start()
+
+    # Reload the model on SIGHUP
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload_model).start())
+
+    server = ThreadingHTTPServer((HOST, PORT), RequestHandler)
+    print "Serving " + RECOMMENDER + " recommendations on http://" + HOST + ":" + str(PORT) + "/recommend?user=<user>"
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+    # Output latency and cache statistics
+    service_stats = get_stats()
+    if service_stats["latency_p50_ms"] is not None:
+        print "Requests: %d, cache hits: %d, mean batch size: %.1f, latency p50: %.2f ms, p99: %.2f ms" % (
+            service_stats["requests"], service_stats["cache_hits"], service_stats["mean_batch_size"],
+            service_stats["latency_p50_ms"], service_stats["latency_p99_ms"])
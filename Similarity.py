@@ -0,0 +1,170 @@
+# Similarity measures between playcount vectors and the users of a UAM (dense or sparse) for user-based CF:
+# inner product, cosine and Pearson correlation (vectorized with precomputed row statistics), and Jaccard
+# coefficient of the listened artists (rows stored as packed bitsets, intersections counted by popcount)
+__author__ = 'mms'
+
+# Load required modules
+import os
+import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+import UAM_Blocks
+
+# Parameters
+MEASURE = "inner"                   # "inner", "cosine", "pearson" or "jaccard"
+MEMORY_BUDGET = 64 * 1024 * 1024    # maximum number of bytes of a block of bitsets intersected or rows summed at once
+
+# Number of bits set in every 16-bit word
+POPCOUNT = np.array([bin(i).count("1") for i in range(0, 65536)], dtype=np.uint8)
+
+
+# Function to compute the sum and the sum of squares of every row of a matrix (dense or sparse), block by block
+# (see UAM_Blocks), so that a memory-mapped UAM is not copied
+def row_sums(M, memory_budget=MEMORY_BUDGET):
+    sums = np.zeros(M.shape[0])
+    squares = np.zeros(M.shape[0])
+    rows = UAM_Blocks.block_rows(M, 16, memory_budget)     # block as float64 and its squares
+    for start in range(0, M.shape[0], rows):
+        block = M[start:start+rows, :]
+        if sp.issparse(block):
+            sums[start:start+rows] = np.asarray(block.sum(axis=1), dtype=np.float64).ravel()
+            squares[start:start+rows] = np.asarray(block.multiply(block).sum(axis=1), dtype=np.float64).ravel()
+        else:
+            block = np.asarray(block, dtype=np.float64)
+            sums[start:start+rows] = np.sum(block, axis=1)
+            squares[start:start+rows] = np.sum(block * block, axis=1)
+    return sums, squares
+
+
+# Function to pack the binary rows (listened to or not) of a matrix (dense or sparse) into bitsets of 16-bit words.
+# It returns a matrix of size |rows| * ceil(|columns| / 16)
+def pack_rows(M, block=1024):
+    no_words = (M.shape[1] + 15) // 16
+    bits = np.zeros(shape=(M.shape[0], 2 * no_words), dtype=np.uint8)
+    for start in range(0, M.shape[0], block):
+        rows = M[start:start+block, :]
+        rows = rows.toarray() if sp.issparse(rows) else np.asarray(rows)
+        packed = np.packbits(rows != 0, axis=1)
+        bits[start:start+block, :packed.shape[1]] = packed
+    return bits.view(np.uint16)
+
+
+# Function to count the bits set in every row of a matrix of bitsets (see pack_rows), block by block
+def bit_counts(bits, block=1024):
+    counts = np.zeros(bits.shape[0], dtype=np.int64)
+    for start in range(0, bits.shape[0], block):
+        counts[start:start+block] = np.sum(POPCOUNT[bits[start:start+block]], axis=1, dtype=np.int64)
+    return counts
+
+
+# Function to precompute what a similarity measure needs of the UAM: row norms (cosine), row means and
+# standard deviations (Pearson), or bitsets and numbers of listened artists (Jaccard).
+# It returns the similarity model as dictionary
+def prepare(UAM, measure=MEASURE):
+    sim_model = {"measure": measure}
+    if measure == "cosine":
+        sums, squares = row_sums(UAM)
+        sim_model["norms"] = np.sqrt(squares)
+    elif measure == "pearson":
+        sums, squares = row_sums(UAM)
+        sim_model["means"] = sums / UAM.shape[1]
+        sim_model["deviations"] = np.sqrt(np.maximum(squares - sums * sim_model["means"], 0.0))
+    elif measure == "jaccard":
+        sim_model["bits"] = pack_rows(UAM)
+        sim_model["counts"] = bit_counts(sim_model["bits"])
+    elif measure != "inner":
+        raise ValueError("unknown similarity measure " + measure)
+    return sim_model
+
+
+# Function to save a similarity model (see prepare). uam_hash is the content hash of the UAM it was computed from
+def save_sim_model(filename, sim_model, uam_hash=None):
+    arrays = dict((name, sim_model[name]) for name in sim_model if name != "measure")
+    UAM_Storage.write_arrays(filename, arrays, {"kind": "similarity_model", "measure": sim_model["measure"],
+                                                "uam_hash": uam_hash})
+
+
+# Function to load a similarity model (memory-mapped). It returns the model and the header (with hash of the UAM)
+def load_sim_model(filename, mmap=True):
+    arrays, header = UAM_Storage.read_arrays(filename, mmap)
+    sim_model = dict(arrays)
+    sim_model["measure"] = header["measure"]
+    return sim_model, header
+
+
+# Function to load the similarity model for the given UAM file, or to compute (and save) it if it does not exist
+# or was computed from a different UAM or for a different measure
+def get_sim_model(UAM, uam_file, model_file, measure=MEASURE):
+    uam_hash = UAM_Storage.content_hash(uam_file)
+    if os.path.exists(model_file):
+        sim_model, header = load_sim_model(model_file)
+        if uam_hash is not None and header["uam_hash"] == uam_hash and header["measure"] == measure:
+            return sim_model
+
+    sim_model = prepare(UAM, measure)
+    save_sim_model(model_file, sim_model, uam_hash)
+    return sim_model
+
+
+# Function to divide by an array, giving 0 where the divisor is 0
+def safe_divide(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b > 0, a / np.where(b > 0, b, 1.0), 0.0)
+
+
+# Function to compute the Jaccard coefficients between the bitsets of queries and of the given users, in blocks of
+# users. It returns a matrix of size |queries| * |users|
+def jaccard(sim_model, query_bits, query_counts, users, memory_budget=MEMORY_BUDGET):
+    bits = sim_model["bits"]
+    counts = sim_model["counts"][users]
+    common = np.zeros(shape=(len(query_bits), len(users)), dtype=np.float32)
+    block = max(1, memory_budget // (3 * bits.itemsize * max(bits.shape[1], 1)))
+    for start in range(0, len(users), block):
+        user_bits = bits[users[start:start+block]]
+        for q in range(0, len(query_bits)):
+            common[q, start:start+block] = np.sum(POPCOUNT[user_bits & query_bits[q]], axis=1, dtype=np.int64)
+    return safe_divide(common, query_counts[:, np.newaxis] + counts[np.newaxis, :] - common).astype(np.float32)
+
+
+# Function to compute the similarities between playcount vectors (one per row of vecs) and the given users
+# (all users if None), by the measure of the similarity model (see prepare).
+# It returns a dense matrix of size |vecs| * |users|
+def similarities(sim_model, UAM, vecs, users=None):
+    vecs = np.atleast_2d(vecs)
+    users = np.arange(UAM.shape[0]) if users is None else np.asarray(users, dtype=np.int64)
+    measure = sim_model["measure"]
+
+    if measure == "jaccard":
+        return jaccard(sim_model, pack_rows(vecs), np.count_nonzero(vecs, axis=1), users)
+
+    rows = UAM if len(users) == UAM.shape[0] else UAM[users, :]
+    if sp.issparse(rows):
+        dots = np.asarray((rows * vecs.T).T, dtype=np.float64)
+    else:
+        dots = np.dot(vecs, np.asarray(rows).T).astype(np.float64)
+
+    if measure == "cosine":
+        norms = np.sqrt(np.sum(vecs * vecs, axis=1, dtype=np.float64))
+        return safe_divide(dots, norms[:, np.newaxis] * sim_model["norms"][users]).astype(np.float32)
+    elif measure == "pearson":
+        # covariance = x.y - n * mean(x) * mean(y), without centring the (sparse) rows
+        n = UAM.shape[1]
+        sums, squares = row_sums(vecs)
+        means = sums / n
+        deviations = np.sqrt(np.maximum(squares - sums * means, 0.0))
+        cov = dots - n * means[:, np.newaxis] * sim_model["means"][users]
+        return safe_divide(cov, deviations[:, np.newaxis] * sim_model["deviations"][users]).astype(np.float32)
+    return dots.astype(np.float32)
+
+
+# Function to compute the similarity of every playcount vector (one per row of vecs) to itself.
+# It returns an array of size |vecs|
+def self_similarity(sim_model, vecs):
+    vecs = np.atleast_2d(vecs)
+    if sim_model["measure"] == "inner":
+        return np.sum(vecs * vecs, axis=1)
+    # Cosine, Pearson and Jaccard are 1 for every vector with non-zero norm (deviation for Pearson)
+    sums, squares = row_sums(vecs)
+    if sim_model["measure"] == "pearson":
+        return (squares - sums * sums / vecs.shape[1] > 0).astype(np.float32)
+    return (squares > 0).astype(np.float32)
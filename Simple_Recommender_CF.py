@@ -2,27 +2,26 @@
 __author__ = 'mms'
 
 # Load required modules
-import csv
 import numpy as np
+import UAM_Storage
+import Neighbor_Index
+import ANN_Index
+import Similarity
+import Instrumentation
 
 
 # Parameters
-UAM_FILE = "UAM.txt"                    # user-artist-matrix (UAM)
+UAM_FILE = "UAM.bin"                    # user-artist-matrix (UAM)
 ARTISTS_FILE = "UAM_artists.txt"        # artist names for UAM
 USERS_FILE = "UAM_users.txt"            # user names for UAM
+NEIGHBOR_INDEX_FILE = "UAM_neighbors.bin"   # precomputed top-K neighbor index (see Neighbor_Index)
+LSH_INDEX_FILE = "UAM_lsh.bin"          # LSH index for approximate neighbor search (see ANN_Index)
 
-
-# Function to read metadata (users or artists)
-def read_from_file(filename):
-    data = []
-    with open(filename, 'r') as f:                  # open file for reading
-        reader = csv.reader(f, delimiter='\t')      # create reader
-        headers = reader.next()                     # skip header
-        for row in reader:
-            item = row[0]
-            data.append(item)
-    f.close()
-    return data
+NEIGHBOR_SEARCH = "index"               # "exact" (all users), "index" (precomputed top-K index) or "lsh" (approximate)
+K = 1                                   # number of neighbors to look up in the index
+SIMILARITY = "inner"                    # similarity of users for exact search: "inner", "cosine", "pearson" or "jaccard"
+QUIET = False                           # set to True to switch off the output for every user
+REPORT = True                           # output time spent per stage at the end (see Instrumentation)
 
 
 # Main program
@@ -32,29 +31,58 @@ if __name__ == '__main__':
     artists = []            # artists
     users = []              # users
 
-    # Load metadata from provided files into lists
-    artists = read_from_file(ARTISTS_FILE)
-    users = read_from_file(USERS_FILE)
+    # The neighbor index and the LSH index rank neighbors by inner product; other measures need exact search
+    if SIMILARITY != "inner" and NEIGHBOR_SEARCH != "exact":
+        raise ValueError("similarity measure " + SIMILARITY + " requires NEIGHBOR_SEARCH = \"exact\"")
+
+    # Load UAM and metadata (artists and users)
+    UAM, users, artists = UAM_Storage.load_data(UAM_FILE, USERS_FILE, ARTISTS_FILE)
 
-    # Load UAM
-    UAM = np.loadtxt(UAM_FILE, delimiter='\t', dtype=np.float32)
+    # Load the top-K neighbor index, or build it if it does not exist or is outdated
+    if NEIGHBOR_SEARCH == "index":
+        nn_idx, nn_sim = Neighbor_Index.get_neighbor_index(UAM, UAM_FILE, NEIGHBOR_INDEX_FILE, K)
+    # Load the LSH index, or build it if it does not exist or is outdated
+    elif NEIGHBOR_SEARCH == "lsh":
+        lsh_index = ANN_Index.get_lsh_index(UAM, UAM_FILE, LSH_INDEX_FILE)
+    # Precompute row statistics or bitsets of the similarity measure
+    elif SIMILARITY != "inner":
+        sim_model = Similarity.prepare(UAM, SIMILARITY)
 
     # For all users
     for u in range(0, UAM.shape[0]):
-        # get (normalized) playcount vector for current user u
-        pc_vec = UAM[u, :]
-
-        # Compute similarities as inner product between playcount vector of user and all users via UAM (assuming that UAM is already normalized)
-        sim_users = np.inner(pc_vec, UAM)     # similarities between u and other users
-        print sim_users
-
-        # Sort similarities of seed user to all others
-        sort_idx = np.argsort(sim_users)        # sort in ascending order
-
-        # Select the closest neighbor to seed user u (which is the last but one; last one is user u herself!)
-        neighbor_idx = sort_idx[-2:-1][0]
-        print "The closest user to user " + str(u) + " is " + str(neighbor_idx) + "."
-        print "The closest user to user " + users[u] + " is user " + users[neighbor_idx] + "."
+        if NEIGHBOR_SEARCH == "index":
+            # Look up the closest neighbor to seed user u in the index (sorted by decreasing similarity)
+            neighbor_idx = nn_idx[u, 0]
+        elif NEIGHBOR_SEARCH == "lsh":
+            # Search the (approximately) closest neighbor to seed user u among the candidates in her LSH buckets
+            lsh_neighbors, lsh_sim = ANN_Index.query_lsh(lsh_index, UAM, UAM[u, :], 1, [u])[0]
+            if len(lsh_neighbors) == 0:
+                print "No neighbor found for user " + str(u) + "."
+                continue
+            neighbor_idx = lsh_neighbors[0]
+        else:
+            # get (normalized) playcount vector for current user u
+            pc_vec = UAM[u, :]
+
+            # Compute similarities as inner product between playcount vector of user and all users via UAM (assuming that UAM is already normalized),
+            # or by the selected measure (see Similarity)
+            with Instrumentation.timer("similarity"):
+                if SIMILARITY == "inner":
+                    sim_users = np.inner(pc_vec, UAM)     # similarities between u and other users
+                else:
+                    sim_users = Similarity.similarities(sim_model, UAM, pc_vec)[0]
+            if not QUIET:
+                print sim_users
+
+            # Sort similarities of seed user to all others
+            with Instrumentation.timer("neighbor selection"):
+                sort_idx = np.argsort(sim_users)        # sort in ascending order
+
+            # Select the closest neighbor to seed user u (which is the last but one; last one is user u herself!)
+            neighbor_idx = sort_idx[-2:-1][0]
+        if not QUIET:
+            print "The closest user to user " + str(u) + " is " + str(neighbor_idx) + "."
+            print "The closest user to user " + users[u] + " is user " + users[neighbor_idx] + "."
 
         # Get artist indices user u and her closest neighbor listened to, i.e., element with non-zero entries in UAM
         artist_idx_u = np.nonzero(UAM[u, :])                 # indices of artists user u listened to
@@ -65,11 +93,18 @@ if __name__ == '__main__':
         # These artists can be recommended to u.
 
         # np.nonzero returns a tuple of arrays, so we need to take the first element only when computing the set difference
-        recommended_artists_idx = np.setdiff1d(artist_idx_n[0], artist_idx_u[0])
+        with Instrumentation.timer("candidate union"):
+            recommended_artists_idx = np.setdiff1d(artist_idx_n[0], artist_idx_u[0])
+        Instrumentation.count("candidates per query", len(recommended_artists_idx))
         # or alternatively, convert to a numpy array by ...
         # artist_idx_n.arrnp.setdiff1d(np.array(artist_idx_n), np.array(artist_idx_u))
 
 
         # Output recommendations (artists)
         artists_array = np.asarray(artists)     # convert list of artists to array of artists (for convenient indexing)
-        print "Names of the " + str(len(recommended_artists_idx)) + " recommended artists: ", artists_array[recommended_artists_idx]
\ No newline at end of file
+        if not QUIET:
+            print "Names of the " + str(len(recommended_artists_idx)) + " recommended artists: ", artists_array[recommended_artists_idx]
+
+    # Output time spent per stage and counters
+    if REPORT:
+        print Instrumentation.report()
\ No newline at end of file
@@ -0,0 +1,123 @@
+# Out-of-core processing of (memory-mapped) UAMs larger than the memory: row normalization, column statistics and
+# the top-K neighbor index are computed in blocks of rows, so that the memory used stays within a fixed budget
+__author__ = 'mms'
+
+# Load required modules
+import numpy as np
+import scipy.sparse as sp
+import UAM_Storage
+import Neighbor_Index
+
+# Parameters
+COUNTS_FILE = "UAM_counts.bin"              # playcounts (dense or sparse), normalized to UAM_FILE if NORMALIZE is set
+UAM_FILE = "UAM.bin"                        # user-artist-matrix (UAM)
+NEIGHBOR_INDEX_FILE = "UAM_neighbors.bin"   # top-K neighbor index (see Neighbor_Index)
+
+NORMALIZE = False           # set to True to normalize the playcounts of COUNTS_FILE before building the index
+K = 100                     # number of nearest neighbors to store per user
+MEMORY_BUDGET = 256 * 1024 * 1024   # maximum number of bytes used for the blocks of rows
+BLOCK_ROWS = None           # number of rows per block (None: as many as fit into MEMORY_BUDGET)
+
+
+# Function to determine how many rows of a UAM fit into the memory budget, given the number of bytes used per value
+# of a row (a dense row has |artists| values, a sparse row the mean number of non-zero values)
+def block_rows(UAM, bytes_per_value, memory_budget=MEMORY_BUDGET):
+    if sp.issparse(UAM):
+        values_per_row = float(UAM.nnz) / max(UAM.shape[0], 1)
+    else:
+        values_per_row = UAM.shape[1]
+    return max(1, int(memory_budget // (bytes_per_value * max(values_per_row, 1))))
+
+
+# Function to normalize the rows of a dense or sparse (CSR) UAM to sum 1, block by block. The normalized values are
+# written to out, a dense array or the data array of a CSR matrix (the same as the UAM's to normalize in place).
+# It returns the sums of the rows before normalization
+def normalize_rows(UAM, out, rows=None, memory_budget=MEMORY_BUDGET):
+    rows = rows or block_rows(UAM, 12, memory_budget)     # block (float32), sums and quotients
+    sums = np.zeros(UAM.shape[0], dtype=np.float32)
+    for start in range(0, UAM.shape[0], rows):
+        end = min(start + rows, UAM.shape[0])
+        if sp.issparse(UAM):
+            first, last = UAM.indptr[start], UAM.indptr[end]
+            block = sp.csr_matrix((np.asarray(UAM.data[first:last], dtype=np.float32), UAM.indices[first:last],
+                                   UAM.indptr[start:end+1] - first), shape=(end - start, UAM.shape[1]))
+            sums[start:end] = np.asarray(block.sum(axis=1), dtype=np.float32).ravel()
+            out[first:last] = block.data / np.repeat(sums[start:end], np.diff(block.indptr))
+        else:
+            block = np.asarray(UAM[start:end, :], dtype=np.float32)
+            sums[start:end] = np.sum(block, axis=1)
+            out[start:end, :] = block / sums[start:end, np.newaxis]
+    return sums
+
+
+# Function to compute the statistics of every column (artist) of a dense or sparse UAM, block by block.
+# It returns a dictionary with the sums, sums of squares and numbers of non-zero values of the columns
+def column_stats(UAM, rows=None, memory_budget=MEMORY_BUDGET):
+    rows = rows or block_rows(UAM, 24, memory_budget)     # block (float32), as float64 and its squares
+    stats = {"sums": np.zeros(UAM.shape[1]), "squares": np.zeros(UAM.shape[1]),
+             "counts": np.zeros(UAM.shape[1], dtype=np.int64)}
+    for start in range(0, UAM.shape[0], rows):
+        block = UAM[start:min(start + rows, UAM.shape[0]), :]
+        if sp.issparse(block):
+            data = block.data.astype(np.float64)
+            stats["sums"] += np.bincount(block.indices, weights=data, minlength=UAM.shape[1])
+            stats["squares"] += np.bincount(block.indices, weights=data * data, minlength=UAM.shape[1])
+            stats["counts"] += np.bincount(block.indices[data != 0], minlength=UAM.shape[1])
+        else:
+            block = np.asarray(block, dtype=np.float64)
+            stats["sums"] += np.sum(block, axis=0)
+            stats["squares"] += np.sum(block * block, axis=0)
+            stats["counts"] += np.count_nonzero(block, axis=0)
+    return stats
+
+
+# Function to normalize the playcounts of a binary UAM file (dense or sparse) to a new UAM file, block by block:
+# the output file is created at full size and filled in place, so neither UAM is held in memory
+def normalize_file(counts_file, uam_file, rows=None, memory_budget=MEMORY_BUDGET):
+    counts = UAM_Storage.load_UAM(counts_file)
+    names, header = UAM_Storage.read_arrays(counts_file, mmap=False, names=["users", "artists"])
+    specs = dict((name, (names[name].shape, np.uint8)) for name in names)
+    if sp.issparse(counts):
+        specs.update({"data": (counts.data.shape, np.float32), "indices": (counts.indices.shape, counts.indices.dtype),
+                      "indptr": (counts.indptr.shape, counts.indptr.dtype)})
+    else:
+        specs["data"] = (counts.shape, np.float32)
+    arrays = UAM_Storage.create_arrays(uam_file, specs, {"kind": "uam", "shape": list(counts.shape),
+                                                         "dtype": np.dtype(np.float32).str, "layout": header["layout"]})
+    for name in names:
+        arrays[name][:] = names[name]
+
+    if sp.issparse(counts):
+        # The structure of the matrix does not change; indices are copied in blocks
+        step = int(memory_budget // 8)
+        for start in range(0, counts.nnz, step):
+            arrays["indices"][start:start+step] = counts.indices[start:start+step]
+        arrays["indptr"][:] = counts.indptr
+    normalize_rows(counts, arrays["data"], rows, memory_budget)
+
+    for name in arrays:
+        if isinstance(arrays[name], np.memmap):
+            arrays[name].flush()
+    del arrays
+    UAM_Storage.finish_arrays(uam_file)
+
+
+# Main program
+if __name__ == '__main__':
+
+    # Normalize playcounts block by block
+    if NORMALIZE:
+        normalize_file(COUNTS_FILE, UAM_FILE, BLOCK_ROWS)
+
+    # Load UAM (memory-mapped) and compute statistics of the artists
+    UAM = UAM_Storage.load_UAM(UAM_FILE)
+    stats = column_stats(UAM, BLOCK_ROWS)
+    print "UAM of " + str(UAM.shape[0]) + " users and " + str(UAM.shape[1]) + " artists, " + \
+        str(int(np.count_nonzero(stats["counts"]))) + " artists listened to, mean listeners per artist: %.1f" % \
+        np.mean(stats["counts"])
+
+    # Build and save neighbor index, in tiles of users
+    nn_idx, nn_sim = Neighbor_Index.build_neighbor_index_out_of_core(UAM, K, MEMORY_BUDGET, BLOCK_ROWS)
+    Neighbor_Index.save_neighbor_index(NEIGHBOR_INDEX_FILE, nn_idx, nn_sim, UAM_Storage.content_hash(UAM_FILE))
+    print "Stored " + str(nn_idx.shape[1]) + " neighbors for " + str(nn_idx.shape[0]) + " users in " + \
+        NEIGHBOR_INDEX_FILE
@@ -0,0 +1,232 @@
+# Binary, memory-mappable storage of user-artist-matrices (UAM) and their user / artist index
+__author__ = 'mms'
+
+# Load required modules
+import csv
+import json
+import struct
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+
+# Parameters
+MAGIC = "MRSBIN01"          # first bytes of every binary file written by this module
+ALIGNMENT = 64              # byte alignment of arrays in the file (allows efficient memory mapping)
+
+
+# Function to read metadata (users or artists) from a text file with header
+def read_from_file(filename):
+    data = []
+    with open(filename, 'r') as f:                  # open file for reading
+        reader = csv.reader(f, delimiter='\t')      # create reader
+        headers = reader.next()                     # skip header
+        for row in reader:
+            item = row[0]
+            data.append(item)
+    f.close()
+    return data
+
+
+# Function to align a byte offset to ALIGNMENT
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+# Function to compute the SHA-1 hash over a dictionary of named arrays
+def _hash_arrays(arrays):
+    content_hash = hashlib.sha1()
+    for name in sorted(arrays.keys()):
+        content_hash.update(name)
+        content_hash.update(memoryview(np.ascontiguousarray(arrays[name]).reshape(-1).view(np.uint8)))
+    return content_hash.hexdigest()
+
+
+# Function to write a dictionary of named numpy arrays to a binary file.
+# The file starts with MAGIC, followed by the length of a JSON header and the header itself,
+# which holds the description (dtype, shape, offset) of every array, a SHA-1 hash of the array contents
+# and any additional metadata. The arrays follow as raw, aligned C-order data.
+def write_arrays(filename, arrays, meta=None):
+    names = sorted(arrays.keys())
+    arrays = dict((name, np.ascontiguousarray(arrays[name])) for name in names)
+
+    # Create header with array descriptions and content hash; offsets are relative to the aligned end of the header
+    header = dict(meta) if meta is not None else {}
+    header["hash"] = _hash_arrays(arrays)
+    header["arrays"] = []
+    offset = 0
+    for name in names:
+        offset = _align(offset)
+        header["arrays"].append({"name": name, "dtype": arrays[name].dtype.str,
+                                 "shape": list(arrays[name].shape), "offset": offset})
+        offset += arrays[name].nbytes
+    header_str = json.dumps(header)
+    data_start = _align(len(MAGIC) + 8 + len(header_str))
+
+    # Write magic, header and arrays
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_str)))
+        f.write(header_str)
+        for desc in header["arrays"]:
+            f.seek(data_start + desc["offset"])
+            arrays[desc["name"]].tofile(f)
+        f.truncate(data_start + offset)
+
+
+# Function to create a binary file (as write_arrays) for arrays that are too large for the memory and are filled
+# in place. specs is a dictionary name -> (shape, dtype). It returns a dictionary of writable memory-mapped arrays;
+# finish_arrays has to be called when they are filled (and flushed)
+def create_arrays(filename, specs, meta=None):
+    header = dict(meta) if meta is not None else {}
+    header["hash"] = "0" * 40       # placeholder of the SHA-1 hash (same length), set by finish_arrays
+    header["arrays"] = []
+    offset = 0
+    for name in sorted(specs.keys()):
+        shape, dtype = specs[name]
+        offset = _align(offset)
+        header["arrays"].append({"name": name, "dtype": np.dtype(dtype).str, "shape": list(shape), "offset": offset})
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    header_str = json.dumps(header)
+    data_start = _align(len(MAGIC) + 8 + len(header_str))
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_str)))
+        f.write(header_str)
+        f.truncate(data_start + offset)
+
+    arrays = {}
+    for desc in header["arrays"]:
+        shape = tuple(desc["shape"])
+        if int(np.prod(shape)) > 0:
+            arrays[desc["name"]] = np.memmap(filename, dtype=np.dtype(str(desc["dtype"])), mode='r+',
+                                             offset=data_start + desc["offset"], shape=shape)
+        else:
+            arrays[desc["name"]] = np.zeros(shape, dtype=np.dtype(str(desc["dtype"])))
+    return arrays
+
+
+# Function to finish a file created by create_arrays: the content hash is computed over the memory-mapped arrays
+# (read from disk, not held in memory) and written to the header
+def finish_arrays(filename):
+    arrays, header = read_arrays(filename)
+    header_len = len(json.dumps(header))
+    header["hash"] = _hash_arrays(arrays)
+    del arrays
+    header_str = json.dumps(header)
+    assert len(header_str) == header_len
+    with open(filename, 'r+b') as f:
+        f.seek(len(MAGIC) + 8)
+        f.write(header_str)
+
+
+# Function to check if the given file was written by write_arrays
+def is_binary_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# Function to read the header of a binary file. It returns the header and the offset of the array data
+def read_header(filename):
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError("Not a binary UAM file: " + filename)
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    return header, _align(len(MAGIC) + 8 + header_len)
+
+
+# Function to return the content hash of a binary file (None for files in other formats)
+def content_hash(filename):
+    if is_binary_file(filename):
+        return read_header(filename)[0]["hash"]
+    return None
+
+
+# Function to read the arrays of a binary file, memory-mapped (read-only) or copied into memory.
+# If names is given, only these arrays are read.
+# It returns a dictionary of arrays and the header. Setting verify to True recomputes the content hash
+def read_arrays(filename, mmap=True, verify=False, names=None):
+    header, data_start = read_header(filename)
+    arrays = {}
+    for desc in header["arrays"]:
+        if names is not None and desc["name"] not in names:
+            continue
+        dtype = np.dtype(str(desc["dtype"]))
+        shape = tuple(desc["shape"])
+        if mmap and int(np.prod(shape)) > 0:
+            arrays[desc["name"]] = np.memmap(filename, dtype=dtype, mode='r', offset=data_start + desc["offset"], shape=shape)
+        else:
+            with open(filename, 'rb') as f:
+                f.seek(data_start + desc["offset"])
+                arrays[desc["name"]] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+    if verify:
+        if names is not None:
+            raise ValueError("Content hash can only be verified when reading all arrays")
+        if _hash_arrays(arrays) != header["hash"]:
+            raise IOError("Content hash mismatch in " + filename)
+
+    return arrays, header
+
+
+# Function to encode a list of names (users or artists) as byte array
+def encode_names(names):
+    return np.frombuffer("\n".join(names), dtype=np.uint8) if len(names) > 0 else np.zeros(0, dtype=np.uint8)
+
+
+# Function to decode a byte array to a list of names (users or artists)
+def decode_names(data):
+    return np.asarray(data).tobytes().split("\n") if len(data) > 0 else []
+
+
+# Function to save a dense or sparse (CSR) UAM together with user and artist names in binary format
+def save_UAM(filename, UAM, users=None, artists=None):
+    meta = {"kind": "uam", "shape": list(UAM.shape), "dtype": np.dtype(UAM.dtype).str}
+    if sp.issparse(UAM):
+        UAM = UAM.tocsr()
+        meta["layout"] = "csr"
+        arrays = {"data": UAM.data, "indices": UAM.indices, "indptr": UAM.indptr}
+    else:
+        meta["layout"] = "dense"
+        arrays = {"data": UAM}
+    if users is not None:
+        arrays["users"] = encode_names(users)
+    if artists is not None:
+        arrays["artists"] = encode_names(artists)
+    write_arrays(filename, arrays, meta)
+
+
+# Function to load a UAM. Binary files are memory-mapped (unless mmap is False);
+# sparse .npz files and the old text format (UAM.txt) are supported as well.
+# It returns the UAM as numpy array (dense layout) or scipy CSR matrix (sparse layout)
+def load_UAM(filename, mmap=True, verify=False):
+    if is_binary_file(filename):
+        arrays, header = read_arrays(filename, mmap, verify)
+        if header["layout"] == "csr":
+            return sp.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(header["shape"]), copy=False)
+        return arrays["data"]
+    elif filename.endswith(".npz"):
+        return sp.load_npz(filename).tocsr()
+    else:
+        return np.loadtxt(filename, delimiter='\t', dtype=np.float32)
+
+
+# Function to load UAM, users and artists. User and artist names are taken from the binary UAM file
+# if stored there, otherwise from the given text files. If dense is True, a sparse UAM is converted to a dense one
+def load_data(uam_file, users_file, artists_file, dense=True, mmap=True):
+    UAM = load_UAM(uam_file, mmap)
+    users = None
+    artists = None
+    if is_binary_file(uam_file):
+        arrays, header = read_arrays(uam_file, mmap=False, names=["users", "artists"])
+        if "users" in arrays and "artists" in arrays:
+            users = decode_names(arrays["users"])
+            artists = decode_names(arrays["artists"])
+    if users is None:
+        users = read_from_file(users_file)
+    if artists is None:
+        artists = read_from_file(artists_file)
+    if dense and sp.issparse(UAM):
+        UAM = UAM.toarray()
+    return UAM, users, artists